@@ -3,6 +3,8 @@ from .posts import router as posts_router
 from .users import router as users_router
 from .metadata import router as metadata_router
 from .comments import router as comments_router
+from .uploads import router as uploads_router
+from .search import router as search_router
 
 routers = [
     auth_router,
@@ -10,4 +12,6 @@ routers = [
     users_router,
     metadata_router,
     comments_router,
+    uploads_router,
+    search_router,
 ]
\ No newline at end of file
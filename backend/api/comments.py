@@ -1,54 +1,109 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from sqlalchemy import func, tuple_
 from sqlalchemy.orm import Session, joinedload
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 from database import get_db
 from models import Comment, Post, User
 from schemas import CommentCreate, CommentResponse
 from dependencies import get_current_user
+from feed_cache import REVALIDATE_HEADERS, board_version, mark_board_changed, not_modified_response, weak_etag
+from pagination import decode_cursor, encode_cursor, set_next_cursor
 
 router = APIRouter(prefix="/posts/{post_id}/comments", tags=["comments"])
 
 
+def serialize_comment(comment: Comment) -> dict:
+    """Комментарий в формате CommentResponse"""
+    return {
+        "id": comment.id,
+        "post_id": comment.post_id,
+        "user_id": comment.user_id,
+        "text": comment.text,
+        "date": comment.date,
+        "is_deleted": comment.is_deleted,
+        "author_nick": comment.user.nick if comment.user else None,
+        "author_id": comment.user_id
+    }
+
+
+def change_comment_count(db: Session, post_id: int, delta: int) -> None:
+    """
+    Меняет posts.comment_count в текущей транзакции одним UPDATE, без чтения поста
+    (параллельные комментарии не теряются); счётчик есть в ленте, поэтому меняется и updated_at
+    """
+    db.query(Post).filter(Post.id == post_id).update(
+        {Post.comment_count: Post.comment_count + delta, Post.updated_at: func.now()},
+        synchronize_session=False
+    )
+
+
 @router.get("", response_model=List[CommentResponse])
 def get_comments(
     post_id: int,
-    skip: int = Query(0, ge=0),
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0, description="Устарело: используйте cursor"),
     limit: int = Query(100, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы из заголовка X-Next-Cursor"),
+    after_id: Optional[int] = Query(None, description="Только комментарии новее комментария с этим ID"),
     include_deleted: bool = Query(False, description="Включить удалённые комментарии"),
     db: Session = Depends(get_db)
 ):
-    """Получить список комментариев к посту"""
-    # Проверяем, что пост существует
-    post = db.query(Post).filter(Post.id == post_id).first()
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Пост не найден"
-        )
+    """
+    Получить комментарии к посту (старые сначала)
+
+    Постраничный просмотр - по курсору (date, id) из заголовка X-Next-Cursor. after_id
+    возвращает только комментарии новее уже полученного: открытая страница поста
+    дочитывает новые комментарии, не перечитывая ветку. Без after_id ответ с ETag
+    (без изменений - 304). Страницы читаются индексом ix_comments_thread.
+    """
+    if after_id is not None:
+        # Ключ сортировки последнего полученного комментария; по нему же проверяется пост
+        after = db.query(Comment.date).filter(Comment.id == after_id, Comment.post_id == post_id).first()
+        if not after:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Комментарий не найден"
+            )
+        last_key = (after.date, after_id)
+    else:
+        # ETag по версии доски (её меняет коммит любого изменения комментариев и ников):
+        # если доска не менялась, ответ не строится
+        if not db.query(Post.id).filter(Post.id == post_id).first():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Пост не найден"
+            )
+        etag = weak_etag("comments", post_id, board_version(db))
+        not_modified = not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+        response.headers.update({"ETag": etag, **REVALIDATE_HEADERS})
+        last_key = None
     
     query = db.query(Comment).options(joinedload(Comment.user)).filter(Comment.post_id == post_id)
     
     if not include_deleted:
         query = query.filter(Comment.is_deleted == False)
     
-    comments = query.order_by(Comment.date.asc()).offset(skip).limit(limit).all()
+    if cursor:
+        last_key = decode_cursor(cursor, datetime, int)
+    if last_key:
+        query = query.filter(tuple_(Comment.date, Comment.id) > tuple_(*last_key))
+    elif skip:
+        query = query.offset(skip)
     
-    # Преобразуем в формат ответа
-    result = []
-    for comment in comments:
-        comment_dict = {
-            "id": comment.id,
-            "post_id": comment.post_id,
-            "user_id": comment.user_id,
-            "text": comment.text,
-            "date": comment.date,
-            "is_deleted": comment.is_deleted,
-            "author_nick": comment.user.nick if comment.user else None,
-            "author_id": comment.user_id
-        }
-        result.append(comment_dict)
+    # Одна лишняя запись показывает, есть ли следующая страница
+    comments = query.order_by(Comment.date.asc(), Comment.id.asc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = encode_cursor(comments[-1].date, comments[-1].id)
+    set_next_cursor(response, next_cursor)
     
-    return result
+    # Преобразуем в формат ответа
+    return [serialize_comment(comment) for comment in comments]
 
 
 @router.post("", response_model=CommentResponse, status_code=status.HTTP_201_CREATED)
@@ -81,19 +136,12 @@ def create_comment(
     )
     
     db.add(new_comment)
+    change_comment_count(db, post_id, 1)
+    mark_board_changed(db)
     db.commit()
     db.refresh(new_comment, ['user'])
     
-    return {
-        "id": new_comment.id,
-        "post_id": new_comment.post_id,
-        "user_id": new_comment.user_id,
-        "text": new_comment.text,
-        "date": new_comment.date,
-        "is_deleted": new_comment.is_deleted,
-        "author_nick": new_comment.user.nick if new_comment.user else None,
-        "author_id": new_comment.user_id
-    }
+    return serialize_comment(new_comment)
 
 
 @router.delete("/{comment_id}", response_model=CommentResponse)
@@ -129,17 +177,10 @@ def delete_comment(
         )
     
     comment.is_deleted = True
+    change_comment_count(db, post_id, -1)
+    mark_board_changed(db)
     db.commit()
     db.refresh(comment, ['user'])
     
-    return {
-        "id": comment.id,
-        "post_id": comment.post_id,
-        "user_id": comment.user_id,
-        "text": comment.text,
-        "date": comment.date,
-        "is_deleted": comment.is_deleted,
-        "author_nick": comment.user.nick if comment.user else None,
-        "author_id": comment.user_id
-    }
+    return serialize_comment(comment)
 
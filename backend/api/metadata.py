@@ -1,180 +1,202 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import Response
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import List, Optional
 from database import get_db
-from models import Post, PostFile
+from models import AudioMetadata, Post, PostFile
 from file_utils import get_file_path
-from mutagen import File as MutagenFile
-from mutagen.flac import FLAC, Picture as FLACPicture
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3NoHeaderError
-import base64
-from pathlib import Path
+from media_utils import media_file_response
+from audio_utils import (
+    COVER_EXTENSIONS,
+    cached_audio_cover,
+    cached_audio_metadata,
+    extract_audio_cover,
+    get_cover_type,
+    new_audio_metadata,
+    read_audio_metadata,
+    save_cover,
+    set_audio_metadata,
+)
 
 router = APIRouter(prefix="/posts", tags=["metadata"])
 
+# Сколько постов и файлов можно запросить одним пакетным запросом
+BATCH_METADATA_LIMIT = 100
 
-def extract_audio_metadata(file_path: Path, file_type: str) -> Optional[dict]:
-    """Извлекает метаданные из аудио файла"""
+
+def metadata_response(metadata: AudioMetadata, cover_url: str) -> dict:
+    """
+    Ответ эндпоинтов метаданных
+    Обложка не встраивается в ответ: cover_url указывает на файл в хранилище обложек
+    (один URL для одинаковых обложек), пока обложка не сохранена - на эндпоинт cover_url.
+    """
+    if metadata.cover_hash:
+        cover_url = f"/posts/covers/{metadata.cover_hash}"
+    
+    return {
+        "title": metadata.title,
+        "artist": metadata.artist,
+        "album": metadata.album,
+        "duration": metadata.duration,
+        "bitrate": metadata.bitrate,
+        "has_cover": metadata.has_cover,
+        "cover_url": cover_url if metadata.has_cover else None
+    }
+
+
+def get_disk_path(file_path: Optional[str]):
+    """Путь к файлу на диске или 404"""
+    path = get_file_path(file_path)
+    if not path or not path.exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Файл не найден на сервере"
+        )
+    return path
+
+
+def commit_metadata(db: Session, post_file: PostFile) -> AudioMetadata:
+    """Сохраняет извлечённые метаданные; параллельный запрос мог уже сохранить их же"""
     try:
-        # Убеждаемся, что путь абсолютный
-        if not file_path.is_absolute():
-            # Если путь относительный, делаем его абсолютным от текущей рабочей директории
-            # В Docker контейнере рабочая директория - /app
-            file_path = Path.cwd() / file_path
-        
-        # Проверяем существование файла
-        if not file_path.exists():
-            print(f"Файл не найден: {file_path} (абсолютный путь)")
-            # Пробуем найти файл относительно /app
-            alt_path = Path("/app") / file_path
-            if alt_path.exists():
-                file_path = alt_path
-                print(f"Файл найден по альтернативному пути: {file_path}")
-            else:
-                return None
-        
-        # Открываем файл через Mutagen
-        # Для FLAC используем специальный класс FLAC для лучшей поддержки
-        if file_type and 'flac' in file_type.lower():
-            try:
-                audio_file = FLAC(str(file_path))
-            except Exception as e:
-                print(f"Ошибка открытия FLAC файла через FLAC класс: {e}, пробуем MutagenFile")
-                # Пробуем через общий MutagenFile
-                audio_file = MutagenFile(str(file_path))
-        else:
-            audio_file = MutagenFile(str(file_path))
-        
-        if audio_file is None:
-            print(f"Не удалось открыть файл через Mutagen: {file_path}")
-            return None
-        
-        metadata = {}
-        
-        # Название трека
-        title = None
-        if hasattr(audio_file, 'tags') and audio_file.tags:
-            # Для MP3 (ID3 теги)
-            if 'TIT2' in audio_file.tags:
-                title = str(audio_file.tags['TIT2'][0])
-            elif 'TITLE' in audio_file.tags:
-                title = str(audio_file.tags['TITLE'][0])
-        
-        # Для FLAC и других форматов (Vorbis комментарии)
-        if not title:
-            if 'TITLE' in audio_file:
-                title_list = audio_file.get('TITLE', [])
-                title = str(title_list[0]) if title_list else None
-            elif hasattr(audio_file, 'title'):
-                title_val = audio_file.title
-                title = str(title_val[0]) if isinstance(title_val, list) else str(title_val)
-        
-        metadata['title'] = title
-        
-        # Исполнитель
-        artist = None
-        if hasattr(audio_file, 'tags') and audio_file.tags:
-            # Для MP3 (ID3 теги)
-            if 'TPE1' in audio_file.tags:
-                artist = str(audio_file.tags['TPE1'][0])
-            elif 'ARTIST' in audio_file.tags:
-                artist = str(audio_file.tags['ARTIST'][0])
-        
-        # Для FLAC и других форматов
-        if not artist:
-            if 'ARTIST' in audio_file:
-                artist_list = audio_file.get('ARTIST', [])
-                artist = str(artist_list[0]) if artist_list else None
-            elif hasattr(audio_file, 'artist'):
-                artist_val = audio_file.artist
-                artist = str(artist_val[0]) if isinstance(artist_val, list) else str(artist_val)
-        
-        metadata['artist'] = artist
-        
-        # Альбом
-        album = None
-        if hasattr(audio_file, 'tags') and audio_file.tags:
-            # Для MP3 (ID3 теги)
-            if 'TALB' in audio_file.tags:
-                album = str(audio_file.tags['TALB'][0])
-            elif 'ALBUM' in audio_file.tags:
-                album = str(audio_file.tags['ALBUM'][0])
-        
-        # Для FLAC и других форматов
-        if not album:
-            if 'ALBUM' in audio_file:
-                album_list = audio_file.get('ALBUM', [])
-                album = str(album_list[0]) if album_list else None
-            elif hasattr(audio_file, 'album'):
-                album_val = audio_file.album
-                album = str(album_val[0]) if isinstance(album_val, list) else str(album_val)
-        
-        metadata['album'] = album
-        
-        # Обложка
-        cover_data = None
-        try:
-            # Для MP3 файлов (ID3 теги)
-            if hasattr(audio_file, 'tags') and audio_file.tags:
-                # Пытаемся найти APIC (обложку) в ID3 тегах
-                for key in list(audio_file.tags.keys()):
-                    if key.startswith('APIC') or key == 'APIC:':
-                        apic = audio_file.tags[key]
-                        if hasattr(apic, 'data'):
-                            cover_data = apic.data
-                            break
-                        elif isinstance(apic, list) and len(apic) > 0:
-                            if hasattr(apic[0], 'data'):
-                                cover_data = apic[0].data
-                                break
-            
-            # Для FLAC файлов - используем специальный метод
-            if cover_data is None and isinstance(audio_file, FLAC):
-                # FLAC хранит обложки в pictures (атрибут объекта FLAC)
-                try:
-                    if hasattr(audio_file, 'pictures') and audio_file.pictures:
-                        if len(audio_file.pictures) > 0:
-                            # pictures - это список Picture объектов
-                            pic = audio_file.pictures[0]
-                            if hasattr(pic, 'data'):
-                                cover_data = pic.data
-                                print(f"Обложка найдена через FLAC.pictures: {len(cover_data)} байт")
-                except Exception as e:
-                    print(f"Ошибка при извлечении обложки из FLAC.pictures: {e}")
-                    import traceback
-                    traceback.print_exc()
-            
-            # Для OGG и других форматов
-            if cover_data is None and hasattr(audio_file, 'pictures'):
-                if audio_file.pictures:
-                    cover_data = audio_file.pictures[0].data
-                    
-        except Exception as e:
-            print(f"Ошибка извлечения обложки: {e}")
-            import traceback
-            traceback.print_exc()
-            cover_data = None
-        
-        if cover_data:
-            # Конвертируем в base64 для передачи через API
-            cover_base64 = base64.b64encode(cover_data).decode('utf-8')
-            # Определяем MIME type обложки
-            mime_type = 'image/jpeg'  # По умолчанию
-            if cover_data[:4] == b'\x89PNG':
-                mime_type = 'image/png'
-            elif cover_data[:2] == b'\xff\xd8':
-                mime_type = 'image/jpeg'
-            elif cover_data[:4] == b'RIFF' and cover_data[8:12] == b'WEBP':
-                mime_type = 'image/webp'
-            
-            metadata['cover'] = f"data:{mime_type};base64,{cover_base64}"
-        
-        return metadata if metadata else None
-        
-    except Exception as e:
-        print(f"Ошибка извлечения метаданных: {e}")
-        return None
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+    return db.query(AudioMetadata).filter(AudioMetadata.post_file_id == post_file.id).one()
+
+
+def get_stored_metadata(db: Session, post_file: PostFile) -> AudioMetadata:
+    """
+    Метаданные файла из таблицы audio_metadata
+    Для файлов, загруженных до появления таблицы и ещё не обработанных
+    manage.py backfill-metadata, метаданные извлекаются и сохраняются при первом запросе.
+    """
+    if post_file.audio_metadata is not None:
+        return post_file.audio_metadata
+    
+    set_audio_metadata(post_file, read_audio_metadata(get_disk_path(post_file.file_path), post_file.file_type))
+    return commit_metadata(db, post_file)
+
+
+def get_stored_cover(db: Session, post_file: PostFile) -> AudioMetadata:
+    """
+    Метаданные файла с обложкой в хранилище обложек
+    Обложка извлекается из аудио файла, только если её ещё нет в хранилище
+    (записи, созданные до появления хранилища, или удалённый файл обложки).
+    """
+    metadata = get_stored_metadata(db, post_file)
+    if not metadata.has_cover:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Обложка не найдена в метаданных файла"
+        )
+    
+    if metadata.cover_path and get_file_path(metadata.cover_path).exists():
+        return metadata
+    
+    cover_data = extract_audio_cover(get_disk_path(post_file.file_path), post_file.file_type)
+    set_audio_metadata(post_file, save_cover(cover_data) if cover_data else {"has_cover": False})
+    metadata = commit_metadata(db, post_file)
+    if not metadata.has_cover:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Обложка не найдена в метаданных файла"
+        )
+    return metadata
+
+
+def cover_response(metadata: AudioMetadata, request: Request, immutable: bool = True) -> Response:
+    """Отдаёт обложку из хранилища; хэш обложки служит строгим ETag"""
+    filename = f"cover{COVER_EXTENSIONS.get(metadata.cover_type, '')}"
+    return media_file_response(
+        get_file_path(metadata.cover_path),
+        metadata.cover_type or "image/jpeg",
+        filename,
+        request.headers,
+        immutable=immutable,
+        etag=f'"{metadata.cover_hash}"'
+    )
+
+
+def find_post_file(db: Session, post: Post) -> Optional[PostFile]:
+    """Запись PostFile для файла поста в старых полях (у постов старого формата её нет)"""
+    return db.query(PostFile).filter(
+        PostFile.post_id == post.id,
+        PostFile.file_path == post.file_path
+    ).order_by(PostFile.order).first()
+
+
+def check_audio(file_type: Optional[str]):
+    """Метаданные есть только у аудио файлов"""
+    if not file_type or not file_type.startswith('audio/'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Метаданные доступны только для аудио файлов"
+        )
+
+
+@router.get("/covers/{cover_hash}")
+def get_cover(
+    cover_hash: str,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Получить обложку из хранилища обложек по её хэшу (кэшируется браузером бессрочно)"""
+    metadata = db.query(AudioMetadata).filter(AudioMetadata.cover_hash == cover_hash).first()
+    
+    if not metadata or not metadata.cover_path or not get_file_path(metadata.cover_path).exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Обложка не найдена"
+        )
+    
+    return cover_response(metadata, request)
+
+
+@router.get("/metadata/batch")
+def get_batch_metadata(
+    post_ids: List[int] = Query(default=[]),
+    file_ids: List[int] = Query(default=[]),
+    db: Session = Depends(get_db)
+):
+    """
+    Получить метаданные аудио файлов нескольких постов и/или файлов одним запросом
+
+    Пример: /posts/metadata/batch?post_ids=1&post_ids=2&file_ids=15
+    Возвращает все аудио файлы указанных постов и указанные файлы по порядку в посте.
+    Метаданные читаются одним запросом из audio_metadata и не извлекаются из файлов:
+    у файлов, ещё не обработанных manage.py backfill-metadata, поля пустые.
+    """
+    if not post_ids and not file_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Укажите post_ids или file_ids"
+        )
+    
+    if len(post_ids) + len(file_ids) > BATCH_METADATA_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"За один запрос можно получить метаданные не более {BATCH_METADATA_LIMIT} постов и файлов"
+        )
+    
+    rows = db.query(PostFile.id, PostFile.post_id, PostFile.order, AudioMetadata).select_from(PostFile).outerjoin(
+        AudioMetadata
+    ).filter(
+        or_(PostFile.post_id.in_(post_ids), PostFile.id.in_(file_ids)),
+        PostFile.file_type.like("audio/%")
+    ).order_by(PostFile.post_id, PostFile.order).all()
+    
+    tracks = []
+    for file_id, post_id, order, metadata in rows:
+        track = metadata_response(
+            metadata if metadata is not None else new_audio_metadata(None),
+            f"/posts/{post_id}/files/{file_id}/cover"
+        )
+        track.update({"post_id": post_id, "file_id": file_id, "order": order})
+        tracks.append(track)
+    
+    return {"tracks": tracks}
 
 
 @router.get("/{post_id}/metadata")
@@ -197,44 +219,17 @@ def get_post_metadata(
             detail="У поста нет файла"
         )
     
-    # Проверяем, что это аудио файл
-    if not post.file_type or not post.file_type.startswith('audio/'):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Метаданные доступны только для аудио файлов"
-        )
-    
-    file_path = get_file_path(post.file_path)
-    if not file_path or not file_path.exists():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Файл не найден на сервере"
-        )
-    
-    # Извлекаем метаданные
-    metadata = extract_audio_metadata(file_path, post.file_type)
+    check_audio(post.file_type)
     
-    if not metadata:
-        return {
-            "title": None,
-            "artist": None,
-            "album": None,
-            "cover": None,
-            "cover_url": None
-        }
+    cover_url = f"/posts/{post_id}/cover"
+    post_file = find_post_file(db, post)
     
-    # Формируем URL для обложки (если есть)
-    cover_url = None
-    if metadata.get('cover'):
-        cover_url = f"/posts/{post_id}/cover"
+    # Пост старого формата без записи в post_files - метаданные негде сохранить
+    if not post_file:
+        metadata = cached_audio_metadata(get_disk_path(post.file_path), post.file_type)
+        return metadata_response(new_audio_metadata(metadata), cover_url)
     
-    return {
-        "title": metadata.get('title'),
-        "artist": metadata.get('artist'),
-        "album": metadata.get('album'),
-        "cover": metadata.get('cover'),  # Base64 для прямого использования
-        "cover_url": cover_url  # URL для получения обложки отдельно
-    }
+    return metadata_response(get_stored_metadata(db, post_file), cover_url)
 
 
 @router.get("/{post_id}/files/{file_id}/metadata")
@@ -255,50 +250,16 @@ def get_file_metadata(
             detail="Файл не найден"
         )
     
-    # Проверяем, что это аудио файл
-    if not post_file.file_type or not post_file.file_type.startswith('audio/'):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Метаданные доступны только для аудио файлов"
-        )
+    check_audio(post_file.file_type)
     
-    file_path = get_file_path(post_file.file_path)
-    if not file_path or not file_path.exists():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Файл не найден на сервере"
-        )
-    
-    # Извлекаем метаданные
-    metadata = extract_audio_metadata(file_path, post_file.file_type)
-    
-    if not metadata:
-        return {
-            "title": None,
-            "artist": None,
-            "album": None,
-            "cover": None,
-            "cover_url": None
-        }
-    
-    # Формируем URL для обложки (если есть)
-    cover_url = None
-    if metadata.get('cover'):
-        cover_url = f"/posts/{post_id}/files/{file_id}/cover"
-    
-    return {
-        "title": metadata.get('title'),
-        "artist": metadata.get('artist'),
-        "album": metadata.get('album'),
-        "cover": metadata.get('cover'),  # Base64 для прямого использования
-        "cover_url": cover_url  # URL для получения обложки отдельно
-    }
+    return metadata_response(get_stored_metadata(db, post_file), f"/posts/{post_id}/files/{file_id}/cover")
 
 
 @router.get("/{post_id}/files/{file_id}/cover")
 def get_file_cover(
     post_id: int,
     file_id: int,
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """Получить обложку конкретного аудио файла из поста (для альбомов)"""
@@ -313,45 +274,16 @@ def get_file_cover(
             detail="Файл не найден"
         )
     
-    file_path = get_file_path(post_file.file_path)
-    if not file_path or not file_path.exists():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Файл не найден"
-        )
+    check_audio(post_file.file_type)
     
-    metadata = extract_audio_metadata(file_path, post_file.file_type)
-    
-    if not metadata or not metadata.get('cover'):
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Обложка не найдена в метаданных файла"
-        )
-    
-    # Парсим data URL
-    cover_data_url = metadata['cover']
-    if cover_data_url.startswith('data:'):
-        # Извлекаем MIME type и данные
-        header, data = cover_data_url.split(',', 1)
-        mime_type = header.split(';')[0].split(':')[1]
-        cover_bytes = base64.b64decode(data)
-        
-        from fastapi.responses import Response
-        return Response(
-            content=cover_bytes,
-            media_type=mime_type,
-            headers={"Cache-Control": "public, max-age=3600"}
-        )
-    
-    raise HTTPException(
-        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-        detail="Ошибка обработки обложки"
-    )
+    # Файл записи PostFile не меняется, поэтому и его обложка тоже
+    return cover_response(get_stored_cover(db, post_file), request)
 
 
 @router.get("/{post_id}/cover")
 def get_post_cover(
     post_id: int,
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """Получить обложку аудио файла поста (старый формат)"""
@@ -363,38 +295,23 @@ def get_post_cover(
             detail="Пост или файл не найден"
         )
     
-    file_path = get_file_path(post.file_path)
-    if not file_path or not file_path.exists():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Файл не найден"
-        )
+    check_audio(post.file_type)
     
-    metadata = extract_audio_metadata(file_path, post.file_type)
+    post_file = find_post_file(db, post)
+    if post_file:
+        # Файл поста может смениться при редактировании - ответ перепроверяется по ETag
+        return cover_response(get_stored_cover(db, post_file), request, immutable=False)
     
-    if not metadata or not metadata.get('cover'):
+    # Пост старого формата без записи в post_files - обложку негде сохранить
+    cover_data = cached_audio_cover(get_disk_path(post.file_path), post.file_type)
+    if not cover_data:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Обложка не найдена в метаданных файла"
         )
     
-    # Парсим data URL
-    cover_data_url = metadata['cover']
-    if cover_data_url.startswith('data:'):
-        # Извлекаем MIME type и данные
-        header, data = cover_data_url.split(',', 1)
-        mime_type = header.split(';')[0].split(':')[1]
-        cover_bytes = base64.b64decode(data)
-        
-        from fastapi.responses import Response
-        return Response(
-            content=cover_bytes,
-            media_type=mime_type,
-            headers={"Cache-Control": "public, max-age=3600"}
-        )
-    
-    raise HTTPException(
-        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-        detail="Ошибка обработки обложки"
+    return Response(
+        content=cover_data,
+        media_type=get_cover_type(cover_data),
+        headers={"Cache-Control": "public, max-age=3600"}
     )
-
@@ -1,624 +1,674 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File, Form, Request, Header
-from fastapi.responses import FileResponse, Response, StreamingResponse
-from sqlalchemy.orm import Session, joinedload
-from typing import List, Optional
-from urllib.parse import quote
-from database import get_db
-from models import Post, User, PostFile
-from schemas import PostResponse, PostFileResponse
-from dependencies import get_current_user
-from file_utils import save_uploaded_file, delete_file, get_file_path, SUPPORTED_TYPES
-
-router = APIRouter(prefix="/posts", tags=["posts"])
-
-
-def add_file_url_to_post(post: Post, request: Request) -> dict:
-    """Добавляет file_url, files и author_nick к посту для отображения в Swagger"""
-    base_url = str(request.base_url).rstrip('/')
-    
-    post_dict = {
-        "id": post.id,
-        "text": post.text,
-        # Старые поля для обратной совместимости
-        "file_path": post.file_path,
-        "file_type": post.file_type,
-        "file_name": post.file_name,
-        "file_url": None,
-        # Новые поля
-        "files": [],
-        "date": post.date,
-        "is_deleted": post.is_deleted,
-        "upvotes": post.upvotes,
-        "author_nick": None,
-        "author_id": post.user_id if post.user_id else None
-    }
-    
-    # Добавляем URL для старого файла, если он есть (обратная совместимость)
-    if post.file_path:
-        post_dict["file_url"] = f"{base_url}/posts/{post.id}/file"
-    
-    # Добавляем информацию о новых файлах
-    if hasattr(post, 'files') and post.files:
-        for file in post.files:
-            file_dict = {
-                "id": file.id,
-                "file_path": file.file_path,
-                "file_type": file.file_type,
-                "file_name": file.file_name,
-                "file_url": f"{base_url}/posts/{post.id}/files/{file.id}",
-                "file_size": file.file_size,
-                "order": file.order
-            }
-            post_dict["files"].append(file_dict)
-    
-    # Добавляем ник пользователя, если связь загружена
-    if post.user:
-        post_dict["author_nick"] = post.user.nick
-    
-    return post_dict
-
-
-@router.get("", response_model=List[PostResponse])
-def get_posts(
-    request: Request,
-    skip: int = Query(0, ge=0),
-    limit: int = Query(100, ge=1, le=100),
-    include_deleted: bool = Query(False, description="Включить удалённые посты"),
-    db: Session = Depends(get_db)
-):
-    """Получить список постов"""
-    query = db.query(Post).options(joinedload(Post.user), joinedload(Post.files))
-    
-    if not include_deleted:
-        query = query.filter(Post.is_deleted == False)
-    
-    posts = query.order_by(Post.date.desc()).offset(skip).limit(limit).all()
-    
-    # Добавляем file_url к каждому посту
-    return [add_file_url_to_post(post, request) for post in posts]
-
-
-@router.get("/{post_id}", response_model=PostResponse)
-def get_post(post_id: int, request: Request, db: Session = Depends(get_db)):
-    """Получить пост по ID"""
-    post = db.query(Post).options(joinedload(Post.user), joinedload(Post.files)).filter(Post.id == post_id).first()
-    
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Пост не найден"
-        )
-    
-    # Добавляем file_url для отображения в Swagger
-    return add_file_url_to_post(post, request)
-
-
-@router.post("", response_model=PostResponse, status_code=status.HTTP_201_CREATED)
-async def create_post(
-    request: Request,
-    text: Optional[str] = Form(None),
-    files: List[UploadFile] = File(default=[]),  # Теперь принимаем список файлов
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """Создать новый пост с возможностью загрузки одного или нескольких файлов"""
-    
-    # Проверяем, что есть либо текст, либо файлы
-    if not text and (not files or len(files) == 0):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Необходимо указать текст поста или загрузить хотя бы один файл"
-        )
-    
-    new_post = Post(
-        text=text if text and text.strip() else None,  # Сохраняем None вместо пустой строки
-        user_id=current_user.id
-    )
-    
-    db.add(new_post)
-    db.flush()  # Получаем ID поста
-    
-    # Сохраняем все файлы
-    for order, file in enumerate(files):
-        if file and file.filename:  # Проверяем, что файл действительно передан
-            try:
-                file_path, file_type, file_name, file_size = await save_uploaded_file(file)
-                
-                # Создаём запись о файле
-                post_file = PostFile(
-                    post_id=new_post.id,
-                    file_path=file_path,
-                    file_type=file_type,
-                    file_name=file_name,
-                    file_size=file_size,
-                    order=order
-                )
-                db.add(post_file)
-                
-                # Для обратной совместимости сохраняем первый файл в старые поля
-                if order == 0:
-                    new_post.file_path = file_path
-                    new_post.file_type = file_type
-                    new_post.file_name = file_name
-            except Exception as e:
-                # Если ошибка при сохранении файла, пропускаем его
-                print(f"Ошибка при сохранении файла {file.filename}: {e}")
-                continue
-    
-    db.commit()
-    db.refresh(new_post)
-    
-    # Загружаем пользователя и файлы для отображения
-    db.refresh(new_post, ['user', 'files'])
-    
-    # Добавляем file_url для отображения в Swagger
-    return add_file_url_to_post(new_post, request)
-
-
-@router.put("/{post_id}", response_model=PostResponse)
-async def update_post(
-    post_id: int,
-    request: Request,
-    text: Optional[str] = Form(None),
-    file: Optional[UploadFile] = File(None),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """Обновить пост (можно обновить текст и/или файл)"""
-    post = db.query(Post).options(joinedload(Post.user), joinedload(Post.files)).filter(Post.id == post_id).first()
-    
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Пост не найден"
-        )
-    
-    if post.is_deleted:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Нельзя обновить удалённый пост"
-        )
-    
-    # Обновляем текст, если передан
-    if text is not None:
-        post.text = text
-    
-    # Обновляем файл, если загружен новый
-    if file:
-        # Удаляем старый файл, если он был
-        if post.file_path:
-            delete_file(post.file_path)
-        
-        # Сохраняем новый файл
-        file_path, file_type, file_name, file_size = await save_uploaded_file(file)
-        
-        # Удаляем все старые файлы из PostFile
-        db.query(PostFile).filter(PostFile.post_id == post_id).delete()
-        
-        # Создаём новую запись о файле
-        post_file = PostFile(
-            post_id=post.id,
-            file_path=file_path,
-            file_type=file_type,
-            file_name=file_name,
-            file_size=file_size,
-            order=0
-        )
-        db.add(post_file)
-        
-        # Для обратной совместимости сохраняем в старые поля
-        post.file_path = file_path
-        post.file_type = file_type
-        post.file_name = file_name
-    
-    db.commit()
-    db.refresh(post, ['user', 'files'])
-    
-    # Добавляем file_url для отображения в Swagger
-    return add_file_url_to_post(post, request)
-
-
-@router.delete("/{post_id}", response_model=PostResponse)
-def delete_post(
-    post_id: int,
-    request: Request,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """Удалить пост (soft delete) - только свой пост"""
-    post = db.query(Post).options(joinedload(Post.user), joinedload(Post.files)).filter(Post.id == post_id).first()
-    
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Пост не найден"
-        )
-    
-    # Проверяем, что пользователь может удалять только свои посты
-    if post.user_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Вы можете удалять только свои посты"
-        )
-    
-    if post.is_deleted:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Пост уже удалён"
-        )
-    
-    # Удаляем файл с диска при удалении поста (старый способ)
-    if post.file_path:
-        delete_file(post.file_path)
-    
-    # Удаляем все файлы из PostFile
-    for post_file in post.files:
-        if post_file.file_path:
-            delete_file(post_file.file_path)
-    
-    post.is_deleted = True
-    post.file_path = None
-    post.file_type = None
-    post.file_name = None
-    db.commit()
-    db.refresh(post, ['user', 'files'])
-    
-    # Добавляем file_url (будет None, так как файл удалён)
-    return add_file_url_to_post(post, request)
-
-@router.post("/{post_id}/upvote", response_model=PostResponse)
-def upvote_post(
-    post_id: int,
-    request: Request,
-    db: Session = Depends(get_db)
-):
-    """Увеличить количество апвоутов поста"""
-    post = db.query(Post).options(joinedload(Post.user)).filter(Post.id == post_id).first()
-    
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Пост не найден"
-        )
-    
-    if post.is_deleted:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Нельзя апвоутить удалённый пост"
-        )
-    
-    post.upvotes += 1
-    db.commit()
-    db.refresh(post, ['user'])
-    
-    # Добавляем file_url для отображения в Swagger
-    return add_file_url_to_post(post, request)
-
-@router.post("/{post_id}/downvote", response_model=PostResponse)
-def downvote_post(
-    post_id: int,
-    request: Request,
-    db: Session = Depends(get_db)
-):
-    """Уменьшить количество апвоутов поста (даунвоут)"""
-    post = db.query(Post).options(joinedload(Post.user), joinedload(Post.files)).filter(Post.id == post_id).first()
-    
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Пост не найден"
-        )
-    
-    if post.is_deleted:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Нельзя даунвоутить удалённый пост"
-        )
-    
-    post.upvotes -= 1
-    db.commit()
-    db.refresh(post, ['user', 'files'])
-    
-    # Добавляем file_url для отображения в Swagger
-    return add_file_url_to_post(post, request)
-
-
-@router.get(
-    "/{post_id}/file",
-    responses={
-        200: {
-            "content": {
-                "image/jpeg": {},
-                "image/png": {},
-                "image/gif": {},
-                "image/webp": {},
-                "video/mp4": {},
-                "video/webm": {},
-                "video/ogg": {},
-                "video/quicktime": {},
-                "audio/mpeg": {},
-                "audio/ogg": {},
-                "audio/wav": {},
-                "audio/webm": {},
-                "audio/flac": {},
-                "audio/x-flac": {},
-            },
-            "description": "Файл поста. Swagger UI автоматически отобразит изображения и видео. Примечание: FLAC может не воспроизводиться в некоторых браузерах из-за ограничений поддержки формата."
-        }
-    }
-)
-def get_post_file(
-    post_id: int,
-    range_header: Optional[str] = Header(None, alias="Range"),
-    db: Session = Depends(get_db)
-):
-    """
-    Получить файл поста
-    
-    **Для просмотра в Swagger UI:**
-    - Изображения (JPEG, PNG, GIF, WebP) будут отображены автоматически
-    - Видео (MP4, WebM, OGG, MOV) можно воспроизвести прямо в Swagger UI
-    - Аудио файлы (MP3, OGG, WAV, WebM) можно воспроизвести в Swagger UI
-    - FLAC файлы могут не воспроизводиться в некоторых браузерах (Chrome, Firefox не поддерживают FLAC в HTML5 audio)
-      В этом случае файл можно скачать и воспроизвести во внешнем плеере
-    - Или используйте file_url из ответа GET /posts/{id} для прямого доступа
-    """
-    post = db.query(Post).options(joinedload(Post.files)).filter(Post.id == post_id).first()
-    
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Пост не найден"
-        )
-    
-    # Сначала проверяем новые файлы (из post_files)
-    post_file = None
-    if post.files and len(post.files) > 0:
-        # Используем первый файл из списка
-        post_file = post.files[0]
-        file_path = get_file_path(post_file.file_path)
-        media_type = post_file.file_type or "application/octet-stream"
-        filename = post_file.file_name or "file"
-    # Если новых файлов нет, используем старые поля (обратная совместимость)
-    elif post.file_path:
-        file_path = get_file_path(post.file_path)
-        media_type = post.file_type or "application/octet-stream"
-        filename = post.file_name or "file"
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="У поста нет файла"
-        )
-    
-    if not file_path or not file_path.exists():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Файл не найден на сервере"
-        )
-    
-    # Для изображений, видео и аудио используем inline, чтобы Swagger UI мог их отобразить
-    # Для других файлов - attachment (скачивание)
-    is_media = (
-        media_type.startswith('image/') or 
-        media_type.startswith('video/') or 
-        media_type.startswith('audio/')
-    )
-    
-    # Формируем имя файла для заголовка
-    filename = post.file_name or "file"
-    
-    if is_media:
-        # Получаем размер файла
-        file_size = file_path.stat().st_size
-        
-        # Обработка Range requests для потоковой передачи (важно для аудио/видео)
-        if range_header:
-            # Парсим Range заголовок (формат: bytes=start-end)
-            try:
-                range_match = range_header.replace('bytes=', '').split('-')
-                start = int(range_match[0]) if range_match[0] else 0
-                end = int(range_match[1]) if range_match[1] and range_match[1] else file_size - 1
-                
-                if start >= file_size or end >= file_size:
-                    raise HTTPException(
-                        status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
-                        detail="Range Not Satisfiable"
-                    )
-                
-                # Читаем только нужную часть файла
-                with open(file_path, 'rb') as f:
-                    f.seek(start)
-                    content = f.read(end - start + 1)
-                
-                # Кодируем имя файла
-                try:
-                    filename_ascii = filename.encode('ascii', 'ignore').decode('ascii')
-                    if not filename_ascii or filename_ascii != filename:
-                        filename_encoded = quote(filename, safe='')
-                        content_disposition = f'inline; filename*=UTF-8\'\'{filename_encoded}'
-                    else:
-                        content_disposition = f'inline; filename="{filename_ascii}"'
-                except:
-                    content_disposition = 'inline; filename="file"'
-                
-                headers = {
-                    "Content-Range": f"bytes {start}-{end}/{file_size}",
-                    "Accept-Ranges": "bytes",
-                    "Content-Length": str(len(content)),
-                    "Content-Disposition": content_disposition
-                }
-                
-                return Response(
-                    content=content,
-                    media_type=media_type,
-                    status_code=status.HTTP_206_PARTIAL_CONTENT,
-                    headers=headers
-                )
-            except (ValueError, IndexError):
-                # Если Range заголовок некорректный, возвращаем весь файл
-                pass
-        
-        # Обычный запрос - возвращаем весь файл
-        with open(file_path, 'rb') as f:
-            content = f.read()
-        
-        # Кодируем имя файла для заголовка согласно RFC 2231
-        try:
-            filename_ascii = filename.encode('ascii', 'ignore').decode('ascii')
-            if not filename_ascii or filename_ascii != filename:
-                filename_encoded = quote(filename, safe='')
-                content_disposition = f'inline; filename*=UTF-8\'\'{filename_encoded}'
-            else:
-                content_disposition = f'inline; filename="{filename_ascii}"'
-        except:
-            content_disposition = 'inline; filename="file"'
-        
-        # Заголовки для медиа-файлов
-        headers = {
-            "Content-Disposition": content_disposition,
-            "Accept-Ranges": "bytes",  # Поддержка частичных запросов для потоковой передачи
-            "Content-Length": str(len(content))
-        }
-        
-        # Для аудио файлов добавляем дополнительные заголовки
-        if media_type.startswith('audio/'):
-            headers["Cache-Control"] = "public, max-age=3600"
-        
-        return Response(
-            content=content,
-            media_type=media_type,
-            headers=headers
-        )
-    else:
-        # Для других файлов - attachment (скачивание)
-        return FileResponse(
-            path=str(file_path),
-            media_type=media_type,
-            filename=filename
-        )
-
-
-@router.get("/{post_id}/files/{file_id}")
-def get_post_file_by_id(
-    post_id: int,
-    file_id: int,
-    range_header: Optional[str] = Header(None, alias="Range"),
-    db: Session = Depends(get_db)
-):
-    """
-    Получить конкретный файл поста по ID файла
-    
-    Поддерживает любые типы файлов:
-    - Изображения, видео, аудио - отображаются/воспроизводятся в браузере
-    - Остальные файлы - скачиваются
-    """
-    post_file = db.query(PostFile).filter(
-        PostFile.id == file_id,
-        PostFile.post_id == post_id
-    ).first()
-    
-    if not post_file:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Файл не найден"
-        )
-    
-    file_path = get_file_path(post_file.file_path)
-    if not file_path or not file_path.exists():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Файл не найден на сервере"
-        )
-    
-    media_type = post_file.file_type or "application/octet-stream"
-    filename = post_file.file_name or "file"
-    
-    # Определяем, является ли файл медиа-файлом
-    is_media = (
-        media_type.startswith('image/') or 
-        media_type.startswith('video/') or 
-        media_type.startswith('audio/')
-    )
-    
-    if is_media:
-        file_size = file_path.stat().st_size
-        
-        # Обработка Range requests
-        if range_header:
-            try:
-                range_match = range_header.replace('bytes=', '').split('-')
-                start = int(range_match[0]) if range_match[0] else 0
-                end = int(range_match[1]) if range_match[1] and range_match[1] else file_size - 1
-                
-                if start >= file_size or end >= file_size:
-                    raise HTTPException(
-                        status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
-                        detail="Range Not Satisfiable"
-                    )
-                
-                with open(file_path, 'rb') as f:
-                    f.seek(start)
-                    content = f.read(end - start + 1)
-                
-                try:
-                    filename_ascii = filename.encode('ascii', 'ignore').decode('ascii')
-                    if not filename_ascii or filename_ascii != filename:
-                        filename_encoded = quote(filename, safe='')
-                        content_disposition = f'inline; filename*=UTF-8\'\'{filename_encoded}'
-                    else:
-                        content_disposition = f'inline; filename="{filename_ascii}"'
-                except:
-                    content_disposition = 'inline; filename="file"'
-                
-                headers = {
-                    "Content-Range": f"bytes {start}-{end}/{file_size}",
-                    "Accept-Ranges": "bytes",
-                    "Content-Length": str(len(content)),
-                    "Content-Disposition": content_disposition
-                }
-                
-                return Response(
-                    content=content,
-                    media_type=media_type,
-                    status_code=status.HTTP_206_PARTIAL_CONTENT,
-                    headers=headers
-                )
-            except (ValueError, IndexError):
-                pass
-        
-        # Обычный запрос
-        with open(file_path, 'rb') as f:
-            content = f.read()
-        
-        try:
-            filename_ascii = filename.encode('ascii', 'ignore').decode('ascii')
-            if not filename_ascii or filename_ascii != filename:
-                filename_encoded = quote(filename, safe='')
-                content_disposition = f'inline; filename*=UTF-8\'\'{filename_encoded}'
-            else:
-                content_disposition = f'inline; filename="{filename_ascii}"'
-        except:
-            content_disposition = 'inline; filename="file"'
-        
-        headers = {
-            "Content-Disposition": content_disposition,
-            "Accept-Ranges": "bytes",
-            "Content-Length": str(len(content))
-        }
-        
-        if media_type.startswith('audio/'):
-            headers["Cache-Control"] = "public, max-age=3600"
-        
-        return Response(
-            content=content,
-            media_type=media_type,
-            headers=headers
-        )
-    else:
-        # Для других файлов - attachment (скачивание)
-        return FileResponse(
-            path=str(file_path),
-            media_type=media_type,
-            filename=filename
-        )
-
+from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File, Form, Request
+from sqlalchemy import and_, tuple_
+from sqlalchemy.orm import Session, joinedload
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import asyncio
+from database import get_db
+from models import Post, User, PostFile, Vote
+from schemas import PostResponse, PostFileResponse, VoteResponse
+from dependencies import get_current_user
+from file_utils import (
+    save_uploaded_file,
+    stage_uploaded_file,
+    store_staged_file,
+    schedule_file_deletion,
+    release_post_file,
+    get_file_path,
+    get_post_category,
+    get_preview_path,
+    SUPPORTED_TYPES,
+)
+from media_utils import media_file_response
+from pagination import decode_cursor, encode_cursor, next_cursor_headers
+from json_utils import FastJSONResponse
+from feed_cache import board_version, cached_json_response, mark_board_changed, touch_posts, weak_etag
+from audio_utils import is_audio, probe_audio_metadata, set_audio_metadata
+from preview_utils import PREVIEW_MEDIA_TYPES, parse_preview_widths, pick_thumbnail_width
+from tasks import request_previews, request_reclaim, request_vote_flush
+from votes import cast_vote, vote_buffer
+
+router = APIRouter(prefix="/posts", tags=["posts"])
+
+# Сортировки ленты: колонка ключа сортировки и тип её значения в курсоре
+FEED_SORT_KEYS = {
+    "date": (Post.date, datetime),
+    "upvotes": (Post.upvotes, int),
+}
+
+
+@lru_cache(maxsize=64)
+def _preview_layout(preview_widths: str) -> Tuple[Optional[int], Tuple[int, ...]]:
+    """Ширина thumbnail и все ширины копий по значению PostFile.preview_widths (значений немного)"""
+    widths = parse_preview_widths(preview_widths)
+    return pick_thumbnail_width(widths), tuple(widths)
+
+
+def get_posts_url(request: Request) -> str:
+    """Префикс ссылок на посты: <base_url>/posts (считается один раз на запрос)"""
+    return f"{str(request.base_url).rstrip('/')}/posts"
+
+
+def serialize_post_file(file: PostFile, post_url: str) -> dict:
+    """Файл поста в формате PostFileResponse"""
+    file_url = f"{post_url}/files/{file.id}"
+    thumbnail_url = None
+    srcset = None
+    
+    # Уменьшенные копии изображения или обложки аудио (если уже построены)
+    if file.preview_widths:
+        thumbnail_width, widths = _preview_layout(file.preview_widths)
+        if widths:
+            preview_url = f"{file_url}/preview"
+            thumbnail_url = f"{preview_url}/{thumbnail_width}"
+            srcset = ", ".join(f"{preview_url}/{width} {width}w" for width in widths)
+    
+    return {
+        "id": file.id,
+        "file_path": file.file_path,
+        "file_type": file.file_type,
+        "file_name": file.file_name,
+        "file_url": file_url,
+        "file_size": file.file_size,
+        "order": file.order,
+        "thumbnail_url": thumbnail_url,
+        "srcset": srcset,
+    }
+
+
+def serialize_post(post: Post, posts_url: str) -> dict:
+    """
+    Пост в формате PostResponse без проверки pydantic (горячий путь ленты)
+    posts_url - готовый префикс из get_posts_url. Набор и типы полей должны совпадать
+    с PostResponse и PostFileResponse: ответ кодируется в JSON как есть.
+    """
+    post_url = f"{posts_url}/{post.id}"
+    user = post.user
+    return {
+        "id": post.id,
+        "text": post.text,
+        # Старые поля для обратной совместимости
+        "file_path": post.file_path,
+        "file_type": post.file_type,
+        "file_name": post.file_name,
+        "file_url": f"{post_url}/file" if post.file_path else None,
+        # Новые поля
+        "files": [serialize_post_file(file, post_url) for file in post.files],
+        "date": post.date,
+        "is_deleted": post.is_deleted,
+        "upvotes": post.upvotes,
+        "category": post.category,
+        "comment_count": post.comment_count,
+        "file_count": post.file_count,
+        "author_nick": user.nick if user else None,
+        "author_id": post.user_id if post.user_id else None,
+    }
+
+
+def add_file_url_to_post(post: Post, request: Request) -> dict:
+    """Добавляет file_url, files и author_nick к посту для отображения в Swagger"""
+    return serialize_post(post, get_posts_url(request))
+
+
+def feed_etag(db: Session) -> str:
+    """ETag ленты по версии доски: её меняет коммит любого изменения постов"""
+    return weak_etag("posts", board_version(db))
+
+
+def post_etag(db: Session, post_id: int) -> str:
+    """ETag поста по его updated_at"""
+    updated_at = db.query(Post.updated_at).filter(Post.id == post_id).scalar()
+    return weak_etag("post", post_id, updated_at)
+
+
+def build_posts_page(
+    db: Session,
+    request: Request,
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+    category: Optional[str],
+    sort: str,
+    order: str,
+    include_deleted: bool
+) -> Tuple[List[dict], Dict[str, str]]:
+    """Страница ленты и заголовки ответа (курсор следующей страницы)"""
+    sort_column, sort_type = FEED_SORT_KEYS[sort]
+    query = db.query(Post).options(joinedload(Post.user), joinedload(Post.files))
+    
+    if not include_deleted:
+        query = query.filter(Post.is_deleted == False)
+    if category:
+        query = query.filter(Post.category == category)
+    
+    if order == "asc":
+        query = query.order_by(sort_column.asc(), Post.id.asc())
+    else:
+        query = query.order_by(sort_column.desc(), Post.id.desc())
+    if cursor:
+        cursor_value, cursor_id = decode_cursor(cursor, sort_type, int)
+        sort_key = tuple_(sort_column, Post.id)
+        last_key = tuple_(cursor_value, cursor_id)
+        query = query.filter(sort_key > last_key if order == "asc" else sort_key < last_key)
+    elif skip:
+        query = query.offset(skip)
+    
+    # Одна лишняя запись показывает, есть ли следующая страница
+    posts = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = encode_cursor(getattr(posts[-1], sort_column.key), posts[-1].id)
+    
+    # Добавляем file_url к каждому посту
+    posts_url = get_posts_url(request)
+    return [serialize_post(post, posts_url) for post in posts], next_cursor_headers(next_cursor)
+
+
+def build_post(db: Session, request: Request, post_id: int) -> Tuple[dict, Dict[str, str]]:
+    """Пост по ID для ответа (404, если его нет)"""
+    post = db.query(Post).options(joinedload(Post.user), joinedload(Post.files)).filter(Post.id == post_id).first()
+    
+    if not post:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пост не найден"
+        )
+    
+    # Добавляем file_url для отображения в Swagger
+    return add_file_url_to_post(post, request), {}
+
+
+@router.get("", response_model=List[PostResponse], response_class=FastJSONResponse)
+def get_posts(
+    request: Request,
+    skip: int = Query(0, ge=0, description="Устарело: используйте cursor"),
+    limit: int = Query(100, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы из заголовка X-Next-Cursor"),
+    category: Optional[str] = Query(None, pattern="^(image|video|audio|text|other)$", description="Категория постов (по первому файлу)"),
+    sort: str = Query("date", pattern="^(date|upvotes)$", description="Сортировка: по дате или по апвоутам"),
+    order: str = Query("desc", pattern="^(asc|desc)$", description="Направление сортировки"),
+    include_deleted: bool = Query(False, description="Включить удалённые посты"),
+    db: Session = Depends(get_db)
+):
+    """
+    Получить список постов (по умолчанию новые сначала)
+
+    Постраничный просмотр - по курсору: курсор следующей страницы возвращается
+    в заголовке X-Next-Cursor (его нет на последней странице) и действует только
+    с теми же category, sort и order. skip оставлен для совместимости и с cursor
+    не используется. Каждое сочетание фильтра и сортировки читается своим индексом
+    (см. migrate_feed_indexes). Готовые страницы кэшируются до изменения доски (feed_cache.py);
+    на запрос с If-None-Match, совпадающим с ETag, возвращается 304.
+    """
+    key = ("posts", str(request.base_url), skip, limit, cursor, category, sort, order, include_deleted)
+    return cached_json_response(
+        request,
+        key,
+        lambda: feed_etag(db),
+        lambda: build_posts_page(db, request, skip, limit, cursor, category, sort, order, include_deleted)
+    )
+
+
+@router.get("/{post_id}", response_model=PostResponse, response_class=FastJSONResponse)
+def get_post(post_id: int, request: Request, db: Session = Depends(get_db)):
+    """Получить пост по ID (ответ кэшируется до изменения доски, с ETag)"""
+    key = ("post", str(request.base_url), post_id)
+    return cached_json_response(
+        request,
+        key,
+        lambda: post_etag(db, post_id),
+        lambda: build_post(db, request, post_id)
+    )
+
+
+@router.post("", response_model=PostResponse, status_code=status.HTTP_201_CREATED)
+async def create_post(
+    request: Request,
+    text: Optional[str] = Form(None),
+    files: List[UploadFile] = File(default=[]),  # Теперь принимаем список файлов
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Создать новый пост с возможностью загрузки одного или нескольких файлов"""
+    
+    # Проверяем, что есть либо текст, либо файлы
+    if not text and (not files or len(files) == 0):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Необходимо указать текст поста или загрузить хотя бы один файл"
+        )
+    
+    # Проверяем, что файл действительно передан
+    uploaded_files = [file for file in files if file and file.filename]
+    
+    # Файлы копируются на диск параллельно (число одновременных записей ограничено),
+    # поэтому время загрузки альбома определяется самым большим файлом, а не суммой
+    results = await asyncio.gather(
+        *(stage_uploaded_file(file) for file in uploaded_files),
+        return_exceptions=True
+    )
+    staged_paths = [result[0] for result in results if isinstance(result, tuple)]
+    
+    try:
+        failed_files = []
+        for order, (file, result) in enumerate(zip(uploaded_files, results)):
+            if isinstance(result, HTTPException):
+                failed_files.append({"order": order, "file_name": file.filename, "error": result.detail})
+            elif isinstance(result, BaseException):
+                print(f"Ошибка при сохранении файла {file.filename}: {result}")
+                failed_files.append({"order": order, "file_name": file.filename, "error": "Ошибка при сохранении файла"})
+        
+        # Пост создаётся только если сохранились все файлы
+        if failed_files:
+            all_client_errors = all(isinstance(result, HTTPException) for result in results if isinstance(result, BaseException))
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST if all_client_errors else status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"message": "Не удалось сохранить файлы", "files": failed_files}
+            )
+        
+        # Теги аудио файлов читаются один раз, из временных файлов, тоже параллельно
+        audio_metadata = await asyncio.gather(*(
+            probe_audio_metadata(temp_path, file.content_type)
+            for file, (temp_path, _, _) in zip(uploaded_files, results)
+        ))
+        
+        new_post = Post(
+            text=text if text and text.strip() else None,  # Сохраняем None вместо пустой строки
+            user_id=current_user.id,
+            file_count=len(uploaded_files)
+        )
+        
+        db.add(new_post)
+        db.flush()  # Получаем ID поста
+        
+        # Записи в БД создаются по порядку файлов в запросе
+        for order, (file, (temp_path, file_size, content_hash), metadata) in enumerate(zip(uploaded_files, results, audio_metadata)):
+            file_type = file.content_type or "application/octet-stream"
+            blob = store_staged_file(db, temp_path, file_size, content_hash, file_type, file.filename)
+            
+            # Создаём запись о файле
+            post_file = PostFile(
+                post_id=new_post.id,
+                file_path=blob.file_path,
+                file_type=file_type,
+                file_name=file.filename,
+                file_size=blob.file_size,
+                content_hash=blob.content_hash,
+                blob_id=blob.id,
+                order=order
+            )
+            if is_audio(file_type):
+                set_audio_metadata(post_file, metadata)
+            db.add(post_file)
+            
+            # Для обратной совместимости сохраняем первый файл в старые поля
+            if order == 0:
+                new_post.file_path = blob.file_path
+                new_post.file_type = file_type
+                new_post.file_name = file.filename
+                new_post.category = get_post_category(file_type)
+    finally:
+        # Временные файлы, не перенесённые в хранилище (ошибка или дубликат)
+        for temp_path in staged_paths:
+            temp_path.unlink(missing_ok=True)
+    
+    mark_board_changed(db)
+    db.commit()
+    db.refresh(new_post)
+    
+    if uploaded_files:
+        request_previews()
+    
+    # Загружаем пользователя и файлы для отображения
+    db.refresh(new_post, ['user', 'files'])
+    
+    # Добавляем file_url для отображения в Swagger
+    return add_file_url_to_post(new_post, request)
+
+
+@router.put("/{post_id}", response_model=PostResponse)
+async def update_post(
+    post_id: int,
+    request: Request,
+    text: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Обновить пост (можно обновить текст и/или файл)"""
+    post = db.query(Post).options(joinedload(Post.user), joinedload(Post.files)).filter(Post.id == post_id).first()
+    
+    if not post:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пост не найден"
+        )
+    
+    if post.is_deleted:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Нельзя обновить удалённый пост"
+        )
+    
+    # Обновляем текст, если передан
+    if text is not None:
+        post.text = text
+    
+    # Обновляем файл, если загружен новый
+    if file:
+        # Сохраняем новый файл до освобождения старых: если содержимое то же, blob сохранится
+        blob, file_type, file_name = await save_uploaded_file(file, db)
+        
+        # Помечаем к удалению старый файл старого формата (без записи в PostFile), если он был
+        if post.file_path and not any(f.file_path == post.file_path for f in post.files):
+            schedule_file_deletion(db, post.file_path)
+        
+        # Освобождаем и удаляем все старые файлы из PostFile
+        for old_file in post.files:
+            release_post_file(db, old_file)
+        db.query(PostFile).filter(PostFile.post_id == post_id).delete()
+        
+        # Создаём новую запись о файле
+        post_file = PostFile(
+            post_id=post.id,
+            file_path=blob.file_path,
+            file_type=file_type,
+            file_name=file_name,
+            file_size=blob.file_size,
+            content_hash=blob.content_hash,
+            blob_id=blob.id,
+            order=0
+        )
+        if is_audio(file_type):
+            set_audio_metadata(post_file, await probe_audio_metadata(blob.file_path, file_type))
+        db.add(post_file)
+        
+        # Для обратной совместимости сохраняем в старые поля
+        post.file_path = blob.file_path
+        post.file_type = file_type
+        post.file_name = file_name
+        post.category = get_post_category(file_type)
+        post.file_count = 1
+    
+    # Файлы поста могли смениться без изменения полей самого поста (тот же blob)
+    touch_posts(db, [post.id])
+    db.commit()
+    
+    if file:
+        request_previews()
+        request_reclaim()
+    
+    db.refresh(post, ['user', 'files'])
+    
+    # Добавляем file_url для отображения в Swagger
+    return add_file_url_to_post(post, request)
+
+
+@router.delete("/{post_id}", response_model=PostResponse)
+def delete_post(
+    post_id: int,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Удалить пост (soft delete) - только свой пост"""
+    post = db.query(Post).options(joinedload(Post.user), joinedload(Post.files)).filter(Post.id == post_id).first()
+    
+    if not post:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пост не найден"
+        )
+    
+    # Проверяем, что пользователь может удалять только свои посты
+    if post.user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Вы можете удалять только свои посты"
+        )
+    
+    if post.is_deleted:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Пост уже удалён"
+        )
+    
+    # Файлы не удаляются в запросе: они помечаются к удалению в этой же транзакции,
+    # а с диска их удаляет фоновая задача после коммита
+    # Файл старого формата (без записи в PostFile)
+    if post.file_path and not any(f.file_path == post.file_path for f in post.files):
+        schedule_file_deletion(db, post.file_path)
+    
+    # Освобождаем все файлы из PostFile: общий файл удаляется только с последней ссылкой
+    for post_file in post.files:
+        release_post_file(db, post_file)
+    
+    post.is_deleted = True
+    post.file_path = None
+    post.file_type = None
+    post.file_name = None
+    mark_board_changed(db)
+    db.commit()
+    request_reclaim()
+    db.refresh(post, ['user', 'files'])
+    
+    # Добавляем file_url (будет None, так как файл удалён)
+    return add_file_url_to_post(post, request)
+
+def check_votable(post, deleted_detail: str) -> None:
+    """Проверяет, что пост есть и не удалён"""
+    if not post:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пост не найден"
+        )
+    if post.is_deleted:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=deleted_detail
+        )
+
+
+def vote_post(db: Session, post_id: int, user: User, value: int, deleted_detail: str) -> dict:
+    """
+    Голос пользователя за пост (см. votes.py); повторный такой же голос ничего не меняет
+    Возвращает: ответ в формате VoteResponse (кодируется orjson без проверки по схеме)
+    """
+    if vote_buffer.enabled:
+        # Голос записывается пачкой в фоне; здесь только чтение поста и голоса пользователя
+        post = db.query(Post.upvotes, Post.is_deleted, Vote.value.label("vote")).outerjoin(
+            Vote, and_(Vote.post_id == Post.id, Vote.user_id == user.id)
+        ).filter(Post.id == post_id).first()
+        check_votable(post, deleted_detail)
+        upvotes, flush_now = vote_buffer.vote(user.id, post_id, value, post.vote, post.upvotes)
+        if flush_now:
+            request_vote_flush()
+        return {"post_id": post_id, "upvotes": upvotes, "vote": value}
+    
+    upvotes = cast_vote(db, user.id, post_id, value)
+    
+    if upvotes is None:
+        # Голос не изменился, либо поста нет или он удалён
+        post = db.query(Post.upvotes, Post.is_deleted).filter(Post.id == post_id).first()
+        check_votable(post, deleted_detail)
+        upvotes = post.upvotes
+    else:
+        mark_board_changed(db)
+        db.commit()
+    
+    return {"post_id": post_id, "upvotes": upvotes, "vote": value}
+
+
+@router.post("/{post_id}/upvote", response_model=VoteResponse, response_class=FastJSONResponse)
+def upvote_post(
+    post_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Апвоут поста: один голос от пользователя, даунвоут меняется на апвоут"""
+    return FastJSONResponse(content=vote_post(db, post_id, current_user, 1, "Нельзя апвоутить удалённый пост"))
+
+
+@router.post("/{post_id}/downvote", response_model=VoteResponse, response_class=FastJSONResponse)
+def downvote_post(
+    post_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Даунвоут поста: один голос от пользователя, апвоут меняется на даунвоут"""
+    return FastJSONResponse(content=vote_post(db, post_id, current_user, -1, "Нельзя даунвоутить удалённый пост"))
+
+
+@router.get(
+    "/{post_id}/file",
+    responses={
+        200: {
+            "content": {
+                "image/jpeg": {},
+                "image/png": {},
+                "image/gif": {},
+                "image/webp": {},
+                "video/mp4": {},
+                "video/webm": {},
+                "video/ogg": {},
+                "video/quicktime": {},
+                "audio/mpeg": {},
+                "audio/ogg": {},
+                "audio/wav": {},
+                "audio/webm": {},
+                "audio/flac": {},
+                "audio/x-flac": {},
+            },
+            "description": "Файл поста. Swagger UI автоматически отобразит изображения и видео. Примечание: FLAC может не воспроизводиться в некоторых браузерах из-за ограничений поддержки формата."
+        }
+    }
+)
+def get_post_file(
+    post_id: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """
+    Получить файл поста
+    
+    **Для просмотра в Swagger UI:**
+    - Изображения (JPEG, PNG, GIF, WebP) будут отображены автоматически
+    - Видео (MP4, WebM, OGG, MOV) можно воспроизвести прямо в Swagger UI
+    - Аудио файлы (MP3, OGG, WAV, WebM) можно воспроизвести в Swagger UI
+    - FLAC файлы могут не воспроизводиться в некоторых браузерах (Chrome, Firefox не поддерживают FLAC в HTML5 audio)
+      В этом случае файл можно скачать и воспроизвести во внешнем плеере
+    - Или используйте file_url из ответа GET /posts/{id} для прямого доступа
+    """
+    post = db.query(Post).options(joinedload(Post.files)).filter(Post.id == post_id).first()
+    
+    if not post:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пост не найден"
+        )
+    
+    # Сначала проверяем новые файлы (из post_files)
+    post_file = None
+    if post.files and len(post.files) > 0:
+        # Используем первый файл из списка
+        post_file = post.files[0]
+        file_path = get_file_path(post_file.file_path)
+        media_type = post_file.file_type or "application/octet-stream"
+        filename = post_file.file_name or "file"
+    # Если новых файлов нет, используем старые поля (обратная совместимость)
+    elif post.file_path:
+        file_path = get_file_path(post.file_path)
+        media_type = post.file_type or "application/octet-stream"
+        filename = post.file_name or "file"
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="У поста нет файла"
+        )
+    
+    if not file_path or not file_path.exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Файл не найден на сервере"
+        )
+    
+    # Первый файл поста может смениться при обновлении, поэтому кэш ревалидируется
+    return media_file_response(file_path, media_type, filename, request.headers, immutable=False)
+
+
+@router.get("/{post_id}/files/{file_id}")
+def get_post_file_by_id(
+    post_id: int,
+    file_id: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """
+    Получить конкретный файл поста по ID файла
+    
+    Поддерживает любые типы файлов:
+    - Изображения, видео, аудио - отображаются/воспроизводятся в браузере
+    - Остальные файлы - скачиваются
+    """
+    post_file = db.query(PostFile).filter(
+        PostFile.id == file_id,
+        PostFile.post_id == post_id
+    ).first()
+    
+    if not post_file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Файл не найден"
+        )
+    
+    file_path = get_file_path(post_file.file_path)
+    if not file_path or not file_path.exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Файл не найден на сервере"
+        )
+    
+    media_type = post_file.file_type or "application/octet-stream"
+    filename = post_file.file_name or "file"
+    
+    # Если известен хэш содержимого, он служит строгим ETag
+    etag = f'"{post_file.content_hash}"' if post_file.content_hash else None
+    
+    return media_file_response(file_path, media_type, filename, request.headers, etag=etag)
+
+
+@router.get("/{post_id}/files/{file_id}/preview/{width}")
+def get_post_file_preview(
+    post_id: int,
+    file_id: int,
+    width: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Получить уменьшенную копию изображения или обложки аудио файла заданной ширины"""
+    post_file = db.query(PostFile).filter(
+        PostFile.id == file_id,
+        PostFile.post_id == post_id
+    ).first()
+    
+    if not post_file or width not in parse_preview_widths(post_file.preview_widths):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Уменьшенная копия не найдена"
+        )
+    
+    preview_path = get_preview_path(post_file.file_path, width, post_file.preview_format)
+    if not preview_path.exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Файл не найден на сервере"
+        )
+    
+    media_type = PREVIEW_MEDIA_TYPES.get(post_file.preview_format, "application/octet-stream")
+    filename = f"{Path(post_file.file_name).stem}.w{width}.{post_file.preview_format}"
+    etag = f'"{post_file.content_hash}-w{width}"' if post_file.content_hash else None
+    
+    return media_file_response(preview_path, media_type, filename, request.headers, etag=etag)
@@ -0,0 +1,75 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
+from sqlalchemy.orm import Session, joinedload
+from typing import List, Optional
+from database import engine, get_db
+from models import Comment, Post
+from schemas import SearchResult
+from pagination import decode_cursor, encode_cursor, next_cursor_headers
+from json_utils import FastJSONResponse
+from fulltext import search_board
+from .posts import get_posts_url, serialize_post
+from .comments import serialize_comment
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+
+@router.get("", response_model=List[SearchResult], response_class=FastJSONResponse)
+def search(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200, description='Запрос: слова, "фраза", -исключение, OR'),
+    limit: int = Query(20, ge=1, le=50),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы из заголовка X-Next-Cursor"),
+    db: Session = Depends(get_db)
+):
+    """
+    Полнотекстовый поиск по постам (текст, имена файлов, теги аудио) и комментариям
+
+    Результаты упорядочены по релевантности; курсор следующей страницы возвращается
+    в заголовке X-Next-Cursor. Найденный комментарий возвращается вместе с постом.
+    Удалённые посты и комментарии не ищутся. Работает только с PostgreSQL (fulltext.py).
+    """
+    if engine.dialect.name != "postgresql":
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="Поиск доступен только с PostgreSQL"
+        )
+    
+    after = decode_cursor(cursor, float, str, int) if cursor else None
+    
+    # Одна лишняя запись показывает, есть ли следующая страница
+    rows = search_board(db, q, limit + 1, after)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].rank, rows[-1].kind, rows[-1].id)
+    
+    # Посты и комментарии страницы - двумя запросами
+    post_ids = {row.post_id for row in rows}
+    comment_ids = [row.id for row in rows if row.kind == "comment"]
+    posts = {}
+    if post_ids:
+        posts = {post.id: post for post in db.query(Post).options(
+            joinedload(Post.user), joinedload(Post.files)
+        ).filter(Post.id.in_(post_ids)).all()}
+    comments = {}
+    if comment_ids:
+        comments = {comment.id: comment for comment in db.query(Comment).options(
+            joinedload(Comment.user)
+        ).filter(Comment.id.in_(comment_ids)).all()}
+    
+    posts_url = get_posts_url(request)
+    results = []
+    for row in rows:
+        post = posts.get(row.post_id)
+        comment = comments.get(row.id) if row.kind == "comment" else None
+        # Запись могли удалить после поиска
+        if post is None or (row.kind == "comment" and comment is None):
+            continue
+        results.append({
+            "kind": row.kind,
+            "rank": row.rank,
+            "post": serialize_post(post, posts_url),
+            "comment": serialize_comment(comment) if comment is not None else None,
+        })
+    
+    return FastJSONResponse(content=results, headers=next_cursor_headers(next_cursor))
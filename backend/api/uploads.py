@@ -0,0 +1,476 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response, Header
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from starlette.requests import ClientDisconnect
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+import fcntl
+import os
+import uuid
+from database import get_db
+from models import Post, PostFile, User, UploadSession
+from schemas import PostResponse, UploadCreate, UploadResponse, UploadFinalize, UploadFinalizeBatch
+from dependencies import get_current_user
+from file_utils import (
+    MAX_FILE_SIZE,
+    UPLOAD_CHUNK_SIZE,
+    file_too_large_error,
+    get_file_path,
+    get_post_category,
+    get_upload_temp_path,
+    hash_file,
+    link_staged_file,
+)
+from audio_utils import is_audio, probe_audio_metadata, set_audio_metadata
+from feed_cache import touch_posts
+from tasks import request_previews
+from .posts import add_file_url_to_post
+
+router = APIRouter(prefix="/uploads", tags=["uploads"])
+
+# Время жизни незавершённой загрузки (часы): продлевается при каждой полученной части
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+
+
+def session_expiry() -> datetime:
+    """Момент, после которого незавершённая сессия загрузки удаляется"""
+    return datetime.now(timezone.utc) + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+
+
+def offset_headers(upload: UploadSession) -> dict:
+    """Заголовки с текущим состоянием загрузки (как в протоколе tus)"""
+    return {
+        "Upload-Offset": str(upload.offset),
+        "Upload-Length": str(upload.total_size),
+        "Cache-Control": "no-store",
+    }
+
+
+def get_user_upload(db: Session, upload_id: str, user: User, lock: bool = False) -> UploadSession:
+    """Возвращает сессию загрузки текущего пользователя"""
+    query = db.query(UploadSession).filter(
+        UploadSession.id == upload_id,
+        UploadSession.user_id == user.id
+    )
+    if lock:
+        query = query.with_for_update()
+    upload = query.first()
+
+    if not upload:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Сессия загрузки не найдена"
+        )
+
+    return upload
+
+
+def lock_upload_file(temp_path: Path) -> BinaryIO:
+    """
+    Открывает временный файл загрузки с эксклюзивной блокировкой (flock)
+    Части одной загрузки пишутся по очереди; блокировка снимается при закрытии файла.
+    """
+    f = os.fdopen(os.open(temp_path, os.O_RDWR | os.O_CREAT), "r+b")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Часть файла уже загружается другим запросом"
+        )
+    return f
+
+
+def seek_to_offset(f: BinaryIO, offset: int) -> None:
+    """Готовит файл к дозаписи, отбрасывая байты после подтверждённого смещения"""
+    if os.fstat(f.fileno()).st_size < offset:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Данные сессии загрузки не найдены"
+        )
+    f.truncate(offset)
+    f.seek(offset)
+
+
+def adopt_legacy_file(db: Session, post: Post) -> Optional[PostFile]:
+    """
+    Переносит файл поста старого формата (только в старых полях) в PostFile с order 0
+    Нужно перед добавлением файлов: иначе новый файл занял бы старые поля, а прежний
+    остался бы на диске без ссылок. Метаданные аудио извлекаются при первом запросе.
+    """
+    if not post.file_path:
+        return None
+
+    legacy_path = get_file_path(post.file_path)
+    post_file = PostFile(
+        post_id=post.id,
+        file_path=post.file_path,
+        file_type=post.file_type or "application/octet-stream",
+        file_name=post.file_name or legacy_path.name,
+        file_size=legacy_path.stat().st_size if legacy_path.exists() else None,
+        order=0
+    )
+    db.add(post_file)
+    return post_file
+
+
+@router.post("", response_model=UploadResponse, status_code=status.HTTP_201_CREATED)
+def create_upload(
+    upload_data: UploadCreate,
+    response: Response,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Создать сессию возобновляемой загрузки файла"""
+    if upload_data.total_size > MAX_FILE_SIZE:
+        raise file_too_large_error()
+
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=current_user.id,
+        file_name=upload_data.file_name,
+        file_type=upload_data.file_type or "application/octet-stream",
+        total_size=upload_data.total_size,
+        offset=0,
+        expires_at=session_expiry()
+    )
+
+    db.add(upload)
+    db.commit()
+    db.refresh(upload)
+
+    get_upload_temp_path(upload.id).touch()
+
+    response.headers["Location"] = f"/uploads/{upload.id}"
+    response.headers.update(offset_headers(upload))
+    return upload
+
+
+@router.api_route("/{upload_id}", methods=["GET", "HEAD"], response_model=UploadResponse)
+def get_upload(
+    upload_id: str,
+    response: Response,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Получить текущее смещение загрузки (с какого байта продолжать)"""
+    upload = get_user_upload(db, upload_id, current_user)
+    response.headers.update(offset_headers(upload))
+    return upload
+
+
+@router.put("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset", ge=0),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Загрузить часть файла, начиная со смещения Upload-Offset
+
+    Тело запроса - сырые байты файла. Если соединение оборвётся, принятые байты
+    сохраняются, и клиент продолжает с нового смещения (GET/HEAD /uploads/{id}).
+
+    Пока читается тело, транзакция закрыта и соединение с БД возвращено в пул:
+    параллельные запросы к одной загрузке разделяет блокировка временного файла,
+    а новое смещение записывается условным UPDATE.
+    """
+    upload = get_user_upload(db, upload_id, current_user)
+    db.expunge(upload)
+    db.rollback()
+
+    out = await run_in_threadpool(lock_upload_file, get_upload_temp_path(upload.id))
+    try:
+        # Смещение перечитывается под блокировкой: его мог сдвинуть предыдущий запрос
+        upload.offset = db.query(UploadSession.offset).filter(UploadSession.id == upload.id).scalar()
+        db.rollback()
+        if upload.offset is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Сессия загрузки не найдена"
+            )
+
+        if upload_offset != upload.offset:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Смещение не совпадает с уже полученными данными",
+                headers=offset_headers(upload)
+            )
+
+        await run_in_threadpool(seek_to_offset, out, upload.offset)
+        received = 0
+        buffer = bytearray()
+        try:
+            async for chunk in request.stream():
+                if upload.offset + received + len(buffer) + len(chunk) > upload.total_size:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Данные выходят за пределы заявленного размера файла"
+                    )
+                buffer += chunk
+                # Пишем на диск блоками, а не каждым мелким фрагментом тела запроса
+                if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                    await run_in_threadpool(out.write, buffer)
+                    received += len(buffer)
+                    buffer = bytearray()
+        except ClientDisconnect:
+            # Клиент повторит запрос с нового смещения - сохраняем то, что успели принять
+            pass
+
+        if buffer:
+            await run_in_threadpool(out.write, buffer)
+            received += len(buffer)
+
+        # Смещение записывается до снятия блокировки файла; сессию могли отменить
+        # или завершить, пока читалось тело
+        updated = db.query(UploadSession).filter(
+            UploadSession.id == upload.id,
+            UploadSession.offset == upload.offset
+        ).update({
+            UploadSession.offset: upload.offset + received,
+            UploadSession.expires_at: session_expiry()
+        }, synchronize_session=False)
+        db.commit()
+    finally:
+        await run_in_threadpool(out.close)
+
+    if not updated:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Сессия загрузки изменилась во время записи"
+        )
+
+    upload.offset += received
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=offset_headers(upload))
+
+
+@router.delete("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+def cancel_upload(
+    upload_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Отменить загрузку и удалить полученные данные"""
+    upload = get_user_upload(db, upload_id, current_user, lock=True)
+
+    get_upload_temp_path(upload.id).unlink(missing_ok=True)
+    db.delete(upload)
+    db.commit()
+
+    return None
+
+
+def get_user_uploads(db: Session, upload_ids: List[str], user: User, lock: bool = False) -> List[UploadSession]:
+    """Полностью загруженные сессии текущего пользователя, в порядке upload_ids"""
+    if len(set(upload_ids)) != len(upload_ids):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Загрузка указана несколько раз"
+        )
+
+    query = db.query(UploadSession).filter(
+        UploadSession.id.in_(upload_ids),
+        UploadSession.user_id == user.id
+    ).order_by(UploadSession.id)
+    if lock:
+        query = query.with_for_update()
+    uploads_by_id = {upload.id: upload for upload in query.all()}
+
+    for upload_id in upload_ids:
+        upload = uploads_by_id.get(upload_id)
+        if not upload:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Сессия загрузки не найдена"
+            )
+
+        if upload.offset != upload.total_size:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Файл загружен не полностью",
+                headers=offset_headers(upload)
+            )
+
+    return [uploads_by_id[upload_id] for upload_id in upload_ids]
+
+
+async def prepare_uploads(
+    db: Session,
+    upload_ids: List[str],
+    user: User
+) -> Dict[str, Tuple[int, str, Optional[dict]]]:
+    """
+    Размер, SHA-256 и метаданные аудио собранных файлов: {upload_id: (размер, хэш, метаданные)}
+    Медленная работа с файлами идёт без блокировок и без соединения с БД. Полностью
+    загруженный файл уже не меняется: запрос части с его концевого смещения ничего не пишет.
+    """
+    uploads = [(upload.id, upload.file_type) for upload in get_user_uploads(db, upload_ids, user)]
+    db.rollback()
+
+    prepared = {}
+    for upload_id, file_type in uploads:
+        temp_path = get_upload_temp_path(upload_id)
+        try:
+            file_size, content_hash = await run_in_threadpool(hash_file, temp_path)
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Данные сессии загрузки не найдены"
+            )
+        # Теги читаются из собранного временного файла до его переноса в хранилище
+        prepared[upload_id] = (file_size, content_hash, await probe_audio_metadata(temp_path, file_type))
+    return prepared
+
+
+def get_finalize_post(db: Session, finalize_data: UploadFinalize, user: User) -> Post:
+    """Пост, к которому прикрепляются файлы: существующий (заблокированный) или новый"""
+    if finalize_data.post_id is None:
+        text = finalize_data.text
+        post = Post(
+            text=text if text and text.strip() else None,
+            user_id=user.id
+        )
+        db.add(post)
+        db.flush()
+        return post
+
+    post = db.query(Post).filter(Post.id == finalize_data.post_id).with_for_update().first()
+
+    if not post:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пост не найден"
+        )
+
+    if post.user_id != user.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Вы можете добавлять файлы только к своим постам"
+        )
+
+    if post.is_deleted:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Нельзя обновить удалённый пост"
+        )
+
+    return post
+
+
+def attach_uploads(
+    db: Session,
+    post: Post,
+    uploads: List[UploadSession],
+    prepared: Dict[str, Tuple[int, str, Optional[dict]]],
+    written_paths: List[str]
+) -> None:
+    """
+    Добавляет собранные файлы в хранилище и в конец поста по порядку
+    Пути файлов, записанных в хранилище, добавляются в written_paths (удаляются при откате).
+    """
+    added_files = len(uploads)
+    last_order = db.query(func.max(PostFile.order)).filter(PostFile.post_id == post.id).scalar()
+    if last_order is None and adopt_legacy_file(db, post):
+        added_files += 1
+        last_order = 0
+    order = 0 if last_order is None else last_order + 1
+
+    for upload in uploads:
+        file_size, content_hash, metadata = prepared[upload.id]
+        # Дубликат не записывается повторно; временный файл остаётся до коммита
+        blob, written_path = link_staged_file(
+            db, get_upload_temp_path(upload.id), file_size, content_hash, upload.file_type, upload.file_name
+        )
+        if written_path:
+            written_paths.append(written_path)
+
+        post_file = PostFile(
+            post_id=post.id,
+            file_path=blob.file_path,
+            file_type=upload.file_type,
+            file_name=upload.file_name,
+            file_size=blob.file_size,
+            content_hash=blob.content_hash,
+            blob_id=blob.id,
+            order=order
+        )
+        if is_audio(upload.file_type):
+            set_audio_metadata(post_file, metadata)
+        db.add(post_file)
+
+        # Для обратной совместимости сохраняем первый файл в старые поля
+        if order == 0:
+            post.file_path = blob.file_path
+            post.file_type = upload.file_type
+            post.file_name = upload.file_name
+            post.category = get_post_category(upload.file_type)
+
+        db.delete(upload)
+        order += 1
+
+    # Существующий пост заблокирован (with_for_update); счётчик меняется в SQL
+    post.file_count = Post.file_count + added_files
+
+
+async def finalize_uploads(
+    db: Session,
+    upload_ids: List[str],
+    finalize_data: UploadFinalize,
+    user: User,
+    request: Request
+) -> dict:
+    """
+    Прикрепляет загрузки к посту одной транзакцией: пост появляется сразу со всеми файлами
+    Хэши и метаданные считаются до блокировок, поэтому сессии и пост заблокированы только
+    на время записи в БД. Если транзакция не удалась, сессии и их временные файлы остаются:
+    завершение можно повторить.
+    """
+    prepared = await prepare_uploads(db, upload_ids, user)
+
+    written_paths = []
+    try:
+        uploads = get_user_uploads(db, upload_ids, user, lock=True)
+        post = get_finalize_post(db, finalize_data, user)
+        attach_uploads(db, post, uploads, prepared, written_paths)
+        touch_posts(db, [post.id])
+        db.commit()
+    except BaseException:
+        db.rollback()
+        for written_path in written_paths:
+            Path(written_path).unlink(missing_ok=True)
+        raise
+
+    for upload_id in upload_ids:
+        get_upload_temp_path(upload_id).unlink(missing_ok=True)
+    request_previews()
+    db.refresh(post, ['user', 'files'])
+
+    return add_file_url_to_post(post, request)
+
+
+@router.post("/finalize", response_model=PostResponse)
+async def finalize_upload_batch(
+    finalize_data: UploadFinalizeBatch,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Завершить несколько загрузок: файлы прикрепляются к посту (или новому посту) в порядке upload_ids"""
+    return await finalize_uploads(db, finalize_data.upload_ids, finalize_data, current_user, request)
+
+
+@router.post("/{upload_id}/finalize", response_model=PostResponse)
+async def finalize_upload(
+    upload_id: str,
+    finalize_data: UploadFinalize,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Завершить загрузку: прикрепить файл к существующему посту или создать новый пост"""
+    return await finalize_uploads(db, [upload_id], finalize_data, current_user, request)
@@ -1,10 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from typing import List
 from database import get_db
-from models import User
+from models import Comment, Post, User
 from schemas import UserResponse, UserUpdate
 from dependencies import get_current_user, get_current_admin_user
+from feed_cache import mark_board_changed
 
 router = APIRouter(prefix="/users", tags=["users"])
 
@@ -77,8 +79,14 @@ def update_user(
             detail="Только администратор может изменять статус администратора"
         )
     
-    if user_data.nick is not None:
+    if user_data.nick is not None and user_data.nick != user.nick:
         user.nick = user_data.nick
+        # Ник автора есть в ответах постов и комментариев
+        for model in (Post, Comment):
+            db.query(model).filter(model.user_id == user.id).update(
+                {model.updated_at: func.now()}, synchronize_session=False
+            )
+        mark_board_changed(db)
     if user_data.is_admin is not None:
         user.is_admin = user_data.is_admin
     
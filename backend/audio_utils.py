@@ -0,0 +1,206 @@
+"""
+Метаданные и обложки аудио файлов: разбор в пуле процессов и хранилище извлечённых обложек
+"""
+from fastapi.concurrency import run_in_threadpool
+from pathlib import Path
+from typing import Optional
+import hashlib
+import os
+import time
+import uuid
+from models import AudioMetadata, PostFile
+from file_utils import UPLOAD_DIR, get_shard_dir
+from media_cache import audio_cache
+from media_pool import run_media_job, run_media_job_async
+from media_probe import parse_audio_file, read_audio_cover
+
+# Максимальная длина тега в таблице audio_metadata
+AUDIO_TAG_MAX_LENGTH = 500
+
+# Хранилище обложек, извлечённых из аудио файлов (адресуется по SHA-256 обложки)
+COVER_DIR = UPLOAD_DIR / "covers"
+COVER_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+}
+
+# Сколько секунд после сохранения или повторного использования обложка не удаляется
+# фоновой задачей: ссылка на неё из audio_metadata может быть ещё не закоммичена
+COVER_MIN_AGE = 3600
+
+
+def is_audio(file_type: Optional[str]) -> bool:
+    """Является ли файл аудио (по MIME type)"""
+    return bool(file_type) and file_type.startswith('audio/')
+
+
+def extract_audio_cover(file_path: Path, file_type: str) -> Optional[bytes]:
+    """Извлекает встроенную обложку из аудио файла (в пуле процессов разбора)"""
+    try:
+        return run_media_job(read_audio_cover, str(file_path), file_type)
+    except Exception as e:
+        print(f"Ошибка извлечения обложки: {e}")
+        return None
+
+
+def get_cover_type(cover_data: bytes) -> str:
+    """MIME type обложки по сигнатуре (по умолчанию JPEG)"""
+    if cover_data[:4] == b'\x89PNG':
+        return 'image/png'
+    if cover_data[:4] == b'RIFF' and cover_data[8:12] == b'WEBP':
+        return 'image/webp'
+    if cover_data[:3] == b'GIF':
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def save_cover(cover_data: bytes) -> dict:
+    """
+    Сохраняет обложку в хранилище обложек: uploads/covers/ab/cd/<sha256>.jpg
+    Одинаковые обложки (треки одного альбома) хранятся один раз.
+    Возвращает: поля cover_hash, cover_path и cover_type для audio_metadata
+    """
+    cover_hash = hashlib.sha256(cover_data).hexdigest()
+    cover_type = get_cover_type(cover_data)
+    filename = f"{cover_hash}{COVER_EXTENSIONS[cover_type]}"
+    cover_dir = get_shard_dir(COVER_DIR, filename)
+    cover_path = cover_dir / filename
+    
+    try:
+        # Обложка уже есть: обновляем mtime, чтобы её не удалила фоновая задача
+        # (см. is_cover_recently_used), пока новая ссылка на неё не закоммичена
+        os.utime(cover_path)
+    except FileNotFoundError:
+        cover_dir.mkdir(parents=True, exist_ok=True)
+        # Запись через временный файл, чтобы не отдать недописанную обложку
+        temp_path = cover_path.with_name(f"{filename}.{uuid.uuid4().hex}.part")
+        try:
+            temp_path.write_bytes(cover_data)
+            os.replace(temp_path, cover_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+    
+    return {"cover_hash": cover_hash, "cover_path": str(cover_path), "cover_type": cover_type}
+
+
+def is_cover_recently_used(file_path: str) -> bool:
+    """Файл - обложка, которую save_cover сохранил или использовал повторно меньше COVER_MIN_AGE назад"""
+    path = Path(file_path)
+    if COVER_DIR.resolve() not in path.resolve().parents:
+        return False
+    try:
+        return time.time() - path.stat().st_mtime < COVER_MIN_AGE
+    except FileNotFoundError:
+        return False
+
+
+def build_audio_metadata(parsed: Optional[dict], store_cover: bool = True) -> Optional[dict]:
+    """
+    Поля таблицы audio_metadata по результату parse_audio_file
+    Обложка сохраняется в хранилище обложек (save_cover), в результат попадает только
+    её хэш и путь; при store_cover=False - только признак has_cover.
+    """
+    if parsed is None:
+        return None
+    
+    cover = parsed.pop('cover', None)
+    metadata = {
+        key: (value[:AUDIO_TAG_MAX_LENGTH] or None) if isinstance(value, str) else value
+        for key, value in parsed.items()
+    }
+    metadata['has_cover'] = bool(cover)
+    if cover and store_cover:
+        try:
+            metadata.update(save_cover(cover))
+        except OSError as e:
+            # Обложка будет сохранена при первом запросе (см. api/metadata.py)
+            print(f"Ошибка сохранения обложки: {e}")
+    return metadata
+
+
+def read_audio_metadata(
+    file_path: Path,
+    file_type: str,
+    store_cover: bool = True,
+    raise_errors: bool = False
+) -> Optional[dict]:
+    """
+    Теги, длительность, битрейт и обложка для таблицы audio_metadata
+    Файл разбирается в пуле процессов (media_pool.py); вызывающий поток ждёт результата.
+    Возвращает None, если файл не распознан или его не удалось разобрать (в том числе
+    по таймауту); с raise_errors ошибки разбора пробрасываются, None - только не распознан.
+    """
+    try:
+        parsed = run_media_job(parse_audio_file, str(file_path), file_type, store_cover)
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"Ошибка извлечения метаданных: {e}")
+        return None
+    return build_audio_metadata(parsed, store_cover)
+
+
+def _metadata_size(metadata: Optional[dict]) -> int:
+    """Примерный объём метаданных в памяти"""
+    if not metadata:
+        return 64
+    return 256 + sum(len(value) for value in metadata.values() if isinstance(value, str))
+
+
+def cached_audio_metadata(file_path: Path, file_type: str) -> Optional[dict]:
+    """
+    read_audio_metadata для файлов, метаданные которых негде сохранить в БД
+    (посты старого формата): результат кэшируется в памяти процесса, обложка не сохраняется
+    """
+    return audio_cache.get_or_compute(
+        ("metadata", file_type),
+        file_path,
+        lambda: read_audio_metadata(file_path, file_type, store_cover=False),
+        _metadata_size
+    )
+
+
+def cached_audio_cover(file_path: Path, file_type: str) -> Optional[bytes]:
+    """extract_audio_cover с кэшем в памяти процесса (для постов старого формата)"""
+    return audio_cache.get_or_compute(
+        ("cover", file_type),
+        file_path,
+        lambda: extract_audio_cover(file_path, file_type),
+        lambda cover_data: 64 + len(cover_data or b"")
+    )
+
+
+async def probe_audio_metadata(file_path: Path, file_type: str) -> Optional[dict]:
+    """
+    read_audio_metadata без блокировки event loop: файл разбирается в пуле процессов,
+    обложка записывается на диск в пуле потоков. Для не аудио - None.
+    """
+    if not is_audio(file_type):
+        return None
+    try:
+        parsed = await run_media_job_async(parse_audio_file, str(file_path), file_type)
+    except Exception as e:
+        print(f"Ошибка извлечения метаданных: {e}")
+        return None
+    return await run_in_threadpool(build_audio_metadata, parsed)
+
+
+def new_audio_metadata(metadata: Optional[dict]) -> AudioMetadata:
+    """
+    Запись audio_metadata по результату read_audio_metadata
+    Для нераспознанного файла запись создаётся пустой, чтобы файл не разбирался повторно.
+    """
+    return AudioMetadata(**(metadata or {"has_cover": False}))
+
+
+def set_audio_metadata(post_file: PostFile, metadata: Optional[dict]) -> AudioMetadata:
+    """Создаёт или обновляет запись audio_metadata файла"""
+    if post_file.audio_metadata is None:
+        post_file.audio_metadata = new_audio_metadata(metadata)
+    else:
+        for key, value in (metadata or {"has_cover": False}).items():
+            setattr(post_file.audio_metadata, key, value)
+    return post_file.audio_metadata
@@ -0,0 +1,113 @@
+"""
+Микробенчмарк сериализации страницы ленты
+
+Сравнивает путь через response_model (словари -> проверка по PostResponse -> json.dumps,
+как FastAPI кодирует возвращённые словари) с прямым сериализатором serialize_post и orjson.
+Посты строятся в памяти, БД не нужна.
+
+Пример:
+    python bench_serialization.py --posts 100 --files 4 --repeat 200
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List
+from pydantic import TypeAdapter
+from models import Post, PostFile, User
+from schemas import PostResponse
+from json_utils import dumps
+from api.posts import serialize_post
+
+BASE_URL = "https://haiko.duckdns.org"
+
+
+def make_posts(count: int, files_per_post: int) -> List[Post]:
+    """Страница ленты: посты-альбомы с изображениями, у которых уже есть уменьшенные копии"""
+    user = User(id=1, login="bench", password="", nick="anon")
+    date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    posts = []
+    for post_id in range(1, count + 1):
+        post = Post(
+            id=post_id,
+            text=f"Пост {post_id} " * 8,
+            user_id=user.id,
+            file_path=f"uploads/image/ab/cd/{post_id:064x}.jpg",
+            file_type="image/jpeg",
+            file_name=f"photo_{post_id}.jpg",
+            category="image",
+            date=date + timedelta(minutes=post_id),
+            is_deleted=False,
+            upvotes=post_id % 17,
+            comment_count=post_id % 23,
+            file_count=files_per_post,
+        )
+        post.user = user
+        post.files = [
+            PostFile(
+                id=post_id * 100 + order,
+                post_id=post_id,
+                file_path=f"uploads/image/ab/cd/{post_id * 100 + order:064x}.jpg",
+                file_type="image/jpeg",
+                file_name=f"photo_{post_id}_{order}.jpg",
+                file_size=1_500_000 + order,
+                order=order,
+                preview_widths="320,640,1280",
+                preview_format="webp",
+            )
+            for order in range(files_per_post)
+        ]
+        posts.append(post)
+    return posts
+
+
+def response_model_page(posts: List[Post], adapter: TypeAdapter) -> bytes:
+    """Словари, проверка по List[PostResponse] и json.dumps (путь response_model)"""
+    content = [serialize_post(post, f"{BASE_URL}/posts") for post in posts]
+    validated = adapter.dump_python(adapter.validate_python(content), mode="json")
+    return json.dumps(validated, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def direct_page(posts: List[Post]) -> bytes:
+    """Прямой сериализатор с готовым префиксом ссылок и orjson"""
+    posts_url = f"{BASE_URL}/posts"
+    return dumps([serialize_post(post, posts_url) for post in posts])
+
+
+def measure(job: Callable[[], bytes], repeat: int) -> float:
+    """Медианное время одного вызова (секунды)"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        job()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение сериализации страницы ленты")
+    parser.add_argument("--posts", type=int, default=100, help="постов на странице")
+    parser.add_argument("--files", type=int, default=4, help="файлов в каждом посте (альбом)")
+    parser.add_argument("--repeat", type=int, default=200, help="повторов каждого варианта")
+    args = parser.parse_args()
+
+    posts = make_posts(args.posts, args.files)
+    adapter = TypeAdapter(List[PostResponse])
+
+    # Оба пути должны давать один и тот же JSON
+    if json.loads(response_model_page(posts, adapter)) != json.loads(direct_page(posts)):
+        raise SystemExit("⚠ Ответы сериализаторов различаются")
+
+    baseline = measure(lambda: response_model_page(posts, adapter), args.repeat)
+    direct = measure(lambda: direct_page(posts), args.repeat)
+    size = len(direct_page(posts))
+
+    print(f"Страница: {args.posts} постов по {args.files} файлов, {size / 1024:.0f} КБ JSON")
+    print(f"  response_model + json:  {baseline * 1000:8.2f} мс")
+    print(f"  serialize_post + orjson: {direct * 1000:8.2f} мс")
+    print(f"✓ Ускорение: {baseline / direct:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
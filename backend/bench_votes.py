@@ -0,0 +1,163 @@
+"""
+Проверка голосования под нагрузкой: сотни параллельных голосов за один пост
+
+Создаёт пост и --users пользователей; каждый голосует --repeat раз подряд (повторный
+голос не должен менять счётчик), каждый пятый в конце меняет апвоут на даунвоут.
+Пользователи голосуют параллельно в --workers потоках. После этого posts.upvotes
+сверяется с ожидаемой суммой и с суммой голосов в votes. С --legacy тот же поток
+апвоутов выполняется старым способом (чтение поста, upvotes += 1, коммит) и
+показывается, сколько обновлений потеряно. С --buffer голоса проходят через VoteBuffer
+(запись пачками раз в --interval мс) и показывается, сколько транзакций записи понадобилось.
+Нужен PostgreSQL (DATABASE_URL); тестовые записи удаляются.
+
+Пример:
+    python bench_votes.py --users 500 --workers 100
+    python bench_votes.py --users 500 --workers 100 --legacy
+    python bench_votes.py --users 500 --workers 100 --buffer --interval 200
+"""
+import argparse
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from sqlalchemy import and_, create_engine, func
+from sqlalchemy.orm import sessionmaker
+from database import DATABASE_URL
+from models import Post, User, Vote
+from votes import VOTE_BUFFER_MAX_VOTES, VoteBuffer, cast_vote
+
+
+def vote_sequence(index: int, repeat: int) -> List[int]:
+    """Голоса одного пользователя: repeat апвоутов, у каждого пятого - затем даунвоут"""
+    values = [1] * repeat
+    if index % 5 == 0:
+        values.append(-1)
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Параллельное голосование за один пост")
+    parser.add_argument("--users", type=int, default=500, help="голосующих пользователей")
+    parser.add_argument("--workers", type=int, default=100, help="параллельных потоков (соединений с БД)")
+    parser.add_argument("--repeat", type=int, default=2, help="одинаковых голосов от каждого пользователя")
+    parser.add_argument("--legacy", action="store_true", help="также проверить старый способ (upvotes += 1)")
+    parser.add_argument("--buffer", action="store_true", help="голосовать через VoteBuffer (запись пачками)")
+    parser.add_argument("--interval", type=int, default=200, help="интервал записи пачек с --buffer (мс)")
+    args = parser.parse_args()
+
+    engine = create_engine(DATABASE_URL, pool_size=args.workers, max_overflow=0)
+    if engine.dialect.name != "postgresql":
+        raise SystemExit("⚠ Проверка рассчитана на PostgreSQL")
+    Session = sessionmaker(bind=engine)
+
+    prefix = f"bench-vote-{uuid.uuid4().hex[:8]}"
+    db = Session()
+    users = [User(login=f"{prefix}-{index}", password="!", nick=prefix) for index in range(args.users)]
+    db.add_all(users)
+    db.flush()
+    post = Post(text=prefix, user_id=users[0].id)
+    db.add(post)
+    db.commit()
+    post_id = post.id
+    user_ids = [user.id for user in users]
+    db.close()
+
+    buffer = VoteBuffer(args.interval, VOTE_BUFFER_MAX_VOTES) if args.buffer else None
+    flush_requested = threading.Event()
+    voting_done = threading.Event()
+
+    def flush_periodically() -> None:
+        """Запись пачек, как фоновая задача flush_votes"""
+        while not voting_done.is_set():
+            flush_requested.wait(buffer.interval)
+            flush_requested.clear()
+            buffer.flush()
+        buffer.flush()
+
+    def buffered_vote(session, user_id: int, value: int) -> None:
+        """Голос через VoteBuffer, как в vote_post"""
+        stored = session.query(Post.upvotes, Vote.value.label("vote")).outerjoin(
+            Vote, and_(Vote.post_id == Post.id, Vote.user_id == user_id)
+        ).filter(Post.id == post_id).first()
+        _, flush_now = buffer.vote(user_id, post_id, value, stored.vote, stored.upvotes)
+        if flush_now:
+            flush_requested.set()
+
+    def vote_as(index: int) -> int:
+        """Голоса одного пользователя; возвращает число изменивших счётчик (без --buffer)"""
+        changed = 0
+        for value in vote_sequence(index, args.repeat):
+            session = Session()
+            try:
+                if buffer is not None:
+                    buffered_vote(session, user_ids[index], value)
+                elif cast_vote(session, user_ids[index], post_id, value) is not None:
+                    changed += 1
+                session.commit()
+            finally:
+                session.close()
+        return changed
+
+    def legacy_upvote(_: int) -> None:
+        session = Session()
+        try:
+            legacy_post = session.query(Post).filter(Post.id == post_id).first()
+            legacy_post.upvotes += 1
+            session.commit()
+        finally:
+            session.close()
+
+    try:
+        started = time.perf_counter()
+        flusher = threading.Thread(target=flush_periodically) if buffer is not None else None
+        if flusher is not None:
+            flusher.start()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            changed = sum(executor.map(vote_as, range(args.users)))
+        if flusher is not None:
+            voting_done.set()
+            flush_requested.set()
+            flusher.join()
+        elapsed = time.perf_counter() - started
+
+        total_votes = sum(len(vote_sequence(index, args.repeat)) for index in range(args.users))
+        expected = sum(vote_sequence(index, args.repeat)[-1] for index in range(args.users))
+        db = Session()
+        upvotes = db.query(Post.upvotes).filter(Post.id == post_id).scalar()
+        ledger_sum = db.query(func.coalesce(func.sum(Vote.value), 0)).filter(Vote.post_id == post_id).scalar()
+        db.close()
+
+        print(f"Голосов: {total_votes} от {args.users} пользователей в {args.workers} потоков "
+              f"за {elapsed:.2f} с ({total_votes / elapsed:.0f}/с)"
+              + ("" if buffer is not None else f", изменили счётчик: {changed}"))
+        print(f"  posts.upvotes = {upvotes}, сумма votes = {ledger_sum}, ожидается {expected}")
+        if buffer is not None:
+            stats = buffer.stats()
+            print(f"  транзакций записи: {stats['flushes']} вместо {total_votes}, "
+                  f"записано голосов: {stats['flushed_votes']}, макс. задержка {stats['max_lag_ms']} мс")
+        if upvotes == expected == ledger_sum:
+            print("✓ Потерянных и повторно учтённых голосов нет")
+        else:
+            print("⚠ Счётчик не совпадает с голосами")
+
+        if args.legacy:
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                list(executor.map(legacy_upvote, range(args.users)))
+            db = Session()
+            legacy_upvotes = db.query(Post.upvotes).filter(Post.id == post_id).scalar()
+            db.close()
+            print(f"Старый способ: {args.users} апвоутов, счётчик вырос на {legacy_upvotes - upvotes} "
+                  f"(потеряно {args.users - (legacy_upvotes - upvotes)})")
+    finally:
+        db = Session()
+        db.query(Vote).filter(Vote.post_id == post_id).delete(synchronize_session=False)
+        db.query(Post).filter(Post.id == post_id).delete(synchronize_session=False)
+        db.query(User).filter(User.login.like(f"{prefix}-%")).delete(synchronize_session=False)
+        db.commit()
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -33,8 +33,26 @@ def init_db():
     
     # Затем выполняем миграции
     try:
-        from migrations import migrate_posts_table
+        from migrations import (
+            migrate_posts_table,
+            migrate_post_files_table,
+            migrate_audio_metadata_table,
+            migrate_file_path_indexes,
+            migrate_updated_at_columns,
+            migrate_feed_indexes,
+            migrate_comment_indexes,
+            migrate_search_columns,
+            migrate_board_version,
+        )
         migrate_posts_table()
+        migrate_post_files_table()
+        migrate_audio_metadata_table()
+        migrate_file_path_indexes()
+        migrate_updated_at_columns()
+        migrate_feed_indexes()
+        migrate_comment_indexes()
+        migrate_search_columns()
+        migrate_board_version()
     except Exception as e:
         print(f"Предупреждение при выполнении миграций: {e}")
 
@@ -0,0 +1,174 @@
+"""
+Локальная замена reverse proxy для проверки режима MEDIA_OFFLOAD
+
+Проксирует запросы на backend и, как Apache mod_xsendfile / nginx, подменяет пустой
+ответ с заголовком X-Sendfile или X-Accel-Redirect содержимым файла с диска.
+
+Пример:
+    MEDIA_OFFLOAD=x-sendfile uvicorn main:app --port 8000
+    python dev_proxy.py --backend http://127.0.0.1:8000 --port 8080
+    curl -v http://127.0.0.1:8080/posts/1/files/1 -o /dev/null
+"""
+import argparse
+import http.client
+import os
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+# Заголовки, которые не пересылаются между клиентом, прокси и backend
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade",
+}
+# Заголовки ответа backend, которые прокси заменяет своими при отдаче файла
+OFFLOAD_HEADERS = {"x-sendfile", "x-accel-redirect", "content-length"}
+
+CHUNK_SIZE = 64 * 1024
+
+
+class OffloadProxyHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов: проксирование на backend и отдача файлов по X-Sendfile/X-Accel-Redirect"""
+
+    backend = urlsplit("http://127.0.0.1:8000")
+    accel_prefix = "/internal-uploads"
+    accel_root = Path("uploads")
+    protocol_version = "HTTP/1.1"
+
+    def _proxy(self):
+        body = None
+        content_length = self.headers.get("Content-Length")
+        if content_length:
+            body = self.rfile.read(int(content_length))
+
+        headers = {
+            key: value for key, value in self.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() != "host"
+        }
+        headers["Host"] = self.backend.netloc
+
+        connection = http.client.HTTPConnection(self.backend.hostname, self.backend.port or 80)
+        try:
+            connection.request(self.command, self.path, body=body, headers=headers)
+            response = connection.getresponse()
+
+            file_path = self._offloaded_file(response)
+            if file_path is not None:
+                response.read()
+                self._send_file(response, file_path)
+                return
+
+            self.send_response(response.status, response.reason)
+            for key, value in response.getheaders():
+                if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() != "content-length":
+                    self.send_header(key, value)
+            data = response.read()
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+        finally:
+            connection.close()
+
+    def _offloaded_file(self, response):
+        """Возвращает путь к файлу, если backend передал отдачу файла прокси"""
+        sendfile = response.getheader("X-Sendfile")
+        if sendfile:
+            return Path(sendfile)
+
+        accel = response.getheader("X-Accel-Redirect")
+        if accel:
+            accel = unquote(accel)
+            prefix = self.accel_prefix.rstrip("/") + "/"
+            if not accel.startswith(prefix):
+                return Path("/nonexistent")
+            return self.accel_root / accel[len(prefix):]
+
+        return None
+
+    def _send_file(self, response, file_path: Path):
+        """Отдаёт файл с диска с учётом простого Range-запроса (один диапазон)"""
+        if not file_path.is_file():
+            self.log_message("offload: файл не найден %s", file_path)
+            self.send_error(404, "File not found")
+            return
+
+        file_size = file_path.stat().st_size
+        start, end = 0, file_size - 1
+        status_code = 200
+
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes=") and "," not in range_header:
+            start_str, _, end_str = range_header[len("bytes="):].partition("-")
+            try:
+                if start_str:
+                    start = int(start_str)
+                    end = min(int(end_str), file_size - 1) if end_str else file_size - 1
+                else:
+                    start = max(file_size - int(end_str), 0)
+                if start > end or start >= file_size:
+                    raise ValueError
+                status_code = 206
+            except ValueError:
+                start, end = 0, file_size - 1
+
+        self.log_message("offload: %s (%d-%d/%d)", file_path, start, end, file_size)
+        self.send_response(status_code)
+        for key, value in response.getheaders():
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in OFFLOAD_HEADERS:
+                self.send_header(key, value)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", formatdate(file_path.stat().st_mtime, usegmt=True))
+        if status_code == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        if self.command == "HEAD":
+            return
+
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    do_GET = _proxy
+    do_HEAD = _proxy
+    do_POST = _proxy
+    do_PUT = _proxy
+    do_PATCH = _proxy
+    do_DELETE = _proxy
+    do_OPTIONS = _proxy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный прокси для проверки X-Sendfile/X-Accel-Redirect")
+    parser.add_argument("--backend", default=os.getenv("BACKEND_URL", "http://127.0.0.1:8000"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--accel-prefix", default="/internal-uploads", help="internal location для X-Accel-Redirect")
+    parser.add_argument("--accel-root", default="uploads", help="каталог, на который указывает internal location")
+    args = parser.parse_args()
+
+    OffloadProxyHandler.backend = urlsplit(args.backend)
+    OffloadProxyHandler.accel_prefix = args.accel_prefix
+    OffloadProxyHandler.accel_root = Path(args.accel_root)
+
+    server = ThreadingHTTPServer((args.host, args.port), OffloadProxyHandler)
+    print(f"Прокси слушает http://{args.host}:{args.port} -> {args.backend}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
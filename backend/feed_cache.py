@@ -0,0 +1,263 @@
+"""
+Кэш ответов ленты и постов в памяти процесса
+
+Готовые JSON ответы GET /posts и GET /posts/{id} хранятся по ключу
+(версия доски, параметры запроса) вместе со слабым ETag. Транзакция, меняющая посты, голоса или комментарии,
+отмечается через mark_board_changed(db): после её коммита версия доски в этом процессе
+увеличивается (старые ответы больше не выдаются), а остальные воркеры узнают об
+изменении через LISTEN/NOTIFY PostgreSQL. Такая транзакция перед коммитом увеличивает и
+board_version в БД - по этой версии строятся ETag ленты и комментариев. Пока соединение LISTEN не установлено,
+кэш в PostgreSQL не используется, чтобы не отдавать ответы, устаревшие в другом воркере.
+"""
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+from fastapi import Request, Response, status
+from sqlalchemy import event, func, text, update
+from sqlalchemy.orm import Session
+from database import engine
+from models import BoardVersion, Post
+from json_utils import dumps
+from media_utils import etag_matches
+
+# Сколько ответов хранится в кэше процесса; 0 - кэш отключён
+FEED_CACHE_MAX_ENTRIES = int(os.getenv("FEED_CACHE_MAX_ENTRIES") or "512")
+
+# Канал NOTIFY, в который транзакции сообщают об изменении доски
+FEED_CHANNEL = "board_changed"
+
+# Через сколько секунд переподключаться после обрыва соединения LISTEN
+LISTEN_RETRY_INTERVAL = 5
+
+# Ответы с ETag: клиент может хранить их, но перед использованием переспрашивает сервер
+REVALIDATE_HEADERS = {"Cache-Control": "no-cache"}
+
+# Отметка в Session.info: транзакция меняет ленту
+_CHANGED_KEY = "board_changed"
+
+# Уведомления своего процесса пропускаются: кэш уже сброшен после коммита
+_PROCESS_TOKEN = uuid.uuid4().hex
+
+
+class FeedCache:
+    """LRU-кэш готовых ответов с версией доски в ключе"""
+
+    def __init__(self, max_entries: int, requires_listener: bool):
+        self.max_entries = max_entries
+        # В PostgreSQL (несколько воркеров) кэш работает, только пока слушаются изменения
+        self.requires_listener = requires_listener
+        self.listening = False
+        self.version = 0
+        self._entries: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and (self.listening or not self.requires_listener)
+
+    def get(self, version: int, key: Hashable) -> Optional[Any]:
+        """Ответ, построенный при этой версии доски, или None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            value = self._entries.get((version, key))
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((version, key))
+            self.hits += 1
+            return value
+
+    def put(self, version: int, key: Hashable, value: Any) -> None:
+        """Сохраняет ответ; ответ, построенный до смены версии, не сохраняется"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[(version, key)] = value
+            self._entries.move_to_end((version, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """Новая версия доски: все сохранённые ответы устаревают"""
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "version": self.version,
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+feed_cache = FeedCache(FEED_CACHE_MAX_ENTRIES, requires_listener=engine.dialect.name == "postgresql")
+
+
+def weak_etag(*parts) -> str:
+    """
+    Слабый ETag из маркеров изменения ресурса (версия доски, id, updated_at)
+    вместо хэша тела ответа: его можно проверить, не строя ответ
+    """
+    values = []
+    for part in parts:
+        if isinstance(part, datetime):
+            part = f"{int(part.timestamp() * 1_000_000):x}"
+        values.append("0" if part is None else str(part))
+    return f'W/"{"-".join(values)}"'
+
+
+def not_modified_response(request: Request, etag: str) -> Optional[Response]:
+    """Ответ 304, если ETag совпадает с If-None-Match запроса, иначе None"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, **REVALIDATE_HEADERS})
+    return None
+
+
+def cached_json_response(
+    request: Request,
+    key: Hashable,
+    etag: Callable[[], str],
+    build: Callable[[], Tuple[Any, Dict[str, str]]]
+) -> Response:
+    """
+    JSON ответ из кэша или построенный заново (с ETag и ответом 304)
+
+    etag вычисляет ETag ресурса дешёвым запросом; при совпадении с If-None-Match
+    ответ не строится и не сериализуется. ETag вычисляется до построения ответа, поэтому
+    он не новее данных. build возвращает (данные ответа, заголовки); данные уже в формате
+    схемы ответа (см. serialize_post) и кодируются orjson без проверки по response_model.
+    Ошибки build (404 и т.п.) не кэшируются.
+    """
+    version = feed_cache.version
+    cached = feed_cache.get(version, key)
+    if cached is None:
+        tag = etag()
+        not_modified = not_modified_response(request, tag)
+        if not_modified is not None:
+            return not_modified
+        content, headers = build()
+        cached = (dumps(content), {**headers, "ETag": tag, **REVALIDATE_HEADERS})
+        feed_cache.put(version, key, cached)
+    body, headers = cached
+    return not_modified_response(request, headers["ETag"]) or Response(
+        content=body, media_type="application/json", headers=headers
+    )
+
+
+def mark_board_changed(db: Session) -> None:
+    """
+    Отмечает, что транзакция меняет ленту: после коммита сбрасывается кэш этого процесса,
+    а NOTIFY (доставляется только при коммите) сбрасывает кэш остальных воркеров
+    """
+    if db.info.get(_CHANGED_KEY):
+        return
+    db.info[_CHANGED_KEY] = True
+    if engine.dialect.name == "postgresql":
+        db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": FEED_CHANNEL, "payload": _PROCESS_TOKEN})
+
+
+def board_version(db: Session) -> int:
+    """
+    Версия доски для ETag: меняется с каждым коммитом транзакции, отмеченной mark_board_changed
+    В отличие от max(updated_at) (now() - время начала транзакции, а не коммита), долгая
+    транзакция не может закоммитить значение старее уже выданного.
+    """
+    return db.query(BoardVersion.version).filter(BoardVersion.id == 1).scalar()
+
+
+def touch_posts(db: Session, post_ids: Iterable[int]) -> None:
+    """
+    Обновляет updated_at постов, у которых изменились не поля самого поста
+    (файлы, уменьшенные копии, ник автора), и отмечает изменение доски
+    """
+    post_ids = list(set(post_ids))
+    if post_ids:
+        db.execute(
+            update(Post).where(Post.id.in_(post_ids)).values(updated_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+    mark_board_changed(db)
+
+
+@event.listens_for(Session, "before_commit")
+def _bump_board_version(session: Session):
+    # Строка board_version блокируется только на время коммита, поэтому версии
+    # идут в порядке коммитов, а пишущие транзакции почти не ждут друг друга
+    if session.info.get(_CHANGED_KEY):
+        session.execute(
+            update(BoardVersion).where(BoardVersion.id == 1).values(version=BoardVersion.version + 1)
+        )
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session: Session):
+    if session.info.pop(_CHANGED_KEY, False):
+        feed_cache.invalidate()
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_after_rollback(session: Session, transaction):
+    # После коммита отметку уже снял after_commit; здесь - откат транзакции
+    if transaction.parent is None:
+        session.info.pop(_CHANGED_KEY, None)
+
+
+def _listen(stop_event: threading.Event):
+    """Слушает уведомления об изменениях доски; при обрыве соединения переподключается"""
+    import psycopg
+
+    conninfo = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    while not stop_event.is_set():
+        try:
+            with psycopg.connect(conninfo, autocommit=True) as conn:
+                conn.execute(f"LISTEN {FEED_CHANNEL}")
+                # Пока соединения не было, уведомления могли быть пропущены
+                feed_cache.invalidate()
+                feed_cache.listening = True
+                while not stop_event.is_set():
+                    for notify in conn.notifies(timeout=1.0):
+                        if notify.payload != _PROCESS_TOKEN:
+                            feed_cache.invalidate()
+        except Exception as e:
+            print(f"⚠ Соединение LISTEN {FEED_CHANNEL} потеряно: {e}")
+        finally:
+            feed_cache.listening = False
+        stop_event.wait(LISTEN_RETRY_INTERVAL)
+
+
+_listener: Optional[threading.Thread] = None
+_listener_stop = threading.Event()
+
+
+def start_feed_cache_listener():
+    """Запускает поток LISTEN (только для PostgreSQL и включённого кэша)"""
+    global _listener
+    if not feed_cache.requires_listener or feed_cache.max_entries <= 0 or _listener is not None:
+        return
+    _listener_stop.clear()
+    _listener = threading.Thread(target=_listen, args=(_listener_stop,), name="feed-cache-listener", daemon=True)
+    _listener.start()
+
+
+def stop_feed_cache_listener():
+    """Останавливает поток LISTEN"""
+    global _listener
+    if _listener is None:
+        return
+    _listener_stop.set()
+    _listener.join(timeout=LISTEN_RETRY_INTERVAL)
+    _listener = None
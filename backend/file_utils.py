@@ -1,155 +1,455 @@
-import os
-import uuid
-from pathlib import Path
-from fastapi import UploadFile, HTTPException, status
-from typing import Optional, Tuple
-
-# Директория для хранения загруженных файлов
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
-
-# Поддерживаемые типы файлов для рендеринга (остальные будут доступны для скачивания)
-SUPPORTED_IMAGE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff"}
-SUPPORTED_VIDEO_TYPES = {"video/mp4", "video/webm", "video/ogg", "video/quicktime", "video/x-msvideo", "video/x-matroska"}
-SUPPORTED_AUDIO_TYPES = {"audio/mpeg", "audio/ogg", "audio/wav", "audio/webm", "audio/flac", "audio/x-flac", "audio/aac", "audio/x-m4a"}
-SUPPORTED_TYPES = SUPPORTED_IMAGE_TYPES | SUPPORTED_VIDEO_TYPES | SUPPORTED_AUDIO_TYPES
-
-# Старые константы для обратной совместимости
-ALLOWED_IMAGE_TYPES = SUPPORTED_IMAGE_TYPES
-ALLOWED_VIDEO_TYPES = SUPPORTED_VIDEO_TYPES
-ALLOWED_AUDIO_TYPES = SUPPORTED_AUDIO_TYPES
-ALLOWED_TYPES = SUPPORTED_TYPES
-
-# Максимальный размер файла (200 МБ)
-MAX_FILE_SIZE = 200 * 1024 * 1024
-
-
-def validate_file_type(file: UploadFile) -> bool:
-    """Проверка типа файла (теперь разрешены любые типы)"""
-    # Разрешаем любые типы файлов
-    return True
-
-
-def get_file_category(content_type: str) -> str:
-    """Определяет категорию файла"""
-    if content_type and content_type.startswith("image/"):
-        return "image"
-    elif content_type and content_type.startswith("video/"):
-        return "video"
-    elif content_type and content_type.startswith("audio/"):
-        return "audio"
-    elif content_type:
-        # Для других типов используем общую категорию "other"
-        return "other"
-    return "unknown"
-
-
-def generate_file_path(file: UploadFile) -> Tuple[str, str]:
-    """
-    Генерирует уникальный путь для файла
-    Возвращает: (путь к файлу, имя файла)
-    """
-    # Получаем расширение из оригинального имени или content_type
-    original_filename = file.filename or "file"
-    file_ext = Path(original_filename).suffix
-    
-    # Если расширения нет, пытаемся определить по content_type или используем .bin
-    if not file_ext:
-        ext_map = {
-            "image/jpeg": ".jpg",
-            "image/png": ".png",
-            "image/gif": ".gif",
-            "image/webp": ".webp",
-            "image/bmp": ".bmp",
-            "image/tiff": ".tiff",
-            "video/mp4": ".mp4",
-            "video/webm": ".webm",
-            "video/ogg": ".ogv",
-            "video/quicktime": ".mov",
-            "video/x-msvideo": ".avi",
-            "video/x-matroska": ".mkv",
-            "audio/mpeg": ".mp3",
-            "audio/ogg": ".ogg",
-            "audio/wav": ".wav",
-            "audio/webm": ".weba",
-            "audio/flac": ".flac",
-            "audio/x-flac": ".flac",
-            "audio/aac": ".aac",
-            "audio/x-m4a": ".m4a",
-            "application/pdf": ".pdf",
-            "application/zip": ".zip",
-            "application/x-rar-compressed": ".rar",
-            "text/plain": ".txt",
-        }
-        file_ext = ext_map.get(file.content_type or "", ".bin")
-    
-    # Генерируем уникальное имя файла
-    unique_id = str(uuid.uuid4())
-    filename = f"{unique_id}{file_ext}"
-    
-    # Создаём поддиректорию по категории файла
-    category = get_file_category(file.content_type)
-    category_dir = UPLOAD_DIR / category
-    category_dir.mkdir(exist_ok=True)
-    
-    file_path = category_dir / filename
-    
-    # Возвращаем относительный путь от корня проекта (для хранения в БД)
-    # Путь будет вида: uploads/image/uuid.jpg
-    relative_path = str(file_path)
-    return relative_path, original_filename
-
-
-async def save_uploaded_file(file: UploadFile) -> Tuple[str, str, str, int]:
-    """
-    Сохраняет загруженный файл
-    Возвращает: (путь к файлу, тип файла, оригинальное имя, размер файла)
-    """
-    # Проверка типа файла (теперь разрешены любые типы)
-    if not validate_file_type(file):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Ошибка при загрузке файла"
-        )
-    
-    # Генерируем путь
-    file_path, original_filename = generate_file_path(file)
-    
-    # Читаем и сохраняем файл
-    content = await file.read()
-    file_size = len(content)
-    
-    # Проверка размера
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Файл слишком большой. Максимальный размер: {MAX_FILE_SIZE / (1024 * 1024):.0f} МБ"
-        )
-    
-    # Сохраняем файл
-    with open(file_path, "wb") as f:
-        f.write(content)
-    
-    # Определяем content_type, если не указан
-    content_type = file.content_type or "application/octet-stream"
-    
-    return file_path, content_type, original_filename, file_size
-
-
-def delete_file(file_path: str) -> bool:
-    """Удаляет файл с диска"""
-    try:
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
-            return True
-    except Exception:
-        pass
-    return False
-
-
-def get_file_path(post_file_path: Optional[str]) -> Optional[Path]:
-    """Возвращает Path объект для файла поста"""
-    if not post_file_path:
-        return None
-    return Path(post_file_path)
-
+import os
+import glob
+import uuid
+import string
+import hashlib
+from pathlib import Path
+from fastapi import UploadFile, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+import anyio
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from typing import BinaryIO, List, Optional, Tuple
+from models import FileBlob, PendingDeletion, PostFile
+from media_cache import audio_cache
+
+# Директория для хранения загруженных файлов
+UPLOAD_DIR = Path("uploads")
+UPLOAD_DIR.mkdir(exist_ok=True)
+
+# Директория для файлов, загружаемых по частям (до завершения загрузки)
+UPLOAD_TMP_DIR = UPLOAD_DIR / "tmp"
+UPLOAD_TMP_DIR.mkdir(exist_ok=True)
+
+# Поддерживаемые типы файлов для рендеринга (остальные будут доступны для скачивания)
+SUPPORTED_IMAGE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff"}
+SUPPORTED_VIDEO_TYPES = {"video/mp4", "video/webm", "video/ogg", "video/quicktime", "video/x-msvideo", "video/x-matroska"}
+SUPPORTED_AUDIO_TYPES = {"audio/mpeg", "audio/ogg", "audio/wav", "audio/webm", "audio/flac", "audio/x-flac", "audio/aac", "audio/x-m4a"}
+SUPPORTED_TYPES = SUPPORTED_IMAGE_TYPES | SUPPORTED_VIDEO_TYPES | SUPPORTED_AUDIO_TYPES
+
+# Старые константы для обратной совместимости
+ALLOWED_IMAGE_TYPES = SUPPORTED_IMAGE_TYPES
+ALLOWED_VIDEO_TYPES = SUPPORTED_VIDEO_TYPES
+ALLOWED_AUDIO_TYPES = SUPPORTED_AUDIO_TYPES
+ALLOWED_TYPES = SUPPORTED_TYPES
+
+# Максимальный размер файла (200 МБ)
+MAX_FILE_SIZE = 200 * 1024 * 1024
+
+# Размер блока при записи загружаемого файла на диск
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Сколько файлов одновременно записывается на диск (общий лимит для всех запросов)
+UPLOAD_WRITE_CONCURRENCY = int(os.getenv("UPLOAD_WRITE_CONCURRENCY") or "4")
+
+_upload_write_limiter: Optional[anyio.CapacityLimiter] = None
+
+
+def get_upload_write_limiter() -> anyio.CapacityLimiter:
+    """Пул потоков для записи загружаемых файлов на диск (создаётся внутри event loop)"""
+    global _upload_write_limiter
+    if _upload_write_limiter is None:
+        _upload_write_limiter = anyio.CapacityLimiter(UPLOAD_WRITE_CONCURRENCY)
+    return _upload_write_limiter
+
+
+def validate_file_type(file: UploadFile) -> bool:
+    """Проверка типа файла (теперь разрешены любые типы)"""
+    # Разрешаем любые типы файлов
+    return True
+
+
+def get_file_category(content_type: str) -> str:
+    """Определяет категорию файла"""
+    if content_type and content_type.startswith("image/"):
+        return "image"
+    elif content_type and content_type.startswith("video/"):
+        return "video"
+    elif content_type and content_type.startswith("audio/"):
+        return "audio"
+    elif content_type:
+        # Для других типов используем общую категорию "other"
+        return "other"
+    return "unknown"
+
+
+def get_post_category(file_type: Optional[str]) -> str:
+    """Категория поста для фильтра ленты: по типу первого файла, пост без файлов - text"""
+    return get_file_category(file_type) if file_type else "text"
+
+
+def get_file_extension(original_filename: str, content_type: Optional[str]) -> str:
+    """Определяет расширение файла по оригинальному имени или content_type"""
+    file_ext = Path(original_filename).suffix
+    
+    # Если расширения нет, пытаемся определить по content_type или используем .bin
+    if not file_ext:
+        ext_map = {
+            "image/jpeg": ".jpg",
+            "image/png": ".png",
+            "image/gif": ".gif",
+            "image/webp": ".webp",
+            "image/bmp": ".bmp",
+            "image/tiff": ".tiff",
+            "video/mp4": ".mp4",
+            "video/webm": ".webm",
+            "video/ogg": ".ogv",
+            "video/quicktime": ".mov",
+            "video/x-msvideo": ".avi",
+            "video/x-matroska": ".mkv",
+            "audio/mpeg": ".mp3",
+            "audio/ogg": ".ogg",
+            "audio/wav": ".wav",
+            "audio/webm": ".weba",
+            "audio/flac": ".flac",
+            "audio/x-flac": ".flac",
+            "audio/aac": ".aac",
+            "audio/x-m4a": ".m4a",
+            "application/pdf": ".pdf",
+            "application/zip": ".zip",
+            "application/x-rar-compressed": ".rar",
+            "text/plain": ".txt",
+        }
+        file_ext = ext_map.get(content_type or "", ".bin")
+    
+    return file_ext.lower()
+
+
+def get_shard_dir(category_dir: Path, filename: str) -> Path:
+    """
+    Подкаталог для файла по первым символам его имени: <category>/ab/cd/
+    Так в одном каталоге не оказывается больше нескольких тысяч файлов.
+    """
+    key = Path(filename).stem.replace("-", "").lower()
+    # Имена старых файлов - uuid, новых - SHA-256; для прочих берём хэш имени
+    if len(key) < 4 or any(c not in string.hexdigits for c in key[:4]):
+        key = hashlib.sha256(filename.encode("utf-8")).hexdigest()
+    return category_dir / key[:2] / key[2:4]
+
+
+def is_sharded_path(file_path: str) -> bool:
+    """Лежит ли файл уже в подкаталоге вида uploads/<category>/ab/cd/"""
+    parts = Path(file_path).parts
+    return len(parts) >= 5 and len(parts[-3]) == 2 and len(parts[-2]) == 2
+
+
+def get_sharded_path(file_path: str) -> str:
+    """Путь, по которому файл старой плоской раскладки (uploads/<category>/<name>) лежит после разбиения"""
+    path = Path(file_path)
+    if is_sharded_path(file_path):
+        return file_path
+    return str(get_shard_dir(path.parent, path.name) / path.name)
+
+
+def generate_file_path(content_hash: str, content_type: Optional[str], original_filename: str) -> str:
+    """
+    Генерирует путь для файла по хэшу его содержимого (одинаковые файлы хранятся один раз)
+    Возвращает: путь к файлу
+    """
+    filename = f"{content_hash}{get_file_extension(original_filename, content_type)}"
+    
+    # Создаём поддиректорию по категории файла и первым символам хэша
+    category = get_file_category(content_type)
+    shard_dir = get_shard_dir(UPLOAD_DIR / category, filename)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Возвращаем относительный путь от корня проекта (для хранения в БД)
+    # Путь будет вида: uploads/image/ab/cd/<sha256>.jpg
+    return str(shard_dir / filename)
+
+
+def file_too_large_error() -> HTTPException:
+    """Ошибка превышения максимального размера файла"""
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"Файл слишком большой. Максимальный размер: {MAX_FILE_SIZE / (1024 * 1024):.0f} МБ"
+    )
+
+
+def copy_to_disk(source: BinaryIO, destination: Path) -> Tuple[int, str]:
+    """
+    Копирует поток на диск блоками по UPLOAD_CHUNK_SIZE, считая размер и SHA-256 за один проход
+    Запись идёт во временный файл, который переименовывается только после успешного копирования.
+    Если размер превышает MAX_FILE_SIZE, копирование прерывается сразу.
+    Возвращает: (размер в байтах, SHA-256 в hex)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    # Уникальное имя временного файла: один и тот же blob могут записывать параллельно
+    temp_path = destination.with_name(f"{destination.name}.{uuid.uuid4().hex}.part")
+
+    try:
+        with open(temp_path, "wb") as out:
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise file_too_large_error()
+                digest.update(chunk)
+                out.write(chunk)
+        os.replace(temp_path, destination)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    return size, digest.hexdigest()
+
+
+def hash_stream(source: BinaryIO) -> Tuple[int, str]:
+    """
+    Считает размер и SHA-256 потока блоками по UPLOAD_CHUNK_SIZE
+    Если размер превышает MAX_FILE_SIZE, чтение прерывается сразу.
+    Возвращает: (размер в байтах, SHA-256 в hex)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = source.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_FILE_SIZE:
+            raise file_too_large_error()
+        digest.update(chunk)
+    return size, digest.hexdigest()
+
+
+async def save_uploaded_file(file: UploadFile, db: Session) -> Tuple[FileBlob, str, str]:
+    """
+    Сохраняет загруженный файл в хранилище, адресуемое по содержимому
+    Сначала в пуле потоков считается SHA-256. Если такой файл уже хранится, счётчик
+    ссылок на blob увеличивается и запись на диск не выполняется.
+    Возвращает: (blob, тип файла, оригинальное имя)
+    """
+    # Проверка типа файла (теперь разрешены любые типы)
+    if not validate_file_type(file):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Ошибка при загрузке файла"
+        )
+    
+    # Если размер известен заранее, отклоняем файл до чтения
+    if file.size is not None and file.size > MAX_FILE_SIZE:
+        raise file_too_large_error()
+    
+    original_filename = file.filename or "file"
+    # Определяем content_type, если не указан
+    content_type = file.content_type or "application/octet-stream"
+    
+    # Считаем хэш, не читая файл в память целиком
+    await file.seek(0)
+    file_size, content_hash = await run_in_threadpool(hash_stream, file.file)
+    
+    file_path = generate_file_path(content_hash, content_type, original_filename)
+    
+    # Если запись на диск не удалась, ссылка на blob откатывается вместе с savepoint
+    with db.begin_nested():
+        blob, needs_write = acquire_blob(db, content_hash, file_size, file_path)
+        
+        if needs_write:
+            await file.seek(0)
+            _, written_hash = await run_in_threadpool(copy_to_disk, file.file, Path(blob.file_path))
+            if written_hash != content_hash:
+                delete_file(blob.file_path)
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Файл изменился во время загрузки"
+                )
+    
+    return blob, content_type, original_filename
+
+
+def delete_file(file_path: str) -> bool:
+    """Удаляет файл с диска (и закэшированные результаты его разбора)"""
+    audio_cache.invalidate(file_path)
+    try:
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+            return True
+    except Exception:
+        pass
+    return False
+
+
+def get_preview_path(file_path: str, width: int, preview_format: str) -> Path:
+    """Путь к уменьшенной копии файла (лежит рядом с оригиналом): uploads/image/ab/cd/<sha256>.w640.webp"""
+    path = Path(file_path)
+    return path.with_name(f"{path.stem}.w{width}.{preview_format}")
+
+
+def list_previews(file_path: str) -> List[Path]:
+    """Все уменьшенные копии файла на диске"""
+    path = Path(file_path)
+    return list(path.parent.glob(f"{glob.escape(path.stem)}.w[0-9]*.*"))
+
+
+def delete_previews(file_path: str) -> None:
+    """Удаляет все уменьшенные копии файла"""
+    for preview_path in list_previews(file_path):
+        preview_path.unlink(missing_ok=True)
+
+
+def get_file_path(post_file_path: Optional[str]) -> Optional[Path]:
+    """Возвращает Path объект для файла поста"""
+    if not post_file_path:
+        return None
+    return Path(post_file_path)
+
+
+def hash_file(file_path: Path) -> Tuple[int, str]:
+    """Считает размер и SHA-256 файла на диске"""
+    with open(file_path, "rb") as f:
+        return hash_stream(f)
+
+
+def link_staged_file(
+    db: Session,
+    source_path: Path,
+    file_size: int,
+    content_hash: str,
+    content_type: str,
+    original_filename: str
+) -> Tuple[FileBlob, Optional[str]]:
+    """
+    Добавляет в хранилище готовый файл с известным хэшем (например, собранный из частей)
+    жёсткой ссылкой: исходный файл остаётся, пока транзакция не закоммичена, и при откате
+    его можно сохранить снова. Исходный файл удаляет вызывающий после коммита.
+    Возвращает: (blob, путь записанного файла - его нужно удалить при откате - или None)
+    """
+    file_path = generate_file_path(content_hash, content_type, original_filename)
+    
+    with db.begin_nested():
+        blob, needs_write = acquire_blob(db, content_hash, file_size, file_path)
+        if not needs_write:
+            return blob, None
+        # Через временное имя: на месте файла может лежать оставшийся после сбоя
+        link_path = f"{blob.file_path}.{uuid.uuid4().hex}.part"
+        os.link(source_path, link_path)
+        try:
+            os.replace(link_path, blob.file_path)
+        except BaseException:
+            os.unlink(link_path)
+            raise
+    
+    return blob, blob.file_path
+
+
+async def stage_uploaded_file(file: UploadFile) -> Tuple[Path, int, str]:
+    """
+    Копирует загруженный файл во временный каталог, считая SHA-256 за тот же проход
+    Не обращается к БД, поэтому файлы одного запроса можно сохранять параллельно;
+    число одновременных записей ограничено UPLOAD_WRITE_CONCURRENCY.
+    Возвращает: (путь к временному файлу, размер в байтах, SHA-256 в hex)
+    """
+    if file.size is not None and file.size > MAX_FILE_SIZE:
+        raise file_too_large_error()
+    
+    temp_path = UPLOAD_TMP_DIR / f"{uuid.uuid4().hex}.part"
+    await file.seek(0)
+    file_size, content_hash = await anyio.to_thread.run_sync(
+        copy_to_disk, file.file, temp_path, limiter=get_upload_write_limiter()
+    )
+    return temp_path, file_size, content_hash
+
+
+def store_staged_file(
+    db: Session,
+    temp_path: Path,
+    file_size: int,
+    content_hash: str,
+    content_type: str,
+    original_filename: str
+) -> FileBlob:
+    """
+    Переносит подготовленный файл с известным хэшем в хранилище
+    Если такой файл уже хранится, временный файл просто удаляется.
+    """
+    file_path = generate_file_path(content_hash, content_type, original_filename)
+    
+    with db.begin_nested():
+        blob, needs_write = acquire_blob(db, content_hash, file_size, file_path)
+        if needs_write:
+            os.replace(temp_path, blob.file_path)
+    
+    temp_path.unlink(missing_ok=True)
+    return blob
+
+
+def get_upload_temp_path(upload_id: str) -> Path:
+    """Возвращает путь к временному файлу сессии загрузки по частям"""
+    return UPLOAD_TMP_DIR / f"{upload_id}.part"
+
+
+def acquire_blob(db: Session, content_hash: str, file_size: int, file_path: str) -> Tuple[FileBlob, bool]:
+    """
+    Берёт ссылку на blob с данным хэшем, создавая запись при необходимости
+    Возвращает: (blob, нужно ли записать файл на диск)
+    """
+    blob = db.query(FileBlob).filter(FileBlob.content_hash == content_hash).with_for_update().first()
+    
+    if blob is None:
+        # Файл с тем же содержимым мог быть помечен к удалению - отменяем, иначе фоновая
+        # задача удалит только что записанный файл (если она уже удаляет его, ждём её коммита)
+        cancel_file_deletion(db, file_path)
+        try:
+            with db.begin_nested():
+                blob = FileBlob(
+                    content_hash=content_hash,
+                    file_path=file_path,
+                    file_size=file_size,
+                    ref_count=1
+                )
+                db.add(blob)
+            return blob, True
+        except IntegrityError:
+            # Тот же файл параллельно загрузили в другом запросе
+            blob = db.query(FileBlob).filter(FileBlob.content_hash == content_hash).with_for_update().one()
+    
+    blob.ref_count += 1
+    # Файл мог пропасть с диска - тогда его нужно записать заново
+    return blob, not os.path.exists(blob.file_path)
+
+
+def schedule_file_deletion(db: Session, file_path: Optional[str]) -> None:
+    """
+    Помечает файл к удалению в текущей транзакции
+    Сам файл (с уменьшенными копиями) удаляет фоновая задача после коммита: если
+    транзакция откатится, файл останется на месте вместе с записями о нём.
+    """
+    if file_path:
+        db.add(PendingDeletion(file_path=file_path))
+
+
+def cancel_file_deletion(db: Session, file_path: str) -> None:
+    """Снимает пометку об удалении с файла, который снова используется"""
+    db.query(PendingDeletion).filter(
+        PendingDeletion.file_path == file_path
+    ).delete(synchronize_session=False)
+
+
+def release_post_file(db: Session, post_file: PostFile) -> None:
+    """
+    Освобождает файл записи PostFile
+    Общий blob помечается к удалению только вместе с последней ссылкой на него;
+    файлы старого формата (без blob) помечаются сразу. Обложка аудио из хранилища
+    обложек помечается всегда: фоновая задача не удалит её, пока она нужна другим файлам.
+    """
+    if post_file.audio_metadata is not None and post_file.audio_metadata.cover_path:
+        schedule_file_deletion(db, post_file.audio_metadata.cover_path)
+    
+    if post_file.blob_id is None:
+        schedule_file_deletion(db, post_file.file_path)
+        return
+    
+    blob = db.query(FileBlob).filter(FileBlob.id == post_file.blob_id).with_for_update().first()
+    post_file.blob_id = None
+    if blob is None:
+        return
+    
+    blob.ref_count -= 1
+    if blob.ref_count <= 0:
+        db.flush()
+        db.delete(blob)
+        schedule_file_deletion(db, blob.file_path)
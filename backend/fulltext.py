@@ -0,0 +1,105 @@
+"""
+Полнотекстовый поиск PostgreSQL по постам, комментариям, именам файлов и тегам аудио
+
+У posts, comments, post_files и audio_metadata есть генерируемая колонка search_vector
+с GIN индексом (см. migrate_search_columns). Текст разбирается каждой конфигурацией из
+SEARCH_CONFIGS: russian приводит к основе русские слова, english - английские, поэтому
+запрос на любом из языков находит другие словоформы. Запрос пользователя - в синтаксисе
+websearch_to_tsquery: слова, "точная фраза", -исключение, OR.
+"""
+import os
+from typing import List, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+# Конфигурации разбора текста; после изменения колонки search_vector нужно пересоздать
+SEARCH_CONFIGS = ("russian", "english")
+
+# Сколько самых новых совпадений каждого источника ранжируется; ограничивает работу
+# запроса из частых слов (совпадения старше не попадают в результаты)
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES") or "5000")
+
+# Текст, по которому строится search_vector каждой таблицы (только immutable выражения)
+SEARCH_COLUMNS = {
+    "posts": "coalesce(text, '')",
+    "comments": "text",
+    # Точки, подчёркивания и дефисы в именах файлов разделяют слова
+    "post_files": "translate(file_name, '._-', '   ')",
+    "audio_metadata": "coalesce(title, '') || ' ' || coalesce(artist, '') || ' ' || coalesce(album, '')",
+}
+
+
+def search_vector_sql(expression: str) -> str:
+    """SQL выражение search_vector: текст expression, разобранный каждой конфигурацией"""
+    return " || ".join(f"to_tsvector('{config}', {expression})" for config in SEARCH_CONFIGS)
+
+
+def _search_query_sql() -> str:
+    """tsquery запроса :q: совпадение по любой из конфигураций"""
+    return " || ".join(f"websearch_to_tsquery('{config}', :q)" for config in SEARCH_CONFIGS)
+
+
+# Совпадения из всех источников с рангом ts_rank_cd. Пост, найденный и по тексту, и по
+# файлам, - один результат с лучшим рангом. Порядок (rank, kind, id) по убыванию
+# однозначен, поэтому по нему работает курсор.
+_SEARCH_SQL = """
+    WITH search_query AS (
+        SELECT {query} AS tsq
+    ),
+    matches AS (
+        (SELECT 'post' AS kind, posts.id AS id, posts.id AS post_id,
+                ts_rank_cd(posts.search_vector, search_query.tsq) AS rank
+         FROM posts, search_query
+         WHERE posts.search_vector @@ search_query.tsq AND posts.is_deleted = false
+         ORDER BY posts.id DESC LIMIT :candidates)
+        UNION ALL
+        (SELECT 'post', posts.id, posts.id, ts_rank_cd(post_files.search_vector, search_query.tsq)
+         FROM post_files JOIN posts ON posts.id = post_files.post_id, search_query
+         WHERE post_files.search_vector @@ search_query.tsq AND posts.is_deleted = false
+         ORDER BY post_files.id DESC LIMIT :candidates)
+        UNION ALL
+        (SELECT 'post', posts.id, posts.id, ts_rank_cd(audio_metadata.search_vector, search_query.tsq)
+         FROM audio_metadata
+         JOIN post_files ON post_files.id = audio_metadata.post_file_id
+         JOIN posts ON posts.id = post_files.post_id, search_query
+         WHERE audio_metadata.search_vector @@ search_query.tsq AND posts.is_deleted = false
+         ORDER BY audio_metadata.post_file_id DESC LIMIT :candidates)
+        UNION ALL
+        (SELECT 'comment', comments.id, comments.post_id, ts_rank_cd(comments.search_vector, search_query.tsq)
+         FROM comments JOIN posts ON posts.id = comments.post_id, search_query
+         WHERE comments.search_vector @@ search_query.tsq AND comments.is_deleted = false AND posts.is_deleted = false
+         ORDER BY comments.id DESC LIMIT :candidates)
+    ),
+    results AS (
+        SELECT kind, id, post_id, MAX(rank) AS rank
+        FROM matches
+        GROUP BY kind, id, post_id
+    )
+    SELECT kind, id, post_id, rank
+    FROM results
+    {after}
+    ORDER BY rank DESC, kind DESC, id DESC
+    LIMIT :limit
+"""
+
+SEARCH_SQL = text(_SEARCH_SQL.format(query=_search_query_sql(), after=""))
+SEARCH_AFTER_SQL = text(_SEARCH_SQL.format(
+    query=_search_query_sql(),
+    after="WHERE (rank, kind, id) < (CAST(:after_rank AS REAL), :after_kind, :after_id)"
+))
+
+
+def search_board(db: Session, q: str, limit: int, after: Optional[Tuple[float, str, int]] = None) -> List[Row]:
+    """
+    Результаты поиска (kind, id, post_id, rank), лучшие сначала
+    kind - post (текст поста, имя файла или теги аудио) или comment; after - ключ
+    (rank, kind, id) последнего результата предыдущей страницы.
+    """
+    params = {"q": q, "limit": limit, "candidates": SEARCH_MAX_CANDIDATES}
+    if after is None:
+        return db.execute(SEARCH_SQL, params).all()
+    after_rank, after_kind, after_id = after
+    return db.execute(SEARCH_AFTER_SQL, {
+        **params, "after_rank": after_rank, "after_kind": after_kind, "after_id": after_id
+    }).all()
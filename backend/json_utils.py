@@ -0,0 +1,21 @@
+"""
+Быстрая сериализация JSON ответов через orjson
+
+Горячие ответы (лента, пост) собираются сериализатором сразу в словари
+формата PostResponse и кодируются напрямую, без повторной проверки по response_model.
+"""
+from typing import Any
+import orjson
+from fastapi.responses import JSONResponse
+
+
+def dumps(content: Any) -> bytes:
+    """JSON в байтах; datetime - ISO 8601, UTC как Z (как у pydantic)"""
+    return orjson.dumps(content, option=orjson.OPT_UTC_Z)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse с кодированием через orjson (содержимое не проверяется по схеме)"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
@@ -5,16 +6,37 @@ from fastapi.staticfiles import StaticFiles
 from database import init_db
 from api import routers
 from dependencies import http_bearer
+from feed_cache import feed_cache, start_feed_cache_listener, stop_feed_cache_listener
+from media_cache import audio_cache
+from media_pool import media_pool_stats, shutdown_media_pool
+from tasks import start_background_tasks, stop_background_tasks
+from votes import vote_buffer
 
 # Инициализация БД при старте
 init_db()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Запуск фоновых задач и прослушивания изменений доски при старте;
+    их остановка, запись накопленных голосов и остановка пула разбора файлов при завершении
+    """
+    start_background_tasks()
+    start_feed_cache_listener()
+    yield
+    stop_feed_cache_listener()
+    await stop_background_tasks()
+    shutdown_media_pool()
+
+
 app = FastAPI(
     title="Imageboard API",
     description="API для аналога имиджборда",
     version="1.0.0",
     docs_url="/docs",  # Swagger UI
-    redoc_url="/redoc"  # ReDoc
+    redoc_url="/redoc",  # ReDoc
+    lifespan=lifespan
 )
 
 
@@ -62,6 +84,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Location", "Upload-Offset", "Upload-Length", "X-Next-Cursor"],  # Для возобновляемой загрузки и курсора страниц
 )
 
 # Подключение статических файлов (должно быть ПЕРЕД роутерами, чтобы не конфликтовать)
@@ -151,3 +174,13 @@ def health_check():
     """Проверка здоровья приложения"""
     return {"status": "ok"}
 
+
+@app.get("/stats")
+def stats():
+    """Счётчики кэшей, пула разбора файлов и очереди голосов процесса (для мониторинга)"""
+    return {
+        "audio_cache": audio_cache.stats(),
+        "feed_cache": feed_cache.stats(),
+        "media_pool": media_pool_stats(),
+        "vote_buffer": vote_buffer.stats(),
+    }
@@ -0,0 +1,309 @@
+"""
+Служебные команды обслуживания хранилища файлов и БД
+
+Пример:
+    python manage.py shard-uploads --batch-size 500
+    python manage.py shard-uploads --dry-run
+    python manage.py reconcile --dry-run
+    python manage.py backfill-metadata --batch-size 100
+    python manage.py repair-counters --batch-size 1000
+"""
+import argparse
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Tuple
+from sqlalchemy import and_, case, func, or_, select, update
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from feed_cache import mark_board_changed, touch_posts
+from models import AudioMetadata, Comment, FileBlob, PendingDeletion, Post, PostFile
+from file_utils import get_file_path, get_sharded_path, is_sharded_path, list_previews
+from audio_utils import read_audio_metadata, set_audio_metadata
+from reconcile import RECONCILE_FILES_PER_SECOND, reconcile_uploads
+
+
+def _link_file(source: Path, destination: Path) -> None:
+    """Делает файл доступным по новому пути: жёсткая ссылка, а если она невозможна - копия"""
+    if destination.exists():
+        return
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        pass
+    except OSError:
+        temp_path = destination.with_name(f"{destination.name}.{uuid.uuid4().hex}.part")
+        try:
+            shutil.copy2(source, temp_path)
+            os.replace(temp_path, destination)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+
+def _rewrite_paths(db: Session, moved: Dict[str, str]) -> None:
+    """
+    Переписывает пути в file_blobs, post_files, posts и pending_deletions одним UPDATE на таблицу
+    Пометка к удалению переезжает вместе с файлом: иначе фоновая задача удалила бы
+    старый путь (его и так удалит _unlink_old_paths), а новый остался бы без ссылок.
+    """
+    for model in (FileBlob, PostFile, Post, PendingDeletion):
+        db.execute(
+            update(model)
+            .where(model.file_path.in_(list(moved)))
+            .values(file_path=case(moved, value=model.file_path))
+            .execution_options(synchronize_session=False)
+        )
+    # Пути файлов есть в ответах ленты (и в старых полях постов старого формата)
+    new_paths = list(moved.values())
+    post_ids = [post_id for (post_id,) in db.query(PostFile.post_id).filter(PostFile.file_path.in_(new_paths))]
+    post_ids += [post_id for (post_id,) in db.query(Post.id).filter(Post.file_path.in_(new_paths))]
+    touch_posts(db, post_ids)
+
+
+def _shard_batch(db: Session, paths: List[str], dry_run: bool) -> Dict[str, str]:
+    """
+    Переносит файлы пачки в разбитую раскладку
+    Файл (и его уменьшенные копии) сначала становится доступен по новому пути,
+    затем в той же транзакции переписываются пути в БД. Старые пути удаляются позже.
+    """
+    moved = {}
+    for old_path in paths:
+        new_path = get_sharded_path(old_path)
+        if new_path == old_path or old_path in moved:
+            continue
+
+        source = Path(old_path)
+        if not source.exists() and not Path(new_path).exists():
+            print(f"⚠ Файл не найден, путь не изменён: {old_path}")
+            continue
+
+        if not dry_run:
+            if source.exists():
+                _link_file(source, Path(new_path))
+            for preview_path in list_previews(old_path):
+                _link_file(preview_path, Path(new_path).parent / preview_path.name)
+        moved[old_path] = new_path
+
+    if moved and not dry_run:
+        _rewrite_paths(db, moved)
+    return moved
+
+
+def _unlink_old_paths(old_paths: List[str]) -> None:
+    """Удаляет старые пути файлов и их уменьшенных копий (данные остаются по новым путям)"""
+    for old_path in old_paths:
+        for preview_path in list_previews(old_path):
+            preview_path.unlink(missing_ok=True)
+        Path(old_path).unlink(missing_ok=True)
+
+
+def shard_uploads(batch_size: int, grace: float, dry_run: bool) -> int:
+    """
+    Переносит файлы из плоской раскладки uploads/<category>/<name>
+    в uploads/<category>/ab/cd/<name> без остановки сервиса
+
+    Проходит по file_blobs, затем по файлам старого формата (post_files без blob
+    и posts.file_path) пачками по batch_size строк. Каждая пачка - одна транзакция;
+    строки блокируются, чтобы параллельная загрузка или удаление того же файла
+    дождались её окончания. Старые пути удаляются не раньше чем через grace секунд
+    после коммита, чтобы запросы, успевшие прочитать старый путь, его нашли.
+    Возвращает: количество перенесённых файлов
+    """
+    sources = (
+        ("file_blobs", FileBlob, None),
+        ("post_files", PostFile, PostFile.blob_id.is_(None)),
+        ("posts", Post, Post.file_path.isnot(None)),
+    )
+    pending: List[Tuple[float, List[str]]] = []
+    total = 0
+
+    db = SessionLocal()
+    try:
+        for table_name, model, condition in sources:
+            last_id = 0
+            while True:
+                query = db.query(model.id, model.file_path).filter(model.id > last_id)
+                if condition is not None:
+                    query = query.filter(condition)
+                rows = query.order_by(model.id).limit(batch_size).with_for_update(of=model).all()
+                if not rows:
+                    db.rollback()
+                    break
+                last_id = rows[-1].id
+
+                paths = [row.file_path for row in rows if row.file_path and not is_sharded_path(row.file_path)]
+                moved = _shard_batch(db, paths, dry_run)
+                if dry_run:
+                    db.rollback()
+                else:
+                    db.commit()
+
+                if moved:
+                    total += len(moved)
+                    pending.append((time.monotonic(), list(moved)))
+                    print(f"✓ {table_name}: перенесено {len(moved)} файлов (до id {last_id})")
+
+                # Удаляем старые пути пачек, закоммиченных более grace секунд назад
+                while pending and time.monotonic() - pending[0][0] >= grace:
+                    _, old_paths = pending.pop(0)
+                    if not dry_run:
+                        _unlink_old_paths(old_paths)
+    finally:
+        db.close()
+
+    if pending and not dry_run:
+        time.sleep(max(0.0, grace - (time.monotonic() - pending[-1][0])))
+        for _, old_paths in pending:
+            _unlink_old_paths(old_paths)
+
+    print(f"{'Будет перенесено' if dry_run else 'Перенесено'} файлов: {total}")
+    return total
+
+
+def backfill_metadata(batch_size: int) -> int:
+    """
+    Извлекает метаданные аудио файлов, загруженных до появления таблицы audio_metadata,
+    и переносит в хранилище обложек обложки записей, созданных до его появления
+    Файлы обрабатываются пачками по batch_size, каждая пачка - одна транзакция.
+    Если файла нет на диске или разбор не удался (таймаут, перезапуск пула процессов),
+    запись не создаётся и не меняется: файл обработает следующий запуск или первый запрос метаданных.
+    Возвращает: количество обработанных файлов
+    """
+    total = 0
+    missing = 0
+    failed = 0
+    last_id = 0
+
+    db = SessionLocal()
+    try:
+        while True:
+            post_files = db.query(PostFile).outerjoin(AudioMetadata).filter(
+                PostFile.id > last_id,
+                PostFile.file_type.like("audio/%"),
+                or_(
+                    AudioMetadata.post_file_id.is_(None),
+                    and_(AudioMetadata.has_cover == True, AudioMetadata.cover_hash.is_(None))
+                )
+            ).order_by(PostFile.id).limit(batch_size).all()
+            if not post_files:
+                break
+            last_id = post_files[-1].id
+
+            for post_file in post_files:
+                file_path = get_file_path(post_file.file_path)
+                if not file_path or not file_path.exists():
+                    missing += 1
+                    continue
+                try:
+                    metadata = read_audio_metadata(file_path, post_file.file_type, raise_errors=True)
+                except Exception as e:
+                    print(f"⚠ Не удалось разобрать {post_file.file_path}: {e}")
+                    failed += 1
+                    continue
+                set_audio_metadata(post_file, metadata)
+                total += 1
+            db.commit()
+            print(f"✓ post_files: обработано {total} файлов (до id {last_id})")
+    finally:
+        db.close()
+
+    if missing:
+        print(f"⚠ Файлов нет на диске: {missing}")
+    if failed:
+        print(f"⚠ Не удалось разобрать файлов (будут обработаны повторно): {failed}")
+    print(f"Извлечены метаданные файлов: {total}")
+    return total
+
+
+def repair_counters(batch_size: int) -> int:
+    """
+    Пересчитывает posts.comment_count и posts.file_count по comments и post_files
+    Посты обрабатываются пачками по batch_size, каждая пачка - одна транзакция. Строки пачки
+    блокируются до пересчёта, поэтому комментарии и файлы, добавляемые параллельно, не теряются.
+    Возвращает: количество исправленных постов
+    """
+    comment_count = select(func.count(Comment.id)).where(
+        Comment.post_id == Post.id, Comment.is_deleted == False
+    ).scalar_subquery()
+    file_count = select(func.count(PostFile.id)).where(PostFile.post_id == Post.id).scalar_subquery()
+    total = 0
+    last_id = 0
+
+    db = SessionLocal()
+    try:
+        while True:
+            post_ids = [post_id for (post_id,) in db.query(Post.id).filter(
+                Post.id > last_id
+            ).order_by(Post.id).limit(batch_size).with_for_update()]
+            if not post_ids:
+                break
+            last_id = post_ids[-1]
+
+            result = db.execute(
+                update(Post)
+                .where(Post.id.in_(post_ids), or_(Post.comment_count != comment_count, Post.file_count != file_count))
+                .values(comment_count=comment_count, file_count=file_count, updated_at=func.now())
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount:
+                mark_board_changed(db)
+            db.commit()
+            total += result.rowcount
+            print(f"✓ posts: исправлено {total} (до id {last_id})")
+    finally:
+        db.close()
+
+    print(f"Исправлено счётчиков постов: {total}")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Служебные команды imageboard")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    shard_parser = subparsers.add_parser(
+        "shard-uploads",
+        help="перенести файлы в раскладку uploads/<category>/ab/cd/ без остановки сервиса"
+    )
+    shard_parser.add_argument("--batch-size", type=int, default=500, help="строк БД в одной транзакции")
+    shard_parser.add_argument("--grace", type=float, default=10.0, help="через сколько секунд после коммита удалять старые пути")
+    shard_parser.add_argument("--dry-run", action="store_true", help="только показать, сколько файлов будет перенесено")
+
+    reconcile_parser = subparsers.add_parser(
+        "reconcile",
+        help="сверить файлы в uploads/ с БД: найти сирот и записи без файлов"
+    )
+    reconcile_parser.add_argument("--dry-run", action="store_true", help="только отчёт, без исправлений")
+    reconcile_parser.add_argument("--rate", type=int, default=RECONCILE_FILES_PER_SECOND, help="файлов в секунду")
+
+    backfill_parser = subparsers.add_parser(
+        "backfill-metadata",
+        help="извлечь метаданные аудио файлов, у которых их ещё нет в audio_metadata"
+    )
+    backfill_parser.add_argument("--batch-size", type=int, default=100, help="файлов в одной транзакции")
+
+    counters_parser = subparsers.add_parser(
+        "repair-counters",
+        help="пересчитать количество комментариев и файлов постов (comment_count, file_count)"
+    )
+    counters_parser.add_argument("--batch-size", type=int, default=1000, help="постов в одной транзакции")
+
+    args = parser.parse_args()
+
+    if args.command == "shard-uploads":
+        shard_uploads(args.batch_size, args.grace, args.dry_run)
+    elif args.command == "reconcile":
+        if reconcile_uploads(fix=not args.dry_run, files_per_second=args.rate) is None:
+            print("⚠ Сверка уже выполняется в другом процессе")
+    elif args.command == "backfill-metadata":
+        backfill_metadata(args.batch_size)
+    elif args.command == "repair-counters":
+        repair_counters(args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
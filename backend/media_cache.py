@@ -0,0 +1,123 @@
+"""
+Кэш результатов разбора медиа файлов в памяти процесса
+
+Значения зависят только от содержимого файла, поэтому ключом служит (путь, размер, mtime):
+изменённый или заменённый файл получает новый ключ, а старая запись вытесняется.
+Объём кэша ограничен суммарным размером значений (обложки занимают сотни КБ).
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Set, Tuple
+
+# Максимальный объём кэша метаданных и обложек аудио (байты)
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES") or str(64 * 1024 * 1024))
+
+# Значения больше этой доли объёма не кэшируются, чтобы не вытеснять весь кэш одним файлом
+MAX_ENTRY_SHARE = 4
+
+
+def _normalize_path(file_path) -> str:
+    return os.path.normpath(str(file_path))
+
+
+class FileLRUCache:
+    """LRU-кэш значений, вычисленных по файлу на диске, с вытеснением по объёму"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, Tuple[object, int]]" = OrderedDict()
+        self._keys_by_path: Dict[str, Set[tuple]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(
+        self,
+        kind: Hashable,
+        file_path,
+        compute: Callable[[], object],
+        sizeof: Callable[[object], int]
+    ):
+        """
+        Значение вида kind для файла: из кэша или вычисленное compute()
+        sizeof оценивает объём значения в байтах. Если файла нет, кэш не используется.
+        """
+        path = _normalize_path(file_path)
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return compute()
+
+        key = (kind, path, stat_result.st_size, stat_result.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Разбор файла - вне блокировки: параллельные промахи по одному файлу допустимы
+        value = compute()
+        self._put(key, path, value, sizeof(value))
+        return value
+
+    def _put(self, key: tuple, path: str, value: object, size: int) -> None:
+        if size > self.max_bytes // MAX_ENTRY_SHARE:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            # Записи той же пары (путь, вид) для прежней версии файла больше не нужны
+            for stale_key in [k for k in self._keys_by_path.get(path, ()) if k[0] == key[0]]:
+                self._remove(stale_key)
+            self._entries[key] = (value, size)
+            self._keys_by_path.setdefault(path, set()).add(key)
+            self._size += size
+            while self._size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: tuple) -> None:
+        _, size = self._entries.pop(key)
+        self._size -= size
+        keys = self._keys_by_path.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_path[key[1]]
+
+    def invalidate(self, file_path) -> None:
+        """Удаляет из кэша все значения для файла (вызывается при удалении файла)"""
+        path = _normalize_path(file_path)
+        with self._lock:
+            for key in list(self._keys_by_path.get(path, ())):
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_path.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """Счётчики кэша для мониторинга"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / requests, 4) if requests else None,
+            }
+
+
+# Метаданные и обложки аудио файлов, которые не хранятся в БД (посты старого формата)
+audio_cache = FileLRUCache(AUDIO_CACHE_MAX_BYTES)
@@ -0,0 +1,127 @@
+"""
+Пул процессов для разбора медиа файлов (Mutagen и т.п.)
+
+Разбор файла нагружает CPU и держит GIL, поэтому выполняется не в потоках сервера,
+а в отдельных процессах. Число процессов и время одной задачи ограничены: если задача
+зависла или процесс упал на повреждённом файле, ошибку получает только эта задача,
+а пул пересоздаётся. Задачи, оказавшиеся в сломанном пуле случайно, повторяются один раз.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+# Число процессов разбора; 0 - разбирать в вызывающем потоке (без пула)
+MEDIA_POOL_SIZE = int(os.getenv("MEDIA_POOL_SIZE") or "2")
+
+# Максимальное время разбора одного файла (секунды)
+MEDIA_JOB_TIMEOUT = float(os.getenv("MEDIA_JOB_TIMEOUT") or "15")
+
+# Процесс пула перезапускается после стольких задач (ограничивает рост памяти)
+MEDIA_POOL_MAX_TASKS_PER_CHILD = 500
+
+_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+_restarts = 0
+
+
+class MediaJobError(Exception):
+    """Задача разбора не выполнена: таймаут или падение процесса пула"""
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawn: процессы не наследуют соединения с БД и потоки сервера
+            _executor = ProcessPoolExecutor(
+                max_workers=MEDIA_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=MEDIA_POOL_MAX_TASKS_PER_CHILD,
+            )
+        return _executor
+
+
+def _restart(executor: ProcessPoolExecutor) -> None:
+    """Останавливает процессы сломанного или зависшего пула; новый создаётся при следующей задаче"""
+    global _executor, _restarts
+    with _lock:
+        if _executor is not executor:
+            return
+        _executor = None
+        _restarts += 1
+
+    # У ProcessPoolExecutor нет способа прервать одну задачу - завершаем его процессы
+    for process in list((getattr(executor, "_processes", None) or {}).values()):
+        process.kill()
+    executor.shutdown(wait=False, cancel_futures=True)
+    print("⚠ Пул разбора медиа файлов перезапущен")
+
+
+def _submit(func: Callable, args: tuple):
+    """Ставит задачу в пул; возвращает (пул, future)"""
+    executor = _get_executor()
+    try:
+        return executor, executor.submit(func, *args)
+    except (BrokenProcessPool, RuntimeError):
+        # Пул сломан другой задачей или уже остановлен - ставим в новый
+        _restart(executor)
+        executor = _get_executor()
+        return executor, executor.submit(func, *args)
+
+
+def run_media_job(func: Callable, *args, timeout: float = MEDIA_JOB_TIMEOUT):
+    """
+    Выполняет func(*args) в пуле процессов и ждёт результата (вызывать из потока, не из event loop)
+    func должна быть функцией уровня модуля без зависимостей от приложения (см. media_probe.py).
+    Исключения func пробрасываются; при таймауте или падении процесса - MediaJobError.
+    """
+    if MEDIA_POOL_SIZE <= 0:
+        return func(*args)
+
+    for attempt in range(2):
+        executor, future = _submit(func, args)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            _restart(executor)
+            raise MediaJobError(f"Разбор файла не уложился в {timeout} с")
+        except BrokenProcessPool:
+            _restart(executor)
+            if attempt:
+                raise MediaJobError("Процесс разбора файла аварийно завершился")
+
+
+async def run_media_job_async(func: Callable, *args, timeout: float = MEDIA_JOB_TIMEOUT):
+    """run_media_job для event loop: ожидание не занимает поток"""
+    if MEDIA_POOL_SIZE <= 0:
+        return await asyncio.to_thread(func, *args)
+
+    for attempt in range(2):
+        executor, future = _submit(func, args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            _restart(executor)
+            raise MediaJobError(f"Разбор файла не уложился в {timeout} с")
+        except BrokenProcessPool:
+            _restart(executor)
+            if attempt:
+                raise MediaJobError("Процесс разбора файла аварийно завершился")
+
+
+def shutdown_media_pool() -> None:
+    """Останавливает пул (вызывается при завершении приложения)"""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def media_pool_stats() -> dict:
+    """Состояние пула для мониторинга"""
+    return {"size": MEDIA_POOL_SIZE, "timeout": MEDIA_JOB_TIMEOUT, "restarts": _restarts}
@@ -0,0 +1,195 @@
+"""
+Разбор аудио файлов через Mutagen
+
+Функции модуля выполняются в процессах пула media_pool.py, поэтому модуль не импортирует
+ничего, кроме Mutagen: ни БД, ни приложения. Результаты - простые типы (dict, bytes).
+"""
+from mutagen import File as MutagenFile
+from mutagen.flac import FLAC
+from pathlib import Path
+from typing import Optional
+
+
+def open_audio_file(file_path: Path, file_type: str):
+    """Открывает аудио файл через Mutagen; возвращает None, если файл не найден или не распознан"""
+    # Убеждаемся, что путь абсолютный
+    if not file_path.is_absolute():
+        # Если путь относительный, делаем его абсолютным от текущей рабочей директории
+        # В Docker контейнере рабочая директория - /app
+        file_path = Path.cwd() / file_path
+    
+    # Проверяем существование файла
+    if not file_path.exists():
+        print(f"Файл не найден: {file_path} (абсолютный путь)")
+        # Пробуем найти файл относительно /app
+        alt_path = Path("/app") / file_path
+        if alt_path.exists():
+            file_path = alt_path
+            print(f"Файл найден по альтернативному пути: {file_path}")
+        else:
+            return None
+    
+    # Открываем файл через Mutagen
+    # Для FLAC используем специальный класс FLAC для лучшей поддержки
+    if file_type and 'flac' in file_type.lower():
+        try:
+            audio_file = FLAC(str(file_path))
+        except Exception as e:
+            print(f"Ошибка открытия FLAC файла через FLAC класс: {e}, пробуем MutagenFile")
+            # Пробуем через общий MutagenFile
+            audio_file = MutagenFile(str(file_path))
+    else:
+        audio_file = MutagenFile(str(file_path))
+    
+    if audio_file is None:
+        print(f"Не удалось открыть файл через Mutagen: {file_path}")
+        return None
+    
+    return audio_file
+
+
+def extract_cover_data(audio_file) -> Optional[bytes]:
+    """Возвращает байты встроенной обложки аудио файла (ID3 APIC, FLAC/OGG pictures)"""
+    cover_data = None
+    try:
+        # Для MP3 файлов (ID3 теги)
+        if hasattr(audio_file, 'tags') and audio_file.tags:
+            # Пытаемся найти APIC (обложку) в ID3 тегах
+            for key in list(audio_file.tags.keys()):
+                if key.startswith('APIC') or key == 'APIC:':
+                    apic = audio_file.tags[key]
+                    if hasattr(apic, 'data'):
+                        cover_data = apic.data
+                        break
+                    elif isinstance(apic, list) and len(apic) > 0:
+                        if hasattr(apic[0], 'data'):
+                            cover_data = apic[0].data
+                            break
+        
+        # Для FLAC файлов - используем специальный метод
+        if cover_data is None and isinstance(audio_file, FLAC):
+            # FLAC хранит обложки в pictures (атрибут объекта FLAC)
+            try:
+                if hasattr(audio_file, 'pictures') and audio_file.pictures:
+                    if len(audio_file.pictures) > 0:
+                        # pictures - это список Picture объектов
+                        pic = audio_file.pictures[0]
+                        if hasattr(pic, 'data'):
+                            cover_data = pic.data
+                            print(f"Обложка найдена через FLAC.pictures: {len(cover_data)} байт")
+            except Exception as e:
+                print(f"Ошибка при извлечении обложки из FLAC.pictures: {e}")
+                import traceback
+                traceback.print_exc()
+        
+        # Для OGG и других форматов
+        if cover_data is None and hasattr(audio_file, 'pictures'):
+            if audio_file.pictures:
+                cover_data = audio_file.pictures[0].data
+                
+    except Exception as e:
+        print(f"Ошибка извлечения обложки: {e}")
+        import traceback
+        traceback.print_exc()
+        cover_data = None
+    
+    return cover_data
+
+
+def extract_tags(audio_file) -> dict:
+    """Название, исполнитель и альбом из тегов ID3 / Vorbis"""
+    metadata = {}
+    
+    # Название трека
+    title = None
+    if hasattr(audio_file, 'tags') and audio_file.tags:
+        # Для MP3 (ID3 теги)
+        if 'TIT2' in audio_file.tags:
+            title = str(audio_file.tags['TIT2'][0])
+        elif 'TITLE' in audio_file.tags:
+            title = str(audio_file.tags['TITLE'][0])
+    
+    # Для FLAC и других форматов (Vorbis комментарии)
+    if not title:
+        if 'TITLE' in audio_file:
+            title_list = audio_file.get('TITLE', [])
+            title = str(title_list[0]) if title_list else None
+        elif hasattr(audio_file, 'title'):
+            title_val = audio_file.title
+            title = str(title_val[0]) if isinstance(title_val, list) else str(title_val)
+    
+    metadata['title'] = title
+    
+    # Исполнитель
+    artist = None
+    if hasattr(audio_file, 'tags') and audio_file.tags:
+        # Для MP3 (ID3 теги)
+        if 'TPE1' in audio_file.tags:
+            artist = str(audio_file.tags['TPE1'][0])
+        elif 'ARTIST' in audio_file.tags:
+            artist = str(audio_file.tags['ARTIST'][0])
+    
+    # Для FLAC и других форматов
+    if not artist:
+        if 'ARTIST' in audio_file:
+            artist_list = audio_file.get('ARTIST', [])
+            artist = str(artist_list[0]) if artist_list else None
+        elif hasattr(audio_file, 'artist'):
+            artist_val = audio_file.artist
+            artist = str(artist_val[0]) if isinstance(artist_val, list) else str(artist_val)
+    
+    metadata['artist'] = artist
+    
+    # Альбом
+    album = None
+    if hasattr(audio_file, 'tags') and audio_file.tags:
+        # Для MP3 (ID3 теги)
+        if 'TALB' in audio_file.tags:
+            album = str(audio_file.tags['TALB'][0])
+        elif 'ALBUM' in audio_file.tags:
+            album = str(audio_file.tags['ALBUM'][0])
+    
+    # Для FLAC и других форматов
+    if not album:
+        if 'ALBUM' in audio_file:
+            album_list = audio_file.get('ALBUM', [])
+            album = str(album_list[0]) if album_list else None
+        elif hasattr(audio_file, 'album'):
+            album_val = audio_file.album
+            album = str(album_val[0]) if isinstance(album_val, list) else str(album_val)
+    
+    metadata['album'] = album
+    
+    return metadata
+
+
+def parse_audio_file(file_path: str, file_type: str, with_cover: bool = True) -> Optional[dict]:
+    """
+    Теги, длительность, битрейт и обложка аудио файла
+    Возвращает: {"title", "artist", "album", "duration", "bitrate", "cover": bytes или None}
+    (при with_cover=False вместо байтов обложки - True, если она есть) или None,
+    если файл не распознан
+    """
+    audio_file = open_audio_file(Path(file_path), file_type)
+    if audio_file is None:
+        return None
+    
+    parsed = extract_tags(audio_file)
+    
+    info = getattr(audio_file, 'info', None)
+    length = getattr(info, 'length', None)
+    bitrate = getattr(info, 'bitrate', None)
+    parsed['duration'] = float(length) if length else None
+    parsed['bitrate'] = int(bitrate) if bitrate else None
+    
+    cover_data = extract_cover_data(audio_file)
+    parsed['cover'] = cover_data if with_cover else cover_data is not None
+    return parsed
+
+
+def read_audio_cover(file_path: str, file_type: str) -> Optional[bytes]:
+    """Байты встроенной обложки аудио файла"""
+    audio_file = open_audio_file(Path(file_path), file_type)
+    if audio_file is None:
+        return None
+    return extract_cover_data(audio_file)
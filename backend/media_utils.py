@@ -0,0 +1,374 @@
+"""
+Отдача файлов постов с диска: потоковая передача без чтения файла целиком в память
+"""
+import os
+import secrets
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+from file_utils import UPLOAD_DIR
+
+load_dotenv()
+
+# Размер блока при потоковой передаче (память на запрос не зависит от размера файла)
+CHUNK_SIZE = 64 * 1024
+
+# Максимальное число диапазонов в одном Range-запросе (защита от злоупотреблений)
+MAX_RANGES = 16
+
+# Файлы в uploads/ имеют уникальные имена и никогда не перезаписываются
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Для URL, за которым может оказаться другой файл - кэшируем с обязательной ревалидацией
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+# Отдача байтов файла через reverse proxy: backend только проверяет доступ и возвращает заголовок
+#   "" - файлы отдаёт сам backend
+#   "x-sendfile" - Apache (mod_xsendfile) или lighttpd, заголовок X-Sendfile с путём к файлу
+#   "x-accel-redirect" - nginx, заголовок X-Accel-Redirect с URI internal location
+MEDIA_OFFLOAD = os.getenv("MEDIA_OFFLOAD", "").strip().lower()
+# Для x-sendfile - путь к uploads/ на машине прокси (по умолчанию путь на машине backend),
+# для x-accel-redirect - префикс internal location, указывающей на uploads/
+MEDIA_OFFLOAD_PREFIX = os.getenv("MEDIA_OFFLOAD_PREFIX") or (
+    "/internal-uploads" if MEDIA_OFFLOAD == "x-accel-redirect" else str(UPLOAD_DIR.resolve())
+)
+
+
+def is_media_type(media_type: str) -> bool:
+    """Проверяет, отображается ли файл в браузере (изображение, видео, аудио)"""
+    return (
+        media_type.startswith('image/') or
+        media_type.startswith('video/') or
+        media_type.startswith('audio/')
+    )
+
+
+def safe_media_type(media_type: str) -> str:
+    """
+    MIME type для заголовков ответа: он сохранён со слов клиента при загрузке, поэтому
+    значение не из печатных ASCII символов (не кодируется в latin-1, перевод строки)
+    заменяется на application/octet-stream
+    """
+    if media_type and "/" in media_type and all(" " <= char <= "~" for char in media_type):
+        return media_type
+    return "application/octet-stream"
+
+
+def build_content_disposition(filename: str, inline: bool) -> str:
+    """Формирует заголовок Content-Disposition, кодируя имя файла согласно RFC 5987"""
+    disposition = "inline" if inline else "attachment"
+    try:
+        filename_ascii = filename.encode('ascii', 'ignore').decode('ascii')
+        if not filename_ascii or filename_ascii != filename or '"' in filename:
+            filename_encoded = quote(filename, safe='')
+            return f"{disposition}; filename*=UTF-8''{filename_encoded}"
+        return f'{disposition}; filename="{filename_ascii}"'
+    except Exception:
+        return f'{disposition}; filename="file"'
+
+
+def parse_range_header(range_header: Optional[str], file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Разбирает заголовок Range (формат: bytes=start-end, bytes=start-, bytes=-suffix, через запятую)
+    Возвращает: список диапазонов (start, end) включительно или None, если заголовок
+    отсутствует или некорректен
+    """
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+
+    specs = range_header[len('bytes='):].split(',')
+    if len(specs) > MAX_RANGES:
+        # Слишком много диапазонов - отдаём файл целиком
+        return None
+
+    ranges = []
+    try:
+        for spec in specs:
+            start_str, end_str = spec.strip().split('-', 1)
+            if start_str:
+                start = int(start_str)
+                end = int(end_str) if end_str else file_size - 1
+                if start < 0 or end < start:
+                    return None
+            else:
+                # Суффиксный диапазон: последние N байт файла
+                suffix_length = int(end_str)
+                if suffix_length <= 0:
+                    continue
+                start = max(file_size - suffix_length, 0)
+                end = file_size - 1
+
+            # Неудовлетворимые диапазоны пропускаем
+            if start < file_size:
+                ranges.append((start, min(end, file_size - 1)))
+    except ValueError:
+        # Некорректный заголовок игнорируем и отдаём файл целиком
+        return None
+
+    if not ranges:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Range Not Satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+
+    return ranges
+
+
+def make_etag(stat_result: os.stat_result) -> str:
+    """Строгий ETag из идентичности файла (размер и время изменения)"""
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(header_value: str, etag: str, weak: bool = True) -> bool:
+    """Сравнивает ETag с заголовком If-None-Match/If-Range (список значений или *)"""
+    if header_value.strip() == '*':
+        return True
+    for candidate in header_value.split(','):
+        candidate = candidate.strip()
+        if weak:
+            # Слабое сравнение: W/ у обоих значений не учитывается
+            candidate = candidate.removeprefix('W/')
+            etag = etag.removeprefix('W/')
+        if candidate == etag:
+            return True
+    return False
+
+
+def _parse_http_date(value: Optional[str]) -> Optional[int]:
+    """Разбирает HTTP-дату в Unix timestamp (секунды)"""
+    if not value:
+        return None
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def is_not_modified(request_headers: Headers, etag: str, last_modified: int) -> bool:
+    """Проверяет условные заголовки запроса (RFC 9110): можно ли ответить 304"""
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match имеет приоритет, If-Modified-Since в этом случае игнорируется
+        return etag_matches(if_none_match, etag)
+
+    if_modified_since = _parse_http_date(request_headers.get("if-modified-since"))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def _if_range_allows(request_headers: Headers, etag: str, last_modified: int) -> bool:
+    """Проверяет If-Range: частичный ответ допустим, только если представление не изменилось"""
+    if_range = request_headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Для If-Range допустимо только строгое сравнение
+        return etag_matches(if_range, etag, weak=False) and if_range != '*'
+    return _parse_http_date(if_range) == last_modified
+
+
+class MediaFileResponse(Response):
+    """
+    Потоковый ответ с частями файла на диске
+
+    Каждая часть - (префикс, смещение, длина): префикс отправляется как есть (заголовки
+    частей multipart/byteranges), затем указанный диапазон файла. Если ASGI-сервер
+    поддерживает расширения zerocopysend/pathsend, передача идёт через sendfile;
+    иначе файл читается блоками по CHUNK_SIZE в отдельном потоке.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        media_type: str,
+        parts: List[Tuple[bytes, int, int]],
+        trailer: bytes = b"",
+        status_code: int = status.HTTP_200_OK,
+        headers: Optional[dict] = None
+    ):
+        self.path = str(path)
+        self.parts = parts
+        self.trailer = trailer
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.body = b""
+        headers = dict(headers or {})
+        content_length = sum(len(prefix) + count for prefix, _, count in parts) + len(trailer)
+        headers["Content-Length"] = str(content_length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get("extensions") or {}
+
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+
+        if scope.get("method", "GET").upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        if (
+            self.status_code == status.HTTP_200_OK
+            and "http.response.pathsend" in extensions
+            and "http.response.zerocopysend" not in extensions
+        ):
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+
+        if "http.response.zerocopysend" in extensions:
+            with open(self.path, "rb") as file:
+                for prefix, offset, count in self.parts:
+                    if prefix:
+                        await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": file,
+                        "offset": offset,
+                        "count": count,
+                        "more_body": True,
+                    })
+            await send({"type": "http.response.body", "body": self.trailer, "more_body": False})
+            return
+
+        async with await anyio.open_file(self.path, "rb") as file:
+            for prefix, offset, count in self.parts:
+                if prefix:
+                    await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                await file.seek(offset)
+                remaining = count
+                while remaining > 0:
+                    chunk = await file.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+        await send({"type": "http.response.body", "body": self.trailer, "more_body": False})
+
+
+def offload_response(
+    file_path: Path,
+    media_type: str,
+    filename: str,
+    immutable: bool = True
+) -> Optional[Response]:
+    """
+    Формирует пустой ответ с X-Sendfile/X-Accel-Redirect, по которому файл отдаёт прокси
+
+    Прокси сам обрабатывает Range и условные запросы. Возвращает None, если режим
+    отключён или файл лежит вне uploads/ (тогда файл отдаёт backend).
+    """
+    if MEDIA_OFFLOAD not in ("x-sendfile", "x-accel-redirect"):
+        return None
+
+    try:
+        relative_path = file_path.resolve().relative_to(UPLOAD_DIR.resolve()).as_posix()
+    except ValueError:
+        return None
+
+    headers = {
+        "Content-Disposition": build_content_disposition(filename, inline=is_media_type(media_type)),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+    }
+
+    prefix = MEDIA_OFFLOAD_PREFIX.rstrip('/')
+    if MEDIA_OFFLOAD == "x-sendfile":
+        headers["X-Sendfile"] = f"{prefix}/{relative_path}"
+    else:
+        headers["X-Accel-Redirect"] = quote(f"{prefix}/{relative_path}")
+
+    return Response(status_code=status.HTTP_200_OK, media_type=media_type, headers=headers)
+
+
+def media_file_response(
+    file_path: Path,
+    media_type: str,
+    filename: str,
+    request_headers: Headers,
+    immutable: bool = True,
+    etag: Optional[str] = None
+) -> Response:
+    """
+    Формирует ответ с файлом поста
+
+    Изображения, видео и аудио отдаются inline (чтобы Swagger UI и браузер могли их
+    отобразить), остальные файлы - как attachment. Поддерживаются валидаторы
+    (ETag, Last-Modified), условные запросы (304), If-Range и multipart/byteranges.
+    Файлы в uploads/ не меняются, поэтому по умолчанию ответ кэшируется как immutable;
+    для URL, содержимое которых может смениться, передаётся immutable=False.
+    Если включён MEDIA_OFFLOAD, байты файла отдаёт reverse proxy.
+    """
+    media_type = safe_media_type(media_type)
+    offloaded = offload_response(file_path, media_type, filename, immutable)
+    if offloaded is not None:
+        return offloaded
+
+    stat_result = file_path.stat()
+    file_size = stat_result.st_size
+    last_modified = int(stat_result.st_mtime)
+    etag = etag or make_etag(stat_result)
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+    }
+
+    if is_not_modified(request_headers, etag, last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    headers["Content-Disposition"] = build_content_disposition(filename, inline=is_media_type(media_type))
+
+    ranges = None
+    if _if_range_allows(request_headers, etag, last_modified):
+        ranges = parse_range_header(request_headers.get("range"), file_size)
+
+    if not ranges:
+        return MediaFileResponse(file_path, media_type, [(b"", 0, file_size)], headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        return MediaFileResponse(
+            file_path,
+            media_type,
+            [(b"", start, end - start + 1)],
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            headers=headers
+        )
+
+    # Несколько диапазонов - multipart/byteranges (RFC 9110, раздел 14.6)
+    boundary = secrets.token_hex(16)
+    parts = []
+    for index, (start, end) in enumerate(ranges):
+        # Каждая часть, кроме первой, отделяется от данных предыдущей переводом строки
+        separator = "" if index == 0 else "\r\n"
+        part_header = (
+            f"{separator}--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+        )
+        parts.append((part_header.encode("latin-1"), start, end - start + 1))
+    trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+
+    return MediaFileResponse(
+        file_path,
+        f"multipart/byteranges; boundary={boundary}",
+        parts,
+        trailer=trailer,
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        headers=headers
+    )
@@ -3,6 +3,7 @@
 """
 from sqlalchemy import text
 from database import engine
+from fulltext import SEARCH_COLUMNS, search_vector_sql
 
 
 def migrate_posts_table():
@@ -117,6 +118,58 @@ def migrate_posts_table():
                 conn.execute(text("ALTER TABLE posts ALTER COLUMN text DROP NOT NULL"))
                 print("✓ Колонка 'text' теперь nullable")
             
+            # Категория поста для фильтра ленты (по MIME type первого файла)
+            result = conn.execute(text("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name = 'posts' AND column_name = 'category'
+            """))
+            
+            if not result.fetchone():
+                conn.execute(text("ALTER TABLE posts ADD COLUMN category VARCHAR(20) NOT NULL DEFAULT 'text'"))
+                conn.execute(text("""
+                    UPDATE posts SET category = CASE
+                        WHEN file_type LIKE 'image/%' THEN 'image'
+                        WHEN file_type LIKE 'video/%' THEN 'video'
+                        WHEN file_type LIKE 'audio/%' THEN 'audio'
+                        ELSE 'other'
+                    END
+                    WHERE file_type IS NOT NULL AND file_type <> ''
+                """))
+                print("✓ Добавлена колонка 'category'")
+            
+            # Денормализованные счётчики для ленты (см. manage.py repair-counters)
+            result = conn.execute(text("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name = 'posts' AND column_name = 'comment_count'
+            """))
+            
+            if not result.fetchone():
+                conn.execute(text("ALTER TABLE posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0"))
+                conn.execute(text("""
+                    UPDATE posts SET comment_count = (
+                        SELECT COUNT(*) FROM comments
+                        WHERE comments.post_id = posts.id AND comments.is_deleted = false
+                    )
+                """))
+                print("✓ Добавлена колонка 'comment_count'")
+            
+            result = conn.execute(text("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name = 'posts' AND column_name = 'file_count'
+            """))
+            
+            if not result.fetchone():
+                conn.execute(text("ALTER TABLE posts ADD COLUMN file_count INTEGER NOT NULL DEFAULT 0"))
+                conn.execute(text("""
+                    UPDATE posts SET file_count = (
+                        SELECT COUNT(*) FROM post_files WHERE post_files.post_id = posts.id
+                    )
+                """))
+                print("✓ Добавлена колонка 'file_count'")
+            
             # Проверяем, существует ли таблица post_files
             result = conn.execute(text("""
                 SELECT EXISTS (
@@ -180,6 +233,214 @@ def migrate_posts_table():
         # Не поднимаем исключение, чтобы приложение могло запуститься
 
 
+def migrate_post_files_table():
+    """Миграция таблицы post_files: хэш содержимого, ссылка на blob и уменьшенные копии"""
+    try:
+        with engine.begin() as conn:
+            result = conn.execute(text("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name = 'post_files' AND column_name = 'content_hash'
+            """))
+            
+            if not result.fetchone():
+                conn.execute(text("ALTER TABLE post_files ADD COLUMN content_hash VARCHAR(64)"))
+                print("✓ Добавлена колонка 'content_hash' в 'post_files'")
+            
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_post_files_content_hash ON post_files(content_hash)"))
+            
+            # Ссылка на общий файл в хранилище, адресуемом по содержимому
+            result = conn.execute(text("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name = 'post_files' AND column_name = 'blob_id'
+            """))
+            
+            if not result.fetchone():
+                conn.execute(text("""
+                    ALTER TABLE post_files 
+                    ADD COLUMN blob_id INTEGER REFERENCES file_blobs(id) ON DELETE SET NULL
+                """))
+                print("✓ Добавлена колонка 'blob_id' в 'post_files'")
+            
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_post_files_blob_id ON post_files(blob_id)"))
+            
+            # Уменьшенные копии изображений и обложек
+            for column_name, column_type in (("preview_widths", "VARCHAR(50)"), ("preview_format", "VARCHAR(10)")):
+                result = conn.execute(text(f"""
+                    SELECT column_name 
+                    FROM information_schema.columns 
+                    WHERE table_name = 'post_files' AND column_name = '{column_name}'
+                """))
+                
+                if not result.fetchone():
+                    conn.execute(text(f"ALTER TABLE post_files ADD COLUMN {column_name} {column_type}"))
+                    print(f"✓ Добавлена колонка '{column_name}' в 'post_files'")
+            
+            # Очередь фонового построения копий: файлы, для которых копии ещё не построены
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_post_files_preview_pending 
+                ON post_files(id) WHERE preview_widths IS NULL
+            """))
+            
+    except Exception as e:
+        print(f"Ошибка при выполнении миграции post_files: {e}")
+
+
+def migrate_audio_metadata_table():
+    """Миграция таблицы audio_metadata: обложка в хранилище обложек"""
+    try:
+        with engine.begin() as conn:
+            for column_name, column_type in (
+                ("cover_hash", "VARCHAR(64)"),
+                ("cover_path", "VARCHAR(500)"),
+                ("cover_type", "VARCHAR(50)"),
+            ):
+                result = conn.execute(text(f"""
+                    SELECT column_name 
+                    FROM information_schema.columns 
+                    WHERE table_name = 'audio_metadata' AND column_name = '{column_name}'
+                """))
+                
+                if not result.fetchone():
+                    conn.execute(text(f"ALTER TABLE audio_metadata ADD COLUMN {column_name} {column_type}"))
+                    print(f"✓ Добавлена колонка '{column_name}' в 'audio_metadata'")
+            
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_audio_metadata_cover_hash ON audio_metadata(cover_hash)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_audio_metadata_cover_path ON audio_metadata(cover_path)"))
+            
+    except Exception as e:
+        print(f"Ошибка при выполнении миграции audio_metadata: {e}")
+
+
+def migrate_file_path_indexes():
+    """Индексы на пути к файлам: по ним сверяются файлы на диске с записями в БД"""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_posts_file_path ON posts(file_path)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_post_files_file_path ON post_files(file_path)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_file_blobs_file_path ON file_blobs(file_path)"))
+            print("✓ Индексы на пути к файлам созданы")
+    except Exception as e:
+        print(f"Ошибка при создании индексов на пути к файлам: {e}")
+
+
+def migrate_updated_at_columns():
+    """Миграция posts и comments: колонка updated_at для ETag ответов (заполняется датой создания)"""
+    try:
+        with engine.begin() as conn:
+            for table_name in ("posts", "comments"):
+                result = conn.execute(text("""
+                    SELECT column_name 
+                    FROM information_schema.columns 
+                    WHERE table_name = :table_name AND column_name = 'updated_at'
+                """), {"table_name": table_name})
+                
+                if not result.fetchone():
+                    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()"))
+                    conn.execute(text(f"UPDATE {table_name} SET updated_at = date"))
+                    print(f"✓ Добавлена колонка '{table_name}.updated_at'")
+            
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_posts_updated_at ON posts(updated_at)"))
+    except Exception as e:
+        print(f"Ошибка при миграции updated_at: {e}")
+
+
+def migrate_feed_indexes():
+    """
+    Индексы ленты: курсорная пагинация по (date, id) или (upvotes, id) среди неудалённых постов,
+    всех или одной категории. Обратный порядок (asc) читается тем же индексом с конца.
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_posts_feed 
+                ON posts(date DESC, id DESC) WHERE is_deleted = false
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_posts_feed_upvotes 
+                ON posts(upvotes DESC, id DESC) WHERE is_deleted = false
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_posts_feed_category 
+                ON posts(category, date DESC, id DESC) WHERE is_deleted = false
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_posts_feed_category_upvotes 
+                ON posts(category, upvotes DESC, id DESC) WHERE is_deleted = false
+            """))
+            print("✓ Индексы ленты созданы")
+    except Exception as e:
+        print(f"Ошибка при создании индексов ленты: {e}")
+
+
+def migrate_comment_indexes():
+    """
+    Индекс ветки комментариев: курсорная пагинация и дочитывание новых комментариев
+    по (date, id) среди неудалённых комментариев поста
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_comments_thread 
+                ON comments(post_id, is_deleted, date, id)
+            """))
+            print("✓ Индекс комментариев создан")
+    except Exception as e:
+        print(f"Ошибка при создании индекса комментариев: {e}")
+
+
+def migrate_search_columns():
+    """
+    Полнотекстовый поиск (GET /search, см. fulltext.py): генерируемые колонки search_vector
+    с GIN индексами. Добавление колонки переписывает таблицу, поэтому на больших таблицах
+    миграцию лучше выполнять в окно обслуживания.
+    """
+    try:
+        with engine.begin() as conn:
+            for table, expression in SEARCH_COLUMNS.items():
+                result = conn.execute(text("""
+                    SELECT column_name 
+                    FROM information_schema.columns 
+                    WHERE table_name = :table AND column_name = 'search_vector'
+                """), {"table": table})
+                
+                if not result.fetchone():
+                    conn.execute(text(f"""
+                        ALTER TABLE {table} ADD COLUMN search_vector tsvector
+                        GENERATED ALWAYS AS ({search_vector_sql(expression)}) STORED
+                    """))
+                    print(f"✓ Добавлена колонка '{table}.search_vector'")
+                
+                conn.execute(text(f"""
+                    CREATE INDEX IF NOT EXISTS ix_{table}_search 
+                    ON {table} USING GIN (search_vector)
+                """))
+            print("✓ Индексы поиска созданы")
+    except Exception as e:
+        print(f"Ошибка при создании колонок поиска: {e}")
+
+
+def migrate_board_version():
+    """Строка board_version: версия доски для ETag ленты и комментариев (см. feed_cache.py)"""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO board_version (id, version) 
+                SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM board_version)
+            """))
+    except Exception as e:
+        print(f"Ошибка при создании версии доски: {e}")
+
+
 if __name__ == "__main__":
     migrate_posts_table()
+    migrate_post_files_table()
+    migrate_audio_metadata_table()
+    migrate_file_path_indexes()
+    migrate_updated_at_columns()
+    migrate_feed_indexes()
+    migrate_comment_indexes()
+    migrate_search_columns()
+    migrate_board_version()
 
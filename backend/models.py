@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import BigInteger, Column, Integer, SmallInteger, String, Boolean, DateTime, Float, Text, ForeignKey
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -21,12 +21,16 @@ class Post(Base):
     text = Column(Text, nullable=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     # Старые поля оставляем для обратной совместимости
-    file_path = Column(String(500), nullable=True)  # Путь к файлу на сервере (deprecated)
+    file_path = Column(String(500), nullable=True, index=True)  # Путь к файлу на сервере (deprecated)
     file_type = Column(String(50), nullable=True)  # MIME type файла (deprecated)
     file_name = Column(String(255), nullable=True)  # Оригинальное имя файла (deprecated)
+    category = Column(String(20), default="text", nullable=False)  # Категория ленты по первому файлу (image, video, audio, text, other)
     date = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False, index=True)  # Последнее изменение поста или его файлов (для ETag)
     is_deleted = Column(Boolean, default=False, nullable=False)
     upvotes = Column(Integer, default=0, nullable=False)
+    comment_count = Column(Integer, default=0, nullable=False)  # Неудалённые комментарии (денормализовано, для ленты)
+    file_count = Column(Integer, default=0, nullable=False)  # Записи post_files поста (денормализовано, для ленты)
     
     # Relationship для доступа к пользователю
     user = relationship("User", backref="posts")
@@ -39,14 +43,75 @@ class PostFile(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), nullable=False, index=True)
-    file_path = Column(String(500), nullable=False)  # Путь к файлу на сервере
+    file_path = Column(String(500), nullable=False, index=True)  # Путь к файлу на сервере
     file_type = Column(String(100), nullable=False)  # MIME type файла
     file_name = Column(String(255), nullable=False)  # Оригинальное имя файла
     file_size = Column(Integer, nullable=True)  # Размер файла в байтах
+    content_hash = Column(String(64), nullable=True, index=True)  # SHA-256 содержимого файла
+    blob_id = Column(Integer, ForeignKey("file_blobs.id", ondelete="SET NULL"), nullable=True, index=True)  # Общий файл на диске
     order = Column(Integer, default=0, nullable=False)  # Порядок файла в посте (для альбомов)
+    preview_widths = Column(String(50), nullable=True)  # Ширины готовых уменьшенных копий ("320,640"); NULL - ещё не построены
+    preview_format = Column(String(10), nullable=True)  # Формат уменьшенных копий (webp или jpg)
     
     # Relationship для доступа к посту
     post = relationship("Post", back_populates="files")
+    # Relationship для доступа к файлу на диске
+    blob = relationship("FileBlob")
+    # Relationship для доступа к метаданным аудио файла
+    audio_metadata = relationship("AudioMetadata", back_populates="post_file", uselist=False, cascade="all, delete-orphan", passive_deletes=True)
+
+
+# Метаданные аудио файла: извлекаются один раз при загрузке, эндпоинты метаданных читают их из БД
+class AudioMetadata(Base):
+    __tablename__ = "audio_metadata"
+
+    post_file_id = Column(Integer, ForeignKey("post_files.id", ondelete="CASCADE"), primary_key=True)
+    title = Column(String(500), nullable=True)  # Название трека
+    artist = Column(String(500), nullable=True)  # Исполнитель
+    album = Column(String(500), nullable=True)  # Альбом
+    duration = Column(Float, nullable=True)  # Длительность в секундах
+    bitrate = Column(Integer, nullable=True)  # Битрейт в бит/с
+    has_cover = Column(Boolean, default=False, nullable=False)  # Есть ли встроенная обложка
+    cover_hash = Column(String(64), nullable=True, index=True)  # SHA-256 обложки в хранилище обложек
+    cover_path = Column(String(500), nullable=True, index=True)  # Путь к обложке на сервере
+    cover_type = Column(String(50), nullable=True)  # MIME type обложки
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    post_file = relationship("PostFile", back_populates="audio_metadata")
+
+
+# Файл на диске, адресуемый по SHA-256 содержимого; может использоваться несколькими PostFile
+class FileBlob(Base):
+    __tablename__ = "file_blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), unique=True, nullable=False, index=True)  # SHA-256 содержимого
+    file_path = Column(String(500), nullable=False, index=True)  # Путь к файлу на сервере
+    file_size = Column(Integer, nullable=False)  # Размер файла в байтах
+    ref_count = Column(Integer, default=0, nullable=False)  # Количество PostFile, ссылающихся на файл
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+# Файл, помеченный к удалению: удаляется с диска фоновой задачей после коммита транзакции
+class PendingDeletion(Base):
+    __tablename__ = "pending_deletions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    file_path = Column(String(500), nullable=False, index=True)  # Путь к файлу на сервере
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(32), primary_key=True)  # Идентификатор сессии (uuid4 hex)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    file_name = Column(String(255), nullable=False)  # Оригинальное имя файла
+    file_type = Column(String(100), nullable=False)  # MIME type файла
+    total_size = Column(Integer, nullable=False)  # Заявленный размер файла в байтах
+    offset = Column(Integer, default=0, nullable=False)  # Сколько байт уже получено
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)  # После этого момента сессия удаляется
 
 
 class Comment(Base):
@@ -57,9 +122,28 @@ class Comment(Base):
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     text = Column(Text, nullable=False)
     date = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)  # Последнее изменение комментария (для ETag)
     is_deleted = Column(Boolean, default=False, nullable=False)
     
     # Relationship для доступа к посту и пользователю
     post = relationship("Post", backref="comments")
     user = relationship("User", backref="comments")
 
+
+# Голос пользователя за пост: один на пару (user_id, post_id); posts.upvotes - сумма голосов
+class Vote(Base):
+    __tablename__ = "votes"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True, index=True)
+    value = Column(SmallInteger, nullable=False)  # 1 - апвоут, -1 - даунвоут
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+# Версия доски (одна строка): увеличивается при коммите каждой транзакции, меняющей ленту (для ETag)
+class BoardVersion(Base):
+    __tablename__ = "board_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, default=0, nullable=False)
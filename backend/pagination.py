@@ -0,0 +1,54 @@
+"""
+Курсорная (keyset) пагинация
+
+Курсор - непрозрачная для клиента строка с ключом сортировки последней записи страницы.
+Следующая страница выбирается условием вида (date, id) < (курсор) по индексу, поэтому
+глубокие страницы стоят столько же, сколько первая, а новые записи не сдвигают страницы.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+from fastapi import HTTPException, Response, status
+
+# Заголовок ответа с курсором следующей страницы (тело ответа остаётся списком)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(*values) -> str:
+    """Кодирует ключ сортировки записи в курсор"""
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, *types: type) -> Tuple:
+    """
+    Раскодирует курсор в значения указанных типов (int, str, datetime)
+    Некорректный курсор - ошибка 400.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        if not isinstance(payload, list) or len(payload) != len(types):
+            raise ValueError(cursor)
+        return tuple(
+            datetime.fromisoformat(value) if value_type is datetime else value_type(value)
+            for value, value_type in zip(payload, types)
+        )
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Некорректный курсор"
+        )
+
+
+def next_cursor_headers(next_cursor: Optional[str]) -> Dict[str, str]:
+    """Заголовки с курсором следующей страницы (пустые, если страница последняя)"""
+    return {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]) -> None:
+    """Передаёт курсор следующей страницы в заголовке (если страница не последняя)"""
+    response.headers.update(next_cursor_headers(next_cursor))
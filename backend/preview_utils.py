@@ -0,0 +1,148 @@
+"""
+Уменьшенные копии изображений и обложек аудио для ленты
+
+Копии строятся в фоне (см. tasks.py) и хранятся рядом с оригиналом:
+uploads/image/ab/cd/<sha256>.w640.webp
+"""
+import glob
+import io
+import os
+import uuid
+from pathlib import Path
+from typing import List, Optional
+from PIL import Image, ImageOps, features
+from audio_utils import extract_audio_cover
+from file_utils import get_preview_path
+
+# Ширины уменьшенных копий (px); в ленте карточка занимает ~600 px
+PREVIEW_WIDTHS = (320, 640, 1280)
+
+# Ширина копии, которая отдаётся как thumbnail_url
+PREVIEW_THUMBNAIL_WIDTH = 640
+
+# Формат копий: WebP, если Pillow собран с его поддержкой, иначе JPEG
+PREVIEW_FORMAT = "webp" if features.check("webp") else "jpg"
+PREVIEW_QUALITY = 80
+
+PREVIEW_MEDIA_TYPES = {"webp": "image/webp", "jpg": "image/jpeg"}
+_PIL_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+
+# GIF не уменьшаем: копия потеряла бы анимацию
+_SKIPPED_IMAGE_TYPES = {"image/gif"}
+
+
+def needs_previews(file_type: Optional[str]) -> bool:
+    """Строятся ли для файла уменьшенные копии"""
+    if not file_type:
+        return False
+    if file_type.startswith("image/"):
+        return file_type not in _SKIPPED_IMAGE_TYPES
+    return file_type.startswith("audio/")
+
+
+def parse_preview_widths(preview_widths: Optional[str]) -> List[int]:
+    """Список готовых ширин из колонки PostFile.preview_widths ("320,640")"""
+    if not preview_widths:
+        return []
+    return [int(width) for width in preview_widths.split(",") if width]
+
+
+def pick_thumbnail_width(widths: List[int]) -> Optional[int]:
+    """Наименьшая копия не уже PREVIEW_THUMBNAIL_WIDTH, либо самая большая из имеющихся"""
+    if not widths:
+        return None
+    suitable = [width for width in widths if width >= PREVIEW_THUMBNAIL_WIDTH]
+    return min(suitable) if suitable else max(widths)
+
+
+def find_previews(file_path: str) -> List[int]:
+    """Ширины уже построенных на диске копий файла"""
+    path = Path(file_path)
+    prefix = f"{path.stem}.w"
+    widths = []
+    for preview_path in path.parent.glob(f"{glob.escape(prefix)}[0-9]*.{PREVIEW_FORMAT}"):
+        width = preview_path.name[len(prefix):-len(PREVIEW_FORMAT) - 1]
+        if width.isdigit():
+            widths.append(int(width))
+    return sorted(widths)
+
+
+def _open_source_image(file_path: Path, file_type: str) -> Optional[Image.Image]:
+    """Открывает изображение или встроенную обложку аудио файла"""
+    if file_type.startswith("audio/"):
+        cover_data = extract_audio_cover(file_path, file_type)
+        if not cover_data:
+            return None
+        return Image.open(io.BytesIO(cover_data))
+    return Image.open(file_path)
+
+
+def _prepare_image(image: Image.Image) -> Image.Image:
+    """Поворачивает по EXIF и приводит к режиму, который поддерживает формат копий"""
+    # Для JPEG декодируем сразу в уменьшенном масштабе: обе стороны не меньше нужной ширины
+    image.draft("RGB", (PREVIEW_WIDTHS[-1], PREVIEW_WIDTHS[-1]))
+    image = ImageOps.exif_transpose(image)
+
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    if has_alpha and PREVIEW_FORMAT == "webp":
+        return image.convert("RGBA")
+    if has_alpha:
+        # JPEG не поддерживает прозрачность - накладываем на белый фон
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def _save_preview(image: Image.Image, destination: Path) -> None:
+    """Сохраняет копию через временный файл, чтобы не отдать недописанный файл"""
+    temp_path = destination.with_name(f"{destination.name}.{uuid.uuid4().hex}.part")
+    try:
+        image.save(temp_path, _PIL_FORMATS[PREVIEW_FORMAT], quality=PREVIEW_QUALITY)
+        os.replace(temp_path, destination)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def build_previews(file_path: str, file_type: str) -> List[int]:
+    """
+    Строит уменьшенные копии файла для всех подходящих ширин
+    Изображения не увеличиваются: если оригинал уже самой большой ширины, вместо
+    больших копий строится копия в исходном размере. Уже существующие копии
+    (тот же blob в другом посте) не пересобираются.
+    Возвращает: список ширин готовых копий (пустой, если копии не нужны или не удались)
+    """
+    if not needs_previews(file_type):
+        return []
+
+    existing = find_previews(file_path)
+    if existing:
+        return existing
+
+    source_path = Path(file_path)
+    if not source_path.exists():
+        return []
+
+    try:
+        image = _open_source_image(source_path, file_type)
+        if image is None:
+            return []
+
+        with image:
+            prepared = _prepare_image(image)
+            widths = [width for width in PREVIEW_WIDTHS if width < prepared.width]
+            if prepared.width < PREVIEW_WIDTHS[-1]:
+                widths.append(prepared.width)
+
+            # Уменьшаем от большей копии к меньшей: каждая следующая строится из предыдущей
+            current = prepared
+            for width in sorted(widths, reverse=True):
+                height = max(1, round(current.height * width / current.width))
+                current = current.resize((width, height), Image.Resampling.LANCZOS)
+                _save_preview(current, get_preview_path(file_path, width, PREVIEW_FORMAT))
+
+        return sorted(widths)
+    except Exception as e:
+        print(f"Ошибка построения уменьшенных копий {file_path}: {e}")
+        return []
@@ -0,0 +1,266 @@
+"""
+Сверка файлов в uploads/ с записями в БД
+
+Находит файлы-сироты (на диске есть, в БД ссылок нет) и записи неудалённых постов,
+файлов которых нет на диске. Обращения к диску ограничены по скорости, чтобы сверка
+не мешала отдаче файлов.
+"""
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from collections import Counter
+from typing import Dict, List, Optional, Set
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from database import SessionLocal, engine
+from feed_cache import touch_posts
+from models import AudioMetadata, FileBlob, PendingDeletion, Post, PostFile
+from file_utils import UPLOAD_DIR, UPLOAD_TMP_DIR, get_post_category, release_post_file, schedule_file_deletion
+
+# Сколько файлов в секунду проверяется на диске
+RECONCILE_FILES_PER_SECOND = int(os.getenv("RECONCILE_FILES_PER_SECOND") or "200")
+
+# Если файлов не хватает у большего числа записей, записи не исправляются автоматически:
+# скорее всего, недоступно само хранилище (не смонтирован диск и т.п.)
+RECONCILE_MAX_MISSING = int(os.getenv("RECONCILE_MAX_MISSING") or "100")
+
+# Файлы моложе этого срока (секунды) не считаются сиротами: их может прямо сейчас сохранять загрузка
+ORPHAN_MIN_AGE = 3600
+
+RECONCILE_BATCH_SIZE = 500
+
+# Ключ advisory lock PostgreSQL: сверку выполняет только один воркер
+RECONCILE_LOCK_ID = 7265636
+
+# Сколько найденных путей печатается в отчёте
+REPORT_LIMIT = 20
+
+# Уменьшенная копия: <stem>.w640.webp
+_PREVIEW_NAME = re.compile(r"^(?P<stem>.+)\.w\d+\.[a-z0-9]+$")
+
+
+class ReconcileStopped(Exception):
+    """Сверка прервана (приложение завершается)"""
+
+
+class _Throttle:
+    """Ограничивает число обращений к диску в секунду"""
+
+    def __init__(self, per_second: int, stop_event: Optional[threading.Event]):
+        self.per_second = max(per_second, 1)
+        self.stop_event = stop_event
+        self.started = time.monotonic()
+        self.count = 0
+
+    def tick(self):
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise ReconcileStopped()
+        self.count += 1
+        ahead = self.count / self.per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def referenced_paths(db: Session, paths: List[str], include_pending: bool = True) -> Set[str]:
+    """
+    Какие из путей используются: blob, файлы (и старые поля) и обложки неудалённых постов
+    С include_pending - также пути, уже помеченные к удалению.
+    """
+    referenced = set()
+    for start in range(0, len(paths), RECONCILE_BATCH_SIZE):
+        chunk = paths[start:start + RECONCILE_BATCH_SIZE]
+        queries = [
+            db.query(FileBlob.file_path).filter(FileBlob.file_path.in_(chunk)),
+            db.query(PostFile.file_path).join(Post).filter(
+                PostFile.file_path.in_(chunk), Post.is_deleted == False
+            ),
+            db.query(Post.file_path).filter(Post.file_path.in_(chunk), Post.is_deleted == False),
+            db.query(AudioMetadata.cover_path).join(PostFile).join(Post).filter(
+                AudioMetadata.cover_path.in_(chunk), Post.is_deleted == False
+            ),
+        ]
+        if include_pending:
+            queries.append(db.query(PendingDeletion.file_path).filter(PendingDeletion.file_path.in_(chunk)))
+        for query in queries:
+            referenced.update(path for (path,) in query.all())
+    return referenced
+
+
+def find_orphan_files(db: Session, throttle: _Throttle) -> List[str]:
+    """Файлы в uploads/, на которые не ссылается ни одна запись (без временных загрузок в uploads/tmp/)"""
+    orphans = []
+    stale_before = time.time() - ORPHAN_MIN_AGE
+    tmp_dir = UPLOAD_TMP_DIR.resolve()
+
+    for dir_path, dir_names, file_names in os.walk(UPLOAD_DIR):
+        dir_names[:] = [name for name in dir_names if (Path(dir_path) / name).resolve() != tmp_dir]
+
+        originals = []
+        previews = []
+        for name in file_names:
+            throttle.tick()
+            path = str(Path(dir_path) / name)
+            try:
+                if os.stat(path).st_mtime > stale_before:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            if name.endswith(".part"):
+                # Недописанный файл после сбоя записи
+                orphans.append(path)
+            elif _PREVIEW_NAME.match(name):
+                previews.append(name)
+            else:
+                originals.append(path)
+
+        if originals:
+            referenced = referenced_paths(db, originals)
+            orphans.extend(path for path in originals if path not in referenced)
+
+        # Копия - сирота, если рядом нет оригинала с тем же именем
+        original_stems = {Path(name).stem for name in file_names if not _PREVIEW_NAME.match(name)}
+        for name in previews:
+            if _PREVIEW_NAME.match(name).group("stem") not in original_stems:
+                orphans.append(str(Path(dir_path) / name))
+
+    return orphans
+
+
+def find_missing_files(db: Session, throttle: _Throttle) -> Dict[str, List[int]]:
+    """
+    Записи неудалённых постов, файлов которых нет на диске
+    Возвращает: {"post_files": [id PostFile], "posts": [id Post со старым file_path]}
+    """
+    missing = {"post_files": [], "posts": []}
+
+    last_id = 0
+    while True:
+        rows = db.query(PostFile.id, PostFile.file_path).join(Post).filter(
+            PostFile.id > last_id, Post.is_deleted == False
+        ).order_by(PostFile.id).limit(RECONCILE_BATCH_SIZE).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        for row in rows:
+            throttle.tick()
+            if not os.path.exists(row.file_path):
+                missing["post_files"].append(row.id)
+
+    last_id = 0
+    while True:
+        rows = db.query(Post.id, Post.file_path).filter(
+            Post.id > last_id, Post.is_deleted == False, Post.file_path.isnot(None)
+        ).order_by(Post.id).limit(RECONCILE_BATCH_SIZE).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        for row in rows:
+            throttle.tick()
+            if not os.path.exists(row.file_path):
+                missing["posts"].append(row.id)
+
+    return missing
+
+
+def fix_missing_files(db: Session, missing: Dict[str, List[int]]) -> None:
+    """Удаляет записи о пропавших файлах и переносит старые поля поста на оставшийся файл"""
+    changed_post_ids = []
+    removed_files = Counter()
+    for post_file in db.query(PostFile).filter(PostFile.id.in_(missing["post_files"])).with_for_update().all():
+        # Файл могли восстановить, пока шла сверка
+        if os.path.exists(post_file.file_path):
+            continue
+        release_post_file(db, post_file)
+        db.delete(post_file)
+        changed_post_ids.append(post_file.post_id)
+        removed_files[post_file.post_id] += 1
+    db.flush()
+    for post_id, count in removed_files.items():
+        db.query(Post).filter(Post.id == post_id).update(
+            {Post.file_count: Post.file_count - count}, synchronize_session=False
+        )
+
+    for post in db.query(Post).filter(Post.id.in_(missing["posts"])).with_for_update().all():
+        if not post.file_path or os.path.exists(post.file_path):
+            continue
+        first_file = db.query(PostFile).filter(PostFile.post_id == post.id).order_by(PostFile.order).first()
+        post.file_path = first_file.file_path if first_file else None
+        post.file_type = first_file.file_type if first_file else None
+        post.file_name = first_file.file_name if first_file else None
+        post.category = get_post_category(post.file_type)
+        changed_post_ids.append(post.id)
+    
+    touch_posts(db, changed_post_ids)
+
+
+def _report(title: str, items: List[str]):
+    print(f"{title}: {len(items)}")
+    for item in items[:REPORT_LIMIT]:
+        print(f"  {item}")
+    if len(items) > REPORT_LIMIT:
+        print(f"  ... и ещё {len(items) - REPORT_LIMIT}")
+
+
+def reconcile_uploads(
+    fix: bool = True,
+    files_per_second: int = RECONCILE_FILES_PER_SECOND,
+    stop_event: Optional[threading.Event] = None
+) -> Optional[dict]:
+    """
+    Сверяет файлы в uploads/ с БД, печатает отчёт и (при fix) исправляет расхождения
+
+    Сироты помечаются к удалению, и их удаляет фоновая задача так же, как файлы
+    удалённых постов. Записи о пропавших файлах удаляются, если их не больше
+    RECONCILE_MAX_MISSING. Возвращает: сводку или None, если сверка уже идёт
+    в другом процессе или была прервана.
+    """
+    lock_connection = None
+    if engine.dialect.name == "postgresql":
+        lock_connection = engine.connect()
+        if not lock_connection.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": RECONCILE_LOCK_ID}).scalar():
+            lock_connection.close()
+            return None
+
+    db = SessionLocal()
+    try:
+        throttle = _Throttle(files_per_second, stop_event)
+        orphans = find_orphan_files(db, throttle)
+        db.rollback()
+        missing = find_missing_files(db, throttle)
+        db.rollback()
+
+        _report("Файлы без записей в БД", orphans)
+        missing_count = len(missing["post_files"]) + len(missing["posts"])
+        print(f"Записи без файлов на диске: {missing_count} "
+              f"(post_files: {missing['post_files'][:REPORT_LIMIT]}, posts: {missing['posts'][:REPORT_LIMIT]})")
+
+        fixed_missing = False
+        if fix:
+            for path in orphans:
+                schedule_file_deletion(db, path)
+            if missing_count > RECONCILE_MAX_MISSING:
+                print(f"⚠ Пропавших файлов больше {RECONCILE_MAX_MISSING} - записи не исправлены, проверьте хранилище")
+            elif missing_count:
+                fix_missing_files(db, missing)
+                fixed_missing = True
+            db.commit()
+            print(f"✓ Сверка uploads/ завершена: сирот помечено к удалению {len(orphans)}, "
+                  f"записей исправлено {missing_count if fixed_missing else 0}")
+
+        return {
+            "orphan_files": len(orphans),
+            "missing_files": missing_count,
+            "fixed": fix,
+            "fixed_missing": fixed_missing,
+        }
+    except ReconcileStopped:
+        db.rollback()
+        return None
+    finally:
+        db.close()
+        if lock_connection is not None:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": RECONCILE_LOCK_ID})
+            lock_connection.close()
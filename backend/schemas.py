@@ -58,6 +58,8 @@ class PostFileResponse(BaseModel):
     file_url: Optional[str] = None  # URL для получения файла
     file_size: Optional[int] = None  # Размер файла в байтах
     order: int  # Порядок файла в посте
+    thumbnail_url: Optional[str] = None  # URL уменьшенной копии изображения или обложки (для ленты)
+    srcset: Optional[str] = None  # Все уменьшенные копии в формате атрибута srcset
 
     class Config:
         from_attributes = True
@@ -76,6 +78,9 @@ class PostResponse(BaseModel):
     date: datetime
     is_deleted: bool
     upvotes: int
+    category: str = "text"  # Категория поста: image, video, audio, text, other
+    comment_count: int = 0  # Количество неудалённых комментариев
+    file_count: int = 0  # Количество файлов поста
     author_nick: Optional[str] = None  # Ник пользователя, создавшего пост
     author_id: Optional[int] = None  # ID пользователя, создавшего пост
 
@@ -83,6 +88,40 @@ class PostResponse(BaseModel):
         from_attributes = True
 
 
+class VoteResponse(BaseModel):
+    post_id: int
+    upvotes: int  # Счётчик апвоутов поста после голоса
+    vote: int  # Голос текущего пользователя: 1 или -1
+
+
+# Upload Schemas (возобновляемая загрузка файлов по частям)
+class UploadCreate(BaseModel):
+    file_name: str = Field(..., min_length=1, max_length=255)
+    file_type: Optional[str] = Field(None, max_length=100)  # MIME type файла
+    total_size: int = Field(..., ge=0)  # Полный размер файла в байтах
+
+
+class UploadResponse(BaseModel):
+    id: str
+    file_name: str
+    file_type: str
+    total_size: int
+    offset: int  # Сколько байт уже получено сервером
+    expires_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class UploadFinalize(BaseModel):
+    post_id: Optional[int] = None  # Прикрепить файл к существующему посту; иначе создаётся новый
+    text: Optional[str] = None  # Текст нового поста
+
+
+class UploadFinalizeBatch(UploadFinalize):
+    upload_ids: List[str] = Field(..., min_length=1, max_length=100)  # Файлы поста в нужном порядке
+
+
 # Auth Schemas
 class Token(BaseModel):
     access_token: str
@@ -111,3 +150,9 @@ class CommentResponse(BaseModel):
     class Config:
         from_attributes = True
 
+
+class SearchResult(BaseModel):
+    kind: str  # Что найдено: post (текст, имя файла или теги аудио) или comment
+    rank: float  # Релевантность (ts_rank_cd), результаты упорядочены по ней
+    post: PostResponse  # Найденный пост или пост найденного комментария
+    comment: Optional[CommentResponse] = None  # Найденный комментарий
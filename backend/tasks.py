@@ -0,0 +1,276 @@
+"""
+Фоновые задачи приложения: запускаются при старте и останавливаются при завершении
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, or_, text
+from database import SessionLocal, engine
+from feed_cache import touch_posts
+from models import PendingDeletion, PostFile, UploadSession
+from audio_utils import is_cover_recently_used
+from file_utils import UPLOAD_TMP_DIR, delete_file, delete_previews, get_upload_temp_path
+from preview_utils import PREVIEW_FORMAT, build_previews
+from reconcile import reconcile_uploads, referenced_paths
+from votes import vote_buffer
+
+# Интервал сборки просроченных сессий загрузки (секунды)
+UPLOAD_CLEANUP_INTERVAL = int(os.getenv("UPLOAD_CLEANUP_INTERVAL", "3600"))
+
+# Временные файлы без сессии удаляются, только если не менялись дольше этого срока (секунды):
+# так не затрагиваются файлы, которые прямо сейчас сохраняет create_post
+STALE_TEMP_FILE_AGE = 3600
+
+# Интервал проверки файлов без уменьшенных копий (секунды); после загрузки задача будится сразу
+PREVIEW_INTERVAL = int(os.getenv("PREVIEW_INTERVAL") or "60")
+# Сколько файлов обрабатывается за один проход
+PREVIEW_BATCH_SIZE = 20
+# Ключ advisory lock PostgreSQL: уменьшенные копии строит один воркер за раз
+PREVIEW_LOCK_ID = 7265637
+
+# Интервал удаления помеченных файлов (секунды); после удаления поста задача будится сразу
+RECLAIM_INTERVAL = int(os.getenv("RECLAIM_INTERVAL") or "300")
+# Сколько помеченных файлов удаляется за один проход
+RECLAIM_BATCH_SIZE = 200
+
+# Интервал сверки файлов на диске с БД (секунды), по умолчанию раз в сутки; 0 - не запускать
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL") or "86400")
+RECONCILE_START_DELAY = 600
+
+_tasks: List[asyncio.Task] = []
+_wakeups: Dict[str, asyncio.Event] = {}
+_loop: Optional[asyncio.AbstractEventLoop] = None
+# Сигнал долгим задачам в пуле потоков, что приложение завершается
+_stopping = threading.Event()
+
+
+def cleanup_expired_uploads() -> int:
+    """Удаляет просроченные сессии загрузки по частям и их временные файлы"""
+    db = SessionLocal()
+    try:
+        expired = db.query(UploadSession).filter(
+            UploadSession.expires_at < func.now()
+        ).with_for_update(skip_locked=True).all()
+        
+        for upload in expired:
+            get_upload_temp_path(upload.id).unlink(missing_ok=True)
+            db.delete(upload)
+        db.commit()
+        
+        # Временные файлы, для которых сессии уже нет (например, после сбоя при завершении)
+        active_ids = {upload_id for (upload_id,) in db.query(UploadSession.id).all()}
+        stale_before = time.time() - STALE_TEMP_FILE_AGE
+        for temp_path in UPLOAD_TMP_DIR.glob("*.part"):
+            try:
+                if temp_path.stem not in active_ids and temp_path.stat().st_mtime < stale_before:
+                    temp_path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                continue
+        
+        if expired:
+            print(f"✓ Удалено просроченных сессий загрузки: {len(expired)}")
+        return len(expired)
+    finally:
+        db.close()
+
+
+def build_pending_previews() -> bool:
+    """
+    Строит уменьшенные копии для новых изображений и аудио с обложками
+    Копии пачки строятся без открытой транзакции; затем одна короткая транзакция записывает
+    preview_widths файлам, которые всё ещё ждут копий по тому же пути, и один раз отмечает
+    изменение их постов. Проход выполняет воркер, получивший advisory lock PostgreSQL,
+    поэтому несколько воркеров не строят одни и те же копии.
+    Возвращает True, если за проход обработаны не все ожидающие файлы.
+    """
+    lock_connection = None
+    if engine.dialect.name == "postgresql":
+        lock_connection = engine.connect()
+        locked = lock_connection.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": PREVIEW_LOCK_ID}).scalar()
+        # Блокировка уровня сессии переживает коммит; соединение не остаётся в транзакции
+        lock_connection.commit()
+        if not locked:
+            lock_connection.close()
+            return False
+
+    db = SessionLocal()
+    try:
+        pending = db.query(PostFile.id, PostFile.post_id, PostFile.file_path, PostFile.file_type).filter(
+            PostFile.preview_widths.is_(None),
+            or_(PostFile.file_type.like("image/%"), PostFile.file_type.like("audio/%"))
+        ).order_by(PostFile.id).limit(PREVIEW_BATCH_SIZE).all()
+        db.rollback()
+        
+        if not pending:
+            return False
+        
+        built = [(row, build_previews(row.file_path, row.file_type)) for row in pending]
+        
+        changed_post_ids = []
+        for row, widths in built:
+            # Пустая строка - копии не нужны или не удались, файл больше не обрабатывается.
+            # Файл, перенесённый или удалённый за время построения, обработает следующий проход
+            updated = db.query(PostFile).filter(
+                PostFile.id == row.id,
+                PostFile.file_path == row.file_path,
+                PostFile.preview_widths.is_(None)
+            ).update({
+                PostFile.preview_widths: ",".join(str(width) for width in widths),
+                PostFile.preview_format: PREVIEW_FORMAT if widths else None
+            }, synchronize_session=False)
+            if updated:
+                changed_post_ids.append(row.post_id)
+        # Ссылки на копии появляются в ответах ленты
+        if changed_post_ids:
+            touch_posts(db, changed_post_ids)
+        db.commit()
+        
+        print(f"✓ Обработано файлов для уменьшенных копий: {len(pending)}")
+        return len(pending) == PREVIEW_BATCH_SIZE
+    finally:
+        db.close()
+        if lock_connection is not None:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": PREVIEW_LOCK_ID})
+            lock_connection.close()
+
+
+def reclaim_deleted_files() -> bool:
+    """
+    Удаляет с диска файлы, помеченные к удалению (вместе с уменьшенными копиями)
+    Возвращает True, если за проход обработаны не все помеченные файлы.
+    """
+    db = SessionLocal()
+    try:
+        deletions = db.query(PendingDeletion).order_by(
+            PendingDeletion.id
+        ).limit(RECLAIM_BATCH_SIZE).with_for_update(skip_locked=True).all()
+        
+        # Ссылки проверяются, пока строки пометок заблокированы. Тот же файл могли загрузить
+        # заново (blob), перенести (manage.py shard-uploads) или пометить сверкой, пока на него
+        # ещё ссылается пост старого формата; обложка может быть общей для нескольких постов
+        in_use = referenced_paths(db, [deletion.file_path for deletion in deletions], include_pending=False)
+        for deletion in deletions:
+            # Обложку, которую только что использовала загрузка, удалит сверка, если ссылка так и не появится
+            if deletion.file_path not in in_use and not is_cover_recently_used(deletion.file_path):
+                delete_file(deletion.file_path)
+                delete_previews(deletion.file_path)
+            db.delete(deletion)
+        db.commit()
+        
+        if deletions:
+            print(f"✓ Удалено помеченных файлов: {len(deletions)}")
+        return len(deletions) == RECLAIM_BATCH_SIZE
+    finally:
+        db.close()
+
+
+def run_reconcile():
+    """Сверка файлов на диске с БД (прерывается при завершении приложения)"""
+    reconcile_uploads(fix=True, stop_event=_stopping)
+
+
+def _wake(name: str):
+    """Будит фоновую задачу; можно вызывать и из event loop, и из пула потоков"""
+    event = _wakeups.get(name)
+    if event is not None and _loop is not None:
+        _loop.call_soon_threadsafe(event.set)
+
+
+def request_previews():
+    """Будит фоновую задачу построения копий (после загрузки файлов)"""
+    _wake("build_pending_previews")
+
+
+def request_reclaim():
+    """Будит фоновую задачу удаления помеченных файлов (после удаления или замены файлов)"""
+    _wake("reclaim_deleted_files")
+
+
+def request_vote_flush():
+    """Будит запись накопленных голосов, не дожидаясь интервала (очередь заполнена)"""
+    _wake("flush_votes")
+
+
+async def _run_periodically(
+    name: str,
+    job: Callable[[], object],
+    interval: float,
+    wakeup: Optional[asyncio.Event] = None,
+    initial_delay: float = 0
+):
+    """
+    Периодически выполняет синхронную задачу в пуле потоков
+    wakeup позволяет запустить задачу раньше срока; если задача вернула True,
+    следующий проход начинается сразу.
+    """
+    await asyncio.sleep(initial_delay)
+    while True:
+        try:
+            result = await run_in_threadpool(job)
+        except Exception as e:
+            print(f"Ошибка фоновой задачи {name}: {e}")
+            result = None
+        
+        # Задача сообщила, что обработала не всё - продолжаем сразу
+        if result is True:
+            continue
+        
+        if wakeup is None:
+            await asyncio.sleep(interval)
+            continue
+        
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+
+def _start(
+    name: str,
+    job: Callable[[], object],
+    interval: float,
+    wakeable: bool = False,
+    initial_delay: float = 0
+):
+    """Запускает периодическую задачу; wakeable - задачу можно будить через _wake(name)"""
+    wakeup = None
+    if wakeable:
+        wakeup = _wakeups[name] = asyncio.Event()
+    _tasks.append(asyncio.create_task(_run_periodically(name, job, interval, wakeup, initial_delay)))
+
+
+def start_background_tasks():
+    """Запускает фоновые задачи (вызывается при старте приложения)"""
+    global _loop
+    _loop = asyncio.get_running_loop()
+    _stopping.clear()
+    
+    _start("cleanup_expired_uploads", cleanup_expired_uploads, UPLOAD_CLEANUP_INTERVAL)
+    _start("build_pending_previews", build_pending_previews, PREVIEW_INTERVAL, wakeable=True)
+    _start("reclaim_deleted_files", reclaim_deleted_files, RECLAIM_INTERVAL, wakeable=True)
+    if RECONCILE_INTERVAL > 0:
+        # Первая сверка - не сразу при старте, чтобы не нагружать диск при каждом перезапуске
+        _start("reconcile_uploads", run_reconcile, RECONCILE_INTERVAL, initial_delay=RECONCILE_START_DELAY)
+    if vote_buffer.enabled:
+        _start("flush_votes", vote_buffer.flush, vote_buffer.interval, wakeable=True)
+
+
+async def stop_background_tasks():
+    """
+    Останавливает фоновые задачи (вызывается при завершении приложения)
+    и записывает голоса, накопленные с последней записи
+    """
+    global _loop
+    _stopping.set()
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    # Идущая запись голосов продолжается в пуле потоков; flush дождётся её
+    await run_in_threadpool(vote_buffer.flush)
+    _tasks.clear()
+    _wakeups.clear()
+    _loop = None
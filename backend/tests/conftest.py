@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Модули backend импортируются как в приложении; БД - временная SQLite
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import database
+from api import comments, posts
+from feed_cache import mark_board_changed
+from migrations import migrate_board_version
+from models import Comment, Post, User
+
+
+@pytest.fixture
+def client():
+    database.Base.metadata.drop_all(database.engine)
+    database.Base.metadata.create_all(database.engine)
+    migrate_board_version()
+
+    app = FastAPI()
+    app.include_router(posts.router)
+    app.include_router(comments.router)
+    return TestClient(app)
+
+
+@pytest.fixture
+def board(client):
+    """Два поста и два комментария к первому: {"posts": [id, id], "comments": [id, id]}"""
+    db = database.SessionLocal()
+    user = User(login="author", password="x", nick="author")
+    db.add(user)
+    db.flush()
+    board_posts = [Post(text=f"post {i}", user_id=user.id) for i in range(2)]
+    db.add_all(board_posts)
+    db.flush()
+    board_comments = [Comment(post_id=board_posts[0].id, user_id=user.id, text=f"comment {i}") for i in range(2)]
+    db.add_all(board_comments)
+    db.commit()
+    ids = {"posts": [post.id for post in board_posts], "comments": [comment.id for comment in board_comments]}
+    db.close()
+    return ids
+
+
+def commit_change(started_at: datetime, post_id: int, comment_id: int) -> None:
+    """
+    Транзакция, изменившая пост и комментарий с updated_at = started_at
+    (так пишет now() PostgreSQL: время начала транзакции, а не коммита)
+    """
+    db = database.SessionLocal()
+    db.query(Post).filter(Post.id == post_id).update({Post.updated_at: started_at}, synchronize_session=False)
+    db.query(Comment).filter(Comment.id == comment_id).update({Comment.updated_at: started_at}, synchronize_session=False)
+    mark_board_changed(db)
+    db.commit()
+    db.close()
+
+
+@pytest.mark.parametrize("url", ["/posts", "/posts/{post_id}/comments"])
+def test_etag_changes_when_earlier_transaction_commits_later(client, board, url):
+    url = url.format(post_id=board["posts"][0])
+    long_started_at = datetime.now(timezone.utc) - timedelta(minutes=5)
+    short_started_at = datetime.now(timezone.utc)
+
+    # Короткая транзакция началась позже, но закоммитилась первой
+    commit_change(short_started_at, board["posts"][1], board["comments"][1])
+    etag = client.get(url).headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    # Долгая транзакция закоммитила updated_at старее уже выданного max(updated_at)
+    commit_change(long_started_at, board["posts"][0], board["comments"][0])
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
@@ -0,0 +1,205 @@
+"""
+Голосование за посты
+
+Голоса хранятся в таблице votes (один на пару пользователь-пост), posts.upvotes -
+денормализованная сумма голосов. Голоса записываются и счётчики меняются одним запросом
+без чтения постов в Python, поэтому параллельные голоса не теряются: строку поста
+блокирует только UPDATE, а повторный голос того же пользователя ничего не меняет.
+
+При VOTE_BUFFER_INTERVAL_MS > 0 голоса не пишутся в запросе, а копятся в памяти
+процесса (VoteBuffer) и записываются тем же запросом пачкой раз в интервал
+или при VOTE_BUFFER_MAX_VOTES ожидающих голосах.
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from feed_cache import mark_board_changed
+
+# Интервал записи накопленных голосов (мс); 0 - голос записывается в запросе
+VOTE_BUFFER_INTERVAL_MS = int(os.getenv("VOTE_BUFFER_INTERVAL_MS") or "0")
+# Сколько ожидающих голосов вызывает запись, не дожидаясь интервала
+VOTE_BUFFER_MAX_VOTES = int(os.getenv("VOTE_BUFFER_MAX_VOTES") or "1000")
+
+# Вставка голосов или смена их знака и изменение счётчиков постов в одном запросе.
+# (xmax = 0) в RETURNING отличает вставленную строку от обновлённой: новый голос меняет
+# счётчик на value, смена знака - на 2 * value. Голоса, которые не изменились, и голоса
+# за несуществующие или удалённые посты не попадают в CTE vote и счётчик не меняют.
+# Пары (user_id, post_id) в одном запросе не должны повторяться.
+VOTES_SQL = text("""
+    WITH incoming AS (
+        SELECT *
+        FROM unnest(
+            CAST(:user_ids AS INTEGER[]), CAST(:post_ids AS INTEGER[]), CAST(:vote_values AS SMALLINT[])
+        ) AS incoming(user_id, post_id, value)
+    ),
+    vote AS (
+        INSERT INTO votes (user_id, post_id, value)
+        SELECT incoming.user_id, incoming.post_id, incoming.value
+        FROM incoming
+        WHERE EXISTS (SELECT 1 FROM posts WHERE posts.id = incoming.post_id AND posts.is_deleted = false)
+        ON CONFLICT (user_id, post_id) DO UPDATE
+            SET value = EXCLUDED.value, updated_at = now()
+            WHERE votes.value <> EXCLUDED.value
+        RETURNING votes.post_id, votes.value, (xmax = 0) AS inserted
+    ),
+    delta AS (
+        SELECT post_id, SUM(CASE WHEN inserted THEN value ELSE 2 * value END) AS change
+        FROM vote
+        GROUP BY post_id
+    )
+    UPDATE posts
+    SET upvotes = posts.upvotes + delta.change, updated_at = now()
+    FROM delta
+    WHERE posts.id = delta.post_id
+    RETURNING posts.id, posts.upvotes
+""")
+
+
+def apply_votes(db: Session, votes: Dict[Tuple[int, int], int]) -> Dict[int, int]:
+    """
+    Записывает голоса {(user_id, post_id): 1 или -1} в текущей транзакции
+    Возвращает: новые счётчики постов, у которых голоса что-то изменили
+    """
+    if not votes:
+        return {}
+    keys = list(votes)
+    rows = db.execute(VOTES_SQL, {
+        "user_ids": [user_id for user_id, _ in keys],
+        "post_ids": [post_id for _, post_id in keys],
+        "vote_values": [votes[key] for key in keys],
+    }).all()
+    return {post_id: upvotes for post_id, upvotes in rows}
+
+
+def cast_vote(db: Session, user_id: int, post_id: int, value: int) -> Optional[int]:
+    """
+    Записывает голос пользователя (1 или -1) и меняет posts.upvotes в текущей транзакции
+    Возвращает: новый счётчик или None, если голос не изменился, поста нет или он удалён.
+    """
+    return apply_votes(db, {(user_id, post_id): value}).get(post_id)
+
+
+class VoteBuffer:
+    """
+    Накопитель голосов процесса (write-behind)
+
+    Голос сразу учитывается в счётчике, который видит пользователь (счётчик из БД плюс
+    ещё не записанные голоса), а в БД попадает пачкой: последний голос каждого пользователя
+    за интервал, одна транзакция на пачку. Записанный счётчик всегда верен (запрос сверяет
+    голоса с votes), показанный до записи - приблизителен, если тот же пост одновременно
+    голосуют через другие воркеры. Голоса, не записанные к падению процесса, теряются.
+    """
+
+    def __init__(self, interval_ms: int, max_votes: int):
+        self.interval = interval_ms / 1000
+        self.max_votes = max(max_votes, 1)
+        self._lock = threading.Lock()
+        # Запись пачек по одной: запись при завершении дожидается идущей
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[Tuple[int, int], int] = {}
+        self._pending_delta: Dict[int, int] = defaultdict(int)
+        self._pending_since: Optional[float] = None
+        # Пачка, которая пишется сейчас: её голоса ещё не видны в БД
+        self._inflight: Dict[Tuple[int, int], int] = {}
+        self._inflight_delta: Dict[int, int] = {}
+        self.flushes = 0
+        self.flushed_votes = 0
+        self.failed_flushes = 0
+        self.last_flush_seconds = 0.0
+        self.last_lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def vote(self, user_id: int, post_id: int, value: int, stored_vote: Optional[int], stored_upvotes: int) -> Tuple[int, bool]:
+        """
+        Учитывает голос; stored_vote и stored_upvotes - голос пользователя и счётчик поста в БД
+        Возвращает: (счётчик с ещё не записанными голосами, пора ли записать пачку)
+        """
+        key = (user_id, post_id)
+        with self._lock:
+            previous = self._pending.get(key, self._inflight.get(key, stored_vote))
+            if previous != value:
+                self._pending[key] = value
+                self._pending_delta[post_id] += value - (previous or 0)
+                if self._pending_since is None:
+                    self._pending_since = time.monotonic()
+            upvotes = stored_upvotes + self._pending_delta.get(post_id, 0) + self._inflight_delta.get(post_id, 0)
+            return upvotes, len(self._pending) >= self.max_votes
+
+    def flush(self) -> int:
+        """
+        Записывает накопленные голоса одной транзакцией
+        При ошибке голоса возвращаются в очередь и записываются следующей пачкой.
+        Возвращает: количество записанных голосов
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._inflight, self._pending = self._pending, {}
+                self._inflight_delta, self._pending_delta = dict(self._pending_delta), defaultdict(int)
+                pending_since, self._pending_since = self._pending_since, None
+
+            started = time.monotonic()
+            db = SessionLocal()
+            try:
+                apply_votes(db, self._inflight)
+                mark_board_changed(db)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                with self._lock:
+                    # Более новые голоса тех же пользователей уже учитывают голос из пачки
+                    for key, value in self._inflight.items():
+                        self._pending.setdefault(key, value)
+                    for post_id, change in self._inflight_delta.items():
+                        self._pending_delta[post_id] += change
+                    if self._pending_since is None or pending_since < self._pending_since:
+                        self._pending_since = pending_since
+                    self._inflight, self._inflight_delta = {}, {}
+                    self.failed_flushes += 1
+                print(f"⚠ Ошибка записи голосов: {e}")
+                return 0
+            finally:
+                db.close()
+
+            finished = time.monotonic()
+            with self._lock:
+                flushed = len(self._inflight)
+                self._inflight, self._inflight_delta = {}, {}
+                self.flushes += 1
+                self.flushed_votes += flushed
+                self.last_flush_seconds = finished - started
+                self.last_lag_seconds = finished - pending_since
+                self.max_lag_seconds = max(self.max_lag_seconds, self.last_lag_seconds)
+            return flushed
+
+    def stats(self) -> dict:
+        """Очередь и задержка записи голосов (для мониторинга)"""
+        with self._lock:
+            oldest = time.monotonic() - self._pending_since if self._pending_since is not None else 0.0
+            return {
+                "enabled": self.enabled,
+                "interval_ms": int(self.interval * 1000),
+                "pending_votes": len(self._pending),
+                "pending_posts": len(self._pending_delta),
+                "inflight_votes": len(self._inflight),
+                "oldest_pending_ms": round(oldest * 1000, 1),
+                "flushes": self.flushes,
+                "flushed_votes": self.flushed_votes,
+                "failed_flushes": self.failed_flushes,
+                "last_flush_ms": round(self.last_flush_seconds * 1000, 1),
+                "last_lag_ms": round(self.last_lag_seconds * 1000, 1),
+                "max_lag_ms": round(self.max_lag_seconds * 1000, 1),
+            }
+
+
+vote_buffer = VoteBuffer(VOTE_BUFFER_INTERVAL_MS, VOTE_BUFFER_MAX_VOTES)
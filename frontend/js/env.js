@@ -1,11 +1,19 @@
 // Конфигурация приложения
 window.API_BASE = '';
 window.POSTS_PER_PAGE = 50;
+window.SEARCH_RESULTS_PER_PAGE = 50; // Результатов поиска на странице (не больше 50)
 
 // Константы для отображения постов
 window.MAX_TEXT_LENGTH = 500; // Максимальная длина текста поста до обрезки
 window.MAX_VISIBLE_TRACKS = 4; // Максимальное количество видимых треков в альбоме до сворачивания
+window.PREVIEW_SIZES = '(max-width: 700px) 100vw, 600px'; // Ширина изображения в ленте (атрибут sizes)
+window.PREVIEW_VIEW_SIZES = '100vw'; // Ширина изображения на странице поста
 
 // Константы для метаданных аудио
 window.DEFAULT_TRACK_TITLE = 'Без названия';
-window.DEFAULT_ARTIST = 'Неизвестный исполнитель';
\ No newline at end of file
+window.DEFAULT_ARTIST = 'Неизвестный исполнитель';
+
+// Константы для возобновляемой загрузки файлов
+window.UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024; // Размер части файла при загрузке (5 МБ)
+window.UPLOAD_MAX_RETRIES = 5; // Сколько раз повторять загрузку части после обрыва соединения
+window.UPLOAD_RETRY_DELAY = 1000; // Базовая задержка перед повтором (мс), растёт с каждой попыткой
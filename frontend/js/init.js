@@ -128,6 +128,11 @@ if (typeof initSort === 'function') {
     initSort();
 }
 
+// Инициализация поиска
+if (typeof initSearch === 'function') {
+    initSearch();
+}
+
 // Обработчик кнопки "Назад" на странице поста
 document.addEventListener('DOMContentLoaded', () => {
     const backBtn = document.getElementById('back-to-posts-btn');
@@ -136,7 +136,7 @@ function createPostElementForView(post) {
             fileDiv.className = 'post-file';
             const fileUrl = normalizeFileUrl(file.file_url);
             const img = document.createElement('img');
-            img.src = fileUrl;
+            setPreviewImage(img, file, PREVIEW_VIEW_SIZES);
             img.alt = escapeHtml(file.file_name);
             img.loading = 'lazy';
             img.className = 'post-image';
@@ -200,41 +200,84 @@ function createPostElementForView(post) {
     return postDiv;
 }
 
+let lastCommentId = null; // ID последнего полученного комментария (для дочитывания новых)
+
+// Комментарии поста по страницам (курсор в заголовке X-Next-Cursor); afterId - только новее него
+async function fetchComments(postId, afterId = null) {
+    const comments = [];
+    let cursor = null;
+    do {
+        const params = new URLSearchParams({ limit: '100' });
+        if (afterId !== null) params.set('after_id', afterId);
+        if (cursor) params.set('cursor', cursor);
+        
+        const response = await fetch(`${API_BASE}/posts/${postId}/comments?${params}`);
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        comments.push(...await response.json());
+        cursor = response.headers.get('X-Next-Cursor');
+    } while (cursor);
+    return comments;
+}
+
+// Добавление комментариев в конец списка
+function appendComments(comments, postId) {
+    const commentsList = document.getElementById('comments-list');
+    const placeholder = commentsList.querySelector('.no-comments');
+    if (placeholder && comments.length > 0) {
+        placeholder.remove();
+    }
+    
+    comments.forEach(comment => {
+        if (!comment.is_deleted) {
+            const commentElement = createCommentElement(comment, postId);
+            commentsList.appendChild(commentElement);
+        }
+    });
+    if (comments.length > 0) {
+        lastCommentId = comments[comments.length - 1].id;
+    }
+}
+
 // Загрузка комментариев
 async function loadComments(postId) {
     const commentsList = document.getElementById('comments-list');
     if (!commentsList) return;
+    lastCommentId = null;
     
     try {
-        const response = await fetch(`${API_BASE}/posts/${postId}/comments`);
+        const comments = await fetchComments(postId);
         
-        if (response.ok) {
-            const comments = await response.json();
-            
-            if (comments.length === 0) {
-                commentsList.innerHTML = '<p class="no-comments">Комментариев пока нет</p>';
-                return;
-            }
-            
-            // Очищаем список
-            commentsList.innerHTML = '';
-            
-            // Отображаем комментарии
-            comments.forEach(comment => {
-                if (!comment.is_deleted) {
-                    const commentElement = createCommentElement(comment, postId);
-                    commentsList.appendChild(commentElement);
-                }
-            });
-        } else {
-            commentsList.innerHTML = '<p class="no-comments">Ошибка загрузки комментариев</p>';
+        if (comments.length === 0) {
+            commentsList.innerHTML = '<p class="no-comments">Комментариев пока нет</p>';
+            return;
         }
+        
+        // Очищаем список и отображаем комментарии
+        commentsList.innerHTML = '';
+        appendComments(comments, postId);
     } catch (error) {
         console.error('Ошибка загрузки комментариев:', error);
         commentsList.innerHTML = '<p class="no-comments">Ошибка загрузки комментариев</p>';
     }
 }
 
+// Дочитывание комментариев, появившихся после последнего полученного
+async function loadNewComments(postId) {
+    if (lastCommentId === null) {
+        await loadComments(postId);
+        return;
+    }
+    
+    try {
+        appendComments(await fetchComments(postId, lastCommentId), postId);
+    } catch (error) {
+        console.error('Ошибка загрузки новых комментариев:', error);
+        await loadComments(postId);
+    }
+}
+
 // Создание элемента комментария
 function createCommentElement(comment, postId) {
     const commentDiv = document.createElement('div');
@@ -301,8 +344,8 @@ async function submitComment(postId) {
             // Очищаем форму
             commentText.value = '';
             
-            // Перезагружаем комментарии
-            await loadComments(postId);
+            // Дочитываем новые комментарии (свой и написанные за это время)
+            await loadNewComments(postId);
         } else {
             const errorData = await response.json().catch(() => ({}));
             alert(errorData.detail || 'Ошибка отправки комментария');
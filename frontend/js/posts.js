@@ -1,8 +1,12 @@
-let currentPage = 0;
+let nextCursor = null; // Курсор следующей страницы ленты (заголовок X-Next-Cursor)
+let hasMorePosts = true; // Есть ли ещё страницы
 let allPosts = []; // Храним все загруженные посты
 let currentCategory = 'all'; // Текущая выбранная категория
 let currentSort = 'date'; // Текущая сортировка (date, upvotes)
 let currentSortDirection = 'desc'; // Направление сортировки (asc, desc)
+let currentSearch = ''; // Поисковый запрос; пока он задан, лента показывает результаты GET /search
+const audioMetadataByFile = new Map(); // Метаданные аудио из пакетного запроса: id файла -> метаданные
+const audioMetadataRequests = new Map(); // id поста -> Promise пакетного запроса, в который попал пост
 
 // Функция для получения токена динамически (использует функцию из auth.js, если доступна)
 function getAuthToken() {
@@ -25,79 +29,30 @@ function escapeHtml(text) {
 function displayPosts(posts) {
     const container = document.getElementById('posts');
 
+    // Метаданные всех аудио файлов страницы - одним запросом
+    requestAudioMetadata(posts.filter(post => post.files?.some(file => file.file_type?.startsWith('audio/'))).map(post => post.id));
+
     posts.forEach(post => {
         const postElement = createPostElement(post);
         container.appendChild(postElement);
     });
 }
 
-// Сортировка постов
-function sortPosts(posts, sortBy, direction) {
-    const sortedPosts = [...posts];
-    
-    sortedPosts.sort((a, b) => {
-        let comparison = 0;
-        
-        if (sortBy === 'date') {
-            // Сортировка по дате создания
-            const dateA = new Date(a.date);
-            const dateB = new Date(b.date);
-            comparison = dateA - dateB;
-        } else if (sortBy === 'upvotes') {
-            // Сортировка по апвоутам
-            comparison = (a.upvotes || 0) - (b.upvotes || 0);
-        }
-        
-        // Применяем направление сортировки
-        return direction === 'asc' ? comparison : -comparison;
-    });
-    
-    return sortedPosts;
-}
-
 // Фильтрация постов по категории
 function filterPostsByCategory(category) {
     currentCategory = category;
     applyFiltersAndSort();
 }
 
-// Применение фильтров и сортировки
+// Применение фильтров и сортировки: категория и сортировка применяются на сервере,
+// поэтому лента загружается заново с первой страницы
 function applyFiltersAndSort() {
-    let filteredPosts = [];
-    
-    // Фильтрация по категории
-    if (currentCategory === 'all') {
-        filteredPosts = allPosts;
-    } else if (currentCategory === 'image') {
-        filteredPosts = allPosts.filter(post => post.file_type?.startsWith('image/'));
-    } else if (currentCategory === 'video') {
-        filteredPosts = allPosts.filter(post => post.file_type?.startsWith('video/'));
-    } else if (currentCategory === 'audio') {
-        filteredPosts = allPosts.filter(post => post.file_type?.startsWith('audio/'));
-    } else if (currentCategory === 'text') {
-        filteredPosts = allPosts.filter(post => !post.file_type || post.file_type === null);
-    } else if (currentCategory === 'other') {
-        filteredPosts = allPosts.filter(post => {
-            const fileType = post.file_type;
-            return fileType && 
-                   !fileType.startsWith('image/') && 
-                   !fileType.startsWith('video/') && 
-                   !fileType.startsWith('audio/');
-        });
-    }
-    
-    // Применяем сортировку
-    filteredPosts = sortPosts(filteredPosts, currentSort, currentSortDirection);
-    
-    // Очищаем контейнер и отображаем отфильтрованные посты
-    const container = document.getElementById('posts');
-    container.innerHTML = '';
-    displayPosts(filteredPosts);
-    
     // Обновляем активную категорию в UI
     updateActiveCategory(currentCategory);
     // Обновляем активную сортировку в UI
     updateActiveSort();
+
+    loadPosts(true);
 }
 
 // Обновление активной категории в UI
@@ -114,8 +69,11 @@ function updateActiveCategory(category) {
 
 async function loadPosts(reset = false) {
     if (reset) {
-        currentPage = 0;
+        nextCursor = null;
+        hasMorePosts = true;
         document.getElementById('posts').innerHTML = '';
+    } else if (!hasMorePosts) {
+        return;
     }
 
     const authToken = getAuthToken();
@@ -126,8 +84,32 @@ async function loadPosts(reset = false) {
     }
 
     try {
+        // Страницы выбираются по курсору: новые посты не сдвигают уже загруженные
+        let url;
+        if (currentSearch) {
+            // Результаты поиска упорядочены по релевантности, категория и сортировка не применяются
+            const params = new URLSearchParams({ q: currentSearch, limit: SEARCH_RESULTS_PER_PAGE });
+            if (nextCursor) {
+                params.set('cursor', nextCursor);
+            }
+            url = `${API_BASE}/search?${params}`;
+        } else {
+            const params = new URLSearchParams({
+                limit: POSTS_PER_PAGE,
+                include_deleted: false,
+                sort: currentSort,
+                order: currentSortDirection
+            });
+            if (currentCategory !== 'all') {
+                params.set('category', currentCategory);
+            }
+            if (nextCursor) {
+                params.set('cursor', nextCursor);
+            }
+            url = `${API_BASE}/posts?${params}`;
+        }
         const response = await fetch(
-            `${API_BASE}/posts?skip=${currentPage * POSTS_PER_PAGE}&limit=${POSTS_PER_PAGE}&include_deleted=false`,
+            url,
             {
                 headers: {
                     'Authorization': `Bearer ${authToken}`
@@ -136,7 +118,16 @@ async function loadPosts(reset = false) {
         );
 
         if (response.ok) {
-            const posts = await response.json();
+            let posts = await response.json();
+            if (currentSearch) {
+                // Найденный комментарий показывается постом; пост, уже показанный выше, пропускается
+                const shownIds = new Set(reset ? [] : allPosts.map(post => post.id));
+                posts = posts.map(result => result.post).filter(post => {
+                    if (shownIds.has(post.id)) return false;
+                    shownIds.add(post.id);
+                    return true;
+                });
+            }
             
             if (reset) {
                 allPosts = posts; // Сохраняем все посты
@@ -144,16 +135,16 @@ async function loadPosts(reset = false) {
                 allPosts = allPosts.concat(posts); // Добавляем новые посты
             }
             
-            // Применяем фильтр и сортировку к загруженным постам
-            applyFiltersAndSort();
-            currentPage++;
-
-            // Скрываем кнопку, если постов меньше лимита
-            if (posts.length < 10) {
-                const loadMoreBtn = document.getElementById('loadMoreBtn');
-                if (loadMoreBtn) {
-                    loadMoreBtn.style.display = 'none';
-                }
+            // Посты уже отфильтрованы и отсортированы сервером - дописываем страницу в конец
+            displayPosts(posts);
+
+            // Курсора нет - это последняя страница, скрываем кнопку
+            // (после смены категории или сортировки она может снова понадобиться)
+            nextCursor = response.headers.get('X-Next-Cursor');
+            hasMorePosts = Boolean(nextCursor);
+            const loadMoreBtn = document.getElementById('loadMoreBtn');
+            if (loadMoreBtn) {
+                loadMoreBtn.style.display = hasMorePosts ? '' : 'none';
             }
         } else {
             console.error('Ошибка загрузки постов:', response.status);
@@ -300,13 +291,13 @@ function createPostElement(post) {
             loadAllTracksMetadata(post.id, audioFiles);
         }
         
-        // Изображения
+        // Изображения (в ленте - уменьшенные копии, по клику - оригинал)
         imageFiles.forEach(file => {
             const fileDiv = document.createElement('div');
             fileDiv.className = 'post-file';
             const fileUrl = normalizeFileUrl(file.file_url);
             const img = document.createElement('img');
-            img.src = fileUrl;
+            setPreviewImage(img, file, PREVIEW_SIZES);
             img.alt = escapeHtml(file.file_name);
             img.loading = 'lazy';
             img.className = 'post-image';
@@ -454,6 +445,7 @@ function createPostElement(post) {
             <span class="vote-count">${post.upvotes}</span>
             <button class="vote-btn downvote-btn" onclick="downvotePost(${post.id})" title="Даунвоут">▼</button>
         </div>
+        <a href="#" class="post-id-link" onclick="showPostPage(${post.id}); return false;" title="Комментарии">💬 ${post.comment_count || 0}</a>
         ${deleteButtonHtml}
     `;
 
@@ -493,37 +485,47 @@ async function main() {
     createPostElement(1);
 }
 
+// Пакетный запрос метаданных всех аудио файлов постов (посты, уже попавшие в запрос, пропускаются)
+function requestAudioMetadata(postIds) {
+    const newPostIds = postIds.filter(postId => !audioMetadataRequests.has(postId));
+    if (newPostIds.length === 0) return;
+    
+    const params = new URLSearchParams();
+    newPostIds.forEach(postId => params.append('post_ids', postId));
+    
+    const request = fetch(`${API_BASE}/posts/metadata/batch?${params}`, {
+        headers: {
+            'Authorization': `Bearer ${getAuthToken()}`
+        }
+    })
+        .then(response => response.ok ? response.json() : { tracks: [] })
+        .then(data => data.tracks.forEach(track => audioMetadataByFile.set(track.file_id, track)))
+        .catch(error => console.error('Ошибка загрузки метаданных:', error));
+    
+    newPostIds.forEach(postId => audioMetadataRequests.set(postId, request));
+}
+
+// Метаданные аудио файла из пакетного запроса его поста
+async function getAudioMetadata(postId, fileId) {
+    if (!audioMetadataRequests.has(postId)) {
+        requestAudioMetadata([postId]);
+    }
+    await audioMetadataRequests.get(postId);
+    return audioMetadataByFile.get(fileId) || null;
+}
+
 // Загрузка метаданных для всех треков альбома
 async function loadAllTracksMetadata(postId, audioFiles, isViewPage = false) {
     if (!audioFiles || audioFiles.length === 0) return;
     
-    const authToken = getAuthToken();
-    const prefix = isViewPage ? 'view-' : '';
-    
-    // Загружаем метаданные для каждого трека параллельно
-    const promises = audioFiles.map(async (file, index) => {
+    // Все треки приходят одним пакетным запросом
+    await Promise.all(audioFiles.map(async (file, index) => {
         if (!file.id) return; // Пропускаем, если нет ID файла
         
-        try {
-            const metadataUrl = `${API_BASE}/posts/${postId}/files/${file.id}/metadata`;
-            const response = await fetch(metadataUrl, {
-                headers: {
-                    'Authorization': `Bearer ${authToken}`
-                }
-            });
-            
-            if (response.ok) {
-                const metadata = await response.json();
-                // Обновляем название трека
-                updateTrackName(postId, index, metadata?.title || file.file_name, isViewPage);
-            }
-        } catch (error) {
-            console.error(`Ошибка загрузки метаданных для трека ${index}:`, error);
-        }
-    });
-    
-    // Ждём завершения всех загрузок
-    await Promise.all(promises);
+        const metadata = await getAudioMetadata(postId, file.id);
+        // Обновляем название трека
+        updateTrackName(postId, index, metadata?.title || file.file_name, isViewPage);
+    }));
 }
 
 // Обновление названия трека в списке
@@ -546,16 +548,16 @@ async function loadAudioMetadata(post, audioFiles = null, trackIndex = 0, isView
         // Получаем токен динамически
         const authToken = getAuthToken();
         
-        // Если это альбом, используем file_id из audioFiles
-        let metadataUrl;
+        // Если это альбом, метаданные берутся из пакетного запроса по file_id
         if (audioFiles && audioFiles[trackIndex]?.id) {
-            // Для альбомов используем эндпоинт для конкретного файла
-            metadataUrl = `${API_BASE}/posts/${post.id}/files/${audioFiles[trackIndex].id}/metadata`;
-        } else {
-            // Для одиночных файлов используем старый эндпоинт
-            metadataUrl = `${API_BASE}/posts/${post.id}/metadata`;
+            const metadata = await getAudioMetadata(post.id, audioFiles[trackIndex].id);
+            displayAudioPlayer(post, metadata, audioFiles, trackIndex, isViewPage);
+            return;
         }
         
+        // Для постов старого формата (без списка файлов) используем старый эндпоинт
+        const metadataUrl = `${API_BASE}/posts/${post.id}/metadata`;
+        
         const response = await fetch(metadataUrl, {
             headers: {
                 'Authorization': `Bearer ${authToken}`
@@ -593,15 +595,13 @@ function displayAudioPlayer(post, metadata, audioFiles = null, trackIndex = 0, i
     if (audioFiles) {
         // Это альбом - обложка должна быть в отдельном контейнере сверху
         const coverContainer = document.getElementById(`audio-cover-${prefix}${post.id}`);
+        const coverFile = audioFiles[trackIndex];
         if (coverContainer) {
-            if (metadata?.cover) {
-                // cover - это data URL (base64), используем как есть
-                const coverSrc = metadata.cover.startsWith('data:') 
-                    ? metadata.cover 
-                    : normalizeFileUrl(metadata.cover);
-                coverContainer.innerHTML = `<img src="${coverSrc}" alt="Обложка" class="audio-cover">`;
+            if (coverFile?.thumbnail_url) {
+                // Уменьшенная копия обложки, построенная сервером
+                coverContainer.innerHTML = `<img src="${normalizeFileUrl(coverFile.thumbnail_url)}" srcset="${normalizeSrcset(coverFile.srcset)}" sizes="${PREVIEW_SIZES}" alt="Обложка" class="audio-cover">`;
             } else if (metadata?.cover_url) {
-                // cover_url - это обычный URL, нормализуем
+                // Обложка из хранилища обложек (кэшируется браузером)
                 coverContainer.innerHTML = `<img src="${normalizeFileUrl(metadata.cover_url)}" alt="Обложка" class="audio-cover">`;
             } else {
                 coverContainer.innerHTML = '';
@@ -610,14 +610,8 @@ function displayAudioPlayer(post, metadata, audioFiles = null, trackIndex = 0, i
     } else {
         // Одиночный файл - обложка внутри плеера
         let coverImg = '';
-        if (metadata?.cover) {
-            // cover - это data URL (base64), используем как есть
-            const coverSrc = metadata.cover.startsWith('data:') 
-                ? metadata.cover 
-                : normalizeFileUrl(metadata.cover);
-            coverImg = `<img src="${coverSrc}" alt="Обложка" class="audio-cover">`;
-        } else if (metadata?.cover_url) {
-            // cover_url - это обычный URL, нормализуем
+        if (metadata?.cover_url) {
+            // Обложка из хранилища обложек (кэшируется браузером)
             coverImg = `<img src="${normalizeFileUrl(metadata.cover_url)}" alt="Обложка" class="audio-cover">`;
         }
         
@@ -691,6 +685,28 @@ function normalizeFileUrl(url) {
     return fileUrl.replace(/^https:\/\//, 'http://');
 }
 
+// Нормализация всех URL в атрибуте srcset ("url 320w, url 640w")
+function normalizeSrcset(srcset) {
+    if (!srcset) return '';
+    return srcset.split(',').map(candidate => {
+        const [url, descriptor] = candidate.trim().split(/\s+/);
+        return descriptor ? `${normalizeFileUrl(url)} ${descriptor}` : normalizeFileUrl(url);
+    }).join(', ');
+}
+
+// Подставляет в <img> уменьшенные копии файла, если сервер их уже построил, иначе оригинал
+function setPreviewImage(img, file, sizes) {
+    if (file.thumbnail_url) {
+        img.src = normalizeFileUrl(file.thumbnail_url);
+        if (file.srcset) {
+            img.srcset = normalizeSrcset(file.srcset);
+            img.sizes = sizes;
+        }
+    } else {
+        img.src = normalizeFileUrl(file.file_url);
+    }
+}
+
 // Функция для форматирования размера файла
 function formatFileSize(bytes) {
     if (!bytes) return '0 B';
@@ -804,23 +820,19 @@ async function downvotePost(postId) {
         });
         
         if (response.ok) {
-            const updatedPost = await response.json();
+            const vote = await response.json();
             
             // Обновляем пост в массиве allPosts
             const postIndex = allPosts.findIndex(p => p.id === postId);
             if (postIndex !== -1) {
-                allPosts[postIndex].upvotes = updatedPost.upvotes;
+                allPosts[postIndex].upvotes = vote.upvotes;
             }
             
-            // Если сортировка по апвоутам, пересортируем
-            if (currentSort === 'upvotes') {
-                applyFiltersAndSort();
-            } else {
-                // Иначе просто обновляем счётчик
-                const voteCount = document.querySelector(`#post-${postId} .vote-count`);
-                if (voteCount) {
-                    voteCount.textContent = updatedPost.upvotes;
-                }
+            // Обновляем счётчик; при сортировке по апвоутам пост займёт новое место
+            // при следующей загрузке ленты, чтобы не сбивать курсор загруженных страниц
+            const voteCount = document.querySelector(`#post-${postId} .vote-count`);
+            if (voteCount) {
+                voteCount.textContent = vote.upvotes;
             }
         } else {
             console.error('Ошибка даунвоута:', response.status);
@@ -877,39 +889,35 @@ async function deletePost(postId) {
 }
 
 async function upvotePost(postId) {
-    // Примечание: эндпоинт не требует авторизации, но оставляем проверку на будущее
     const authToken = getAuthToken();
     
+    if (!authToken) {
+        alert('Необходима авторизация для голосования');
+        return;
+    }
+    
     try {
-        const headers = {};
-        // Отправляем токен, если он есть (для будущей авторизации)
-        if (authToken) {
-            headers['Authorization'] = `Bearer ${authToken}`;
-        }
-        
         const response = await fetch(`${API_BASE}/posts/${postId}/upvote`, {
             method: 'POST',
-            headers: headers
+            headers: {
+                'Authorization': `Bearer ${authToken}`
+            }
         });
         
         if (response.ok) {
-            const updatedPost = await response.json();
+            const vote = await response.json();
             
             // Обновляем пост в массиве allPosts
             const postIndex = allPosts.findIndex(p => p.id === postId);
             if (postIndex !== -1) {
-                allPosts[postIndex].upvotes = updatedPost.upvotes;
+                allPosts[postIndex].upvotes = vote.upvotes;
             }
             
-            // Если сортировка по апвоутам, пересортируем
-            if (currentSort === 'upvotes') {
-                applyFiltersAndSort();
-            } else {
-                // Иначе просто обновляем счётчик
-                const voteCount = document.querySelector(`#post-${postId} .vote-count`);
-                if (voteCount) {
-                    voteCount.textContent = updatedPost.upvotes;
-                }
+            // Обновляем счётчик; при сортировке по апвоутам пост займёт новое место
+            // при следующей загрузке ленты, чтобы не сбивать курсор загруженных страниц
+            const voteCount = document.querySelector(`#post-${postId} .vote-count`);
+            if (voteCount) {
+                voteCount.textContent = vote.upvotes;
             }
         } else {
             const errorData = await response.json().catch(() => ({}));
@@ -967,6 +975,26 @@ function initCategoryFilter() {
     updateActiveCategory('all');
 }
 
+// Инициализация поиска: запрос выполняется по Enter, пустой запрос возвращает ленту
+function initSearch() {
+    const searchForm = document.getElementById('search-form');
+    const searchInput = document.getElementById('search-input');
+    if (!searchForm || !searchInput) return;
+    
+    searchForm.addEventListener('submit', (e) => {
+        e.preventDefault();
+        currentSearch = searchInput.value.trim();
+        loadPosts(true);
+    });
+    // Очистка поля (крестик в input type="search") тоже возвращает ленту
+    searchInput.addEventListener('search', () => {
+        if (!searchInput.value.trim() && currentSearch) {
+            currentSearch = '';
+            loadPosts(true);
+        }
+    });
+}
+
 // Инициализация сортировки
 function initSort() {
     const sortButtons = document.querySelectorAll('.sort-btn');
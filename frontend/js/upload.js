@@ -1,29 +1,95 @@
-// Функция для создания поста
-async function createPost(text, files) {
-    const authToken = getAuthToken();
+// Ожидание перед повторной попыткой
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+// Получение текущего смещения загрузки (сколько байт уже на сервере)
+async function getUploadOffset(uploadId, authToken) {
+    const response = await fetch(`${API_BASE}/uploads/${uploadId}`, {
+        method: 'HEAD',
+        headers: {
+            'Authorization': `Bearer ${authToken}`
+        }
+    });
     
-    if (!authToken) {
-        throw new Error('Необходима авторизация');
+    if (!response.ok) {
+        throw new Error('Сессия загрузки не найдена');
     }
     
-    const formData = new FormData();
-    formData.append('text', text);
+    return parseInt(response.headers.get('Upload-Offset'), 10);
+}
+
+// Возобновляемая загрузка файла по частям: при обрыве соединения
+// догружаются только недостающие байты
+async function uploadFileResumable(file, authToken) {
+    const createResponse = await fetch(`${API_BASE}/uploads`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Bearer ${authToken}`
+        },
+        body: JSON.stringify({
+            file_name: file.name,
+            file_type: file.type || null,
+            total_size: file.size
+        })
+    });
+    
+    if (!createResponse.ok) {
+        const errorData = await createResponse.json().catch(() => ({}));
+        throw new Error(errorData.detail || `Ошибка загрузки файла ${file.name}`);
+    }
     
-    // Поддержка нескольких файлов
-    if (files && files.length > 0) {
-        files.forEach(file => {
-            if (file) {
-                formData.append('files', file);
+    const upload = await createResponse.json();
+    let offset = upload.offset;
+    let retries = 0;
+    
+    while (offset < file.size) {
+        try {
+            const chunk = file.slice(offset, offset + UPLOAD_CHUNK_SIZE);
+            const response = await fetch(`${API_BASE}/uploads/${upload.id}`, {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'application/offset+octet-stream',
+                    'Authorization': `Bearer ${authToken}`,
+                    'Upload-Offset': String(offset)
+                },
+                body: chunk
+            });
+            
+            if (response.ok) {
+                offset = parseInt(response.headers.get('Upload-Offset'), 10);
+                retries = 0;
+            } else if (response.status === 409) {
+                // Сервер получил другое количество байт - продолжаем с его смещения
+                offset = await getUploadOffset(upload.id, authToken);
+            } else {
+                const errorData = await response.json().catch(() => ({}));
+                throw new Error(errorData.detail || `Ошибка загрузки файла ${file.name}`);
             }
-        });
+        } catch (error) {
+            retries++;
+            if (retries > UPLOAD_MAX_RETRIES) {
+                throw error;
+            }
+            console.error(`Ошибка загрузки части файла ${file.name}, повтор ${retries}:`, error);
+            await sleep(UPLOAD_RETRY_DELAY * retries);
+            offset = await getUploadOffset(upload.id, authToken).catch(() => offset);
+        }
     }
     
-    const response = await fetch(`${API_BASE}/posts`, {
+    return upload.id;
+}
+
+// Завершение загрузок: пост создаётся сразу со всеми файлами в исходном порядке
+async function finalizeUploads(uploadIds, authToken, text) {
+    const response = await fetch(`${API_BASE}/uploads/finalize`, {
         method: 'POST',
         headers: {
+            'Content-Type': 'application/json',
             'Authorization': `Bearer ${authToken}`
         },
-        body: formData
+        body: JSON.stringify({ upload_ids: uploadIds, text: text })
     });
     
     if (!response.ok) {
@@ -34,6 +100,63 @@ async function createPost(text, files) {
     return await response.json();
 }
 
+// Отмена загрузок, из которых не удалось создать пост (данные на сервере удаляются)
+async function cancelUploads(uploadIds, authToken) {
+    await Promise.all(uploadIds.map(uploadId =>
+        fetch(`${API_BASE}/uploads/${uploadId}`, {
+            method: 'DELETE',
+            headers: {
+                'Authorization': `Bearer ${authToken}`
+            }
+        }).catch(() => null)
+    ));
+}
+
+// Функция для создания поста
+async function createPost(text, files) {
+    const authToken = getAuthToken();
+    
+    if (!authToken) {
+        throw new Error('Необходима авторизация');
+    }
+    
+    const postFiles = (files || []).filter(file => file);
+    
+    // Пост без файлов создаётся одним запросом
+    if (postFiles.length === 0) {
+        const formData = new FormData();
+        formData.append('text', text);
+        
+        const response = await fetch(`${API_BASE}/posts`, {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${authToken}`
+            },
+            body: formData
+        });
+        
+        if (!response.ok) {
+            const errorData = await response.json().catch(() => ({}));
+            throw new Error(errorData.detail || 'Ошибка создания поста');
+        }
+        
+        return await response.json();
+    }
+    
+    // Сначала загружаем все файлы, затем одним запросом собираем из них пост
+    const uploadIds = [];
+    try {
+        for (const file of postFiles) {
+            uploadIds.push(await uploadFileResumable(file, authToken));
+        }
+        
+        return await finalizeUploads(uploadIds, authToken, text);
+    } catch (error) {
+        await cancelUploads(uploadIds, authToken);
+        throw error;
+    }
+}
+
 // Функция для переключения страниц
 function showPage(pageId) {
     // Получаем контейнер с постами